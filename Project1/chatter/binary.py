@@ -0,0 +1,225 @@
+import socket
+import struct
+
+# Compact binary encoding of the chat protocol, used in place of the newline delimited text encoding
+# when a client asks for it. Every message is a frame made up of a 4 byte big endian length, a 1 byte
+# message type, and a type specific body. The length counts the type byte and the body.
+#
+# Frames are kept under 16 MiB, so the first byte of a binary frame is always zero, which no text
+# message ever starts with. That is how the encoding is negotiated: a client that opens with a binary
+# HELO speaks binary for the rest of its session, and everybody else keeps speaking text.
+#
+# Members are encoded as a flags byte, a packed IPv4 address, a 2 byte port, and a length prefixed
+# UTF-8 screen name. The binary flag says whether the member understands binary messages, which lets
+# peers pick the encoding of the chat messages they send it. The room flag is only set in a HELO, and
+# says the member is followed by the length prefixed name of the room to join.
+#
+#   HELO  member, optionally followed by a room name and then the roster version the member last saw
+#   ACPT  member, member, ...
+#   RJCT  screen name, optionally followed by a 1 byte reason the HELO was rejected
+#   JOIN  member
+#   EXIT  screen name (empty when a member says it is leaving)
+#   MESG  screen name, then the UTF-8 message filling the rest of the frame
+#   PING  (empty)
+#   MCST  packed IPv4 group address and 2 byte port
+#   ROST  member, member, ... (the rest of a roster too large for one ACPT datagram)
+#   VERS  4 byte roster id, 8 byte roster version, and 8 byte membership event sequence number
+#   RSYN  roster changes, each a JOIN type byte and a member or an EXIT type byte and a screen name
+#   SEQN  8 byte sequence number of the first of the membership events following it in a datagram
+#   NACK  8 byte sequence numbers of the first and last membership events to resend
+#   FWRD  screen name of the sender, 8 byte message id, then the UTF-8 message filling the rest of the
+#         frame (a chat message passed along the tree overlay, see overlay.py)
+#   RLAY  (empty, sent ahead of the roster when the server relays the chat messages sent to it)
+
+HELO, ACPT, RJCT, JOIN, EXIT, MESG, PING, MCST, ROST, VERS, RSYN, SEQN, NACK, FWRD, RLAY = range( 1, 16 )
+
+MESSAGE_TYPES = {
+    HELO: "HELO",
+    ACPT: "ACPT",
+    RJCT: "RJCT",
+    JOIN: "JOIN",
+    EXIT: "EXIT",
+    MESG: "MESG",
+    PING: "PING",
+    MCST: "MCST",
+    ROST: "ROST",
+    VERS: "VERS",
+    RSYN: "RSYN",
+    SEQN: "SEQN",
+    NACK: "NACK",
+    FWRD: "FWRD",
+    RLAY: "RLAY"
+}
+
+FLAG_BINARY = 0x01
+FLAG_ROOM = 0x02
+
+# Reasons the server gives for rejecting a HELO, other than the screen name being in use, which is
+# what a RJCT without a reason means. The text encoding sends the name after the screen name, and
+# the binary one sends its index in this tuple plus one.
+REJECT_REASONS = ("BUSY", "RATE", "ROOM")
+
+MAX_FRAME_SIZE = (1 << 24) - 1
+
+FRAME_HEADER = struct.Struct( "!IB" )
+NAME_FRAME_HEADER = struct.Struct( "!IBB" )
+MEMBER_ADDRESS = struct.Struct( "!B4sH" )
+MEMBER_HEADER = struct.Struct( "!B4sHB" )
+ADDRESS = struct.Struct( "!4sH" )
+ROSTER_VERSION = struct.Struct( "!IQ" )
+SEQUENCE = struct.Struct( "!Q" )
+SEQUENCE_RANGE = struct.Struct( "!QQ" )
+MESSAGE_ID = struct.Struct( "!Q" )
+
+def is_binary( data ):
+    return len( data ) > 0 and data[0] == 0
+
+def encode_frame( message_type, body=b"" ):
+    if len( body ) >= MAX_FRAME_SIZE:
+        raise ValueError( f"Binary {MESSAGE_TYPES[message_type]} message too large to encode." )
+    return FRAME_HEADER.pack( len( body ) + 1, message_type ) + body
+
+def encode_name( screen_name ):
+    name = screen_name.encode()
+    if len( name ) > 255:
+        raise ValueError( f"Screen name {screen_name} is too long to encode." )
+    return bytes( (len( name ),) ) + name
+
+def encode_named_frame( message_type, screen_name, rest=b"" ):
+    # Encodes a frame whose body is a screen name followed by rest. Screen names are always short, so
+    # the frame header and the name's length are packed in one go rather than framing an encoded name.
+    name = screen_name.encode()
+    if len( name ) > 255:
+        raise ValueError( f"Screen name {screen_name} is too long to encode." )
+    return NAME_FRAME_HEADER.pack( len( name ) + len( rest ) + 2, message_type, len( name ) ) + name + rest
+
+def encode_member( screen_name, ip_address, port, flags=0 ):
+    # Members are the bulk of a roster, so the fixed size part of each one, up to and including the
+    # length of its screen name, is packed in one go.
+    name = screen_name.encode()
+    if len( name ) > 255:
+        raise ValueError( f"Screen name {screen_name} is too long to encode." )
+    return MEMBER_HEADER.pack( flags, socket.inet_aton( ip_address ), int( port ), len( name ) ) + name
+
+def encode_hello( screen_name, ip_address, port, roster_version=None, room=None ):
+    if room:
+        body = encode_member( screen_name, ip_address, port, FLAG_BINARY | FLAG_ROOM ) + encode_name( room )
+    else:
+        body = encode_member( screen_name, ip_address, port, FLAG_BINARY )
+    if roster_version:
+        body += ROSTER_VERSION.pack( *roster_version )
+    return encode_frame( HELO, body )
+
+def encode_reject( screen_name, reason=None ):
+    return encode_named_frame( RJCT, screen_name, bytes( (REJECT_REASONS.index( reason ) + 1,) ) if reason else b"" )
+
+def encode_exit( screen_name ):
+    return encode_named_frame( EXIT, screen_name )
+
+def encode_message( screen_name, message ):
+    return encode_named_frame( MESG, screen_name, message.encode() )
+
+def encode_forward( screen_name, message_id, message ):
+    return encode_named_frame( FWRD, screen_name, MESSAGE_ID.pack( message_id ) + message.encode() )
+
+def encode_multicast_group( group, port ):
+    return encode_frame( MCST, ADDRESS.pack( socket.inet_aton( group ), port ) )
+
+def encode_roster_version( roster_id, version, event_sequence ):
+    return encode_frame( VERS, ROSTER_VERSION.pack( roster_id, version ) + SEQUENCE.pack( event_sequence ) )
+
+def encode_sequence( sequence ):
+    return encode_frame( SEQN, SEQUENCE.pack( sequence ) )
+
+def encode_repair_request( first, last ):
+    return encode_frame( NACK, SEQUENCE_RANGE.pack( first, last ) )
+
+def decode_name( body, offset=0 ):
+    # Returns the screen name starting at offset and the offset just past it.
+    end = offset + 1 + body[offset]
+    return body[offset + 1:end].decode(), end
+
+def decode_member( body, offset=0 ):
+    # Returns (screen name, ip address, port, flags) for the member starting at offset and the offset
+    # just past it.
+    flags, ip_address, port, name_length = MEMBER_HEADER.unpack_from( body, offset )
+    offset += MEMBER_HEADER.size
+    end = offset + name_length
+    return (body[offset:end].decode(), socket.inet_ntoa( ip_address ), port, flags), end
+
+def decode_members( body ):
+    # Rosters can hold thousands of members, so they are decoded in a single loop with everything it
+    # needs bound locally, rather than with a couple of function calls per member. The fixed size part
+    # of each member, up to and including the length of its screen name, is unpacked in one go.
+    members = []
+    append = members.append
+    unpack_header = MEMBER_HEADER.unpack_from
+    header_size = MEMBER_HEADER.size
+    inet_ntoa = socket.inet_ntoa
+    offset = 0
+    body_size = len( body )
+    while offset < body_size:
+        flags, ip_address, port, name_length = unpack_header( body, offset )
+        offset += header_size
+        end = offset + name_length
+        append( (body[offset:end].decode(), inet_ntoa( ip_address ), port, flags) )
+        offset = end
+    return members
+
+def decode_reject( body ):
+    # Returns the screen name and the reason it was rejected, which is None when the name is in use.
+    # A reason this side doesn't know of is returned as its number.
+    screen_name, offset = decode_name( body )
+    if offset == len( body ):
+        return screen_name, None
+    code = body[offset]
+    return screen_name, REJECT_REASONS[code - 1] if 0 < code <= len( REJECT_REASONS ) else str( code )
+
+def decode_message( body ):
+    screen_name, offset = decode_name( body )
+    return screen_name, body[offset:].decode()
+
+def decode_forward( body ):
+    # Returns the screen name of the sender, the message id, and the message.
+    screen_name, offset = decode_name( body )
+    message_id, = MESSAGE_ID.unpack_from( body, offset )
+    return screen_name, message_id, body[offset + MESSAGE_ID.size:].decode()
+
+def decode_multicast_group( body ):
+    group, port = ADDRESS.unpack_from( body )
+    return socket.inet_ntoa( group ), port
+
+def decode_roster_version( body ):
+    # Returns the roster id, roster version, and membership event sequence number.
+    roster_id, version = ROSTER_VERSION.unpack_from( body )
+    event_sequence, = SEQUENCE.unpack_from( body, ROSTER_VERSION.size )
+    return roster_id, version, event_sequence
+
+def decode_roster_changes( body ):
+    # Returns the members that joined, as (screen name, ip address, port, flags), and the screen
+    # names of the members that left.
+    joined = []
+    departed = []
+    offset = 0
+    while offset < len( body ):
+        if body[offset] == JOIN:
+            member, offset = decode_member( body, offset + 1 )
+            joined.append( member )
+        elif body[offset] == EXIT:
+            screen_name, offset = decode_name( body, offset + 1 )
+            departed.append( screen_name )
+        else:
+            raise ValueError( f"Unknown roster change type {body[offset]}." )
+    return joined, departed
+
+def split_frames( data ):
+    # Yields (message type, body) for each frame in a buffer holding one or more complete frames,
+    # such as a datagram carrying a batch of membership events.
+    offset = 0
+    while offset + FRAME_HEADER.size <= len( data ):
+        length, message_type = FRAME_HEADER.unpack_from( data, offset )
+        end = offset + 4 + length
+        if length == 0 or end > len( data ):
+            raise ValueError( "Truncated binary frame." )
+        yield message_type, data[offset + FRAME_HEADER.size:end]
+        offset = end
@@ -0,0 +1,139 @@
+import asyncio
+
+from .binary import FRAME_HEADER
+
+# Default upper bound on the size of a single newline delimited message. Peers that send more than
+# this without a newline have their partial message discarded.
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024
+
+# Smallest amount of free space handed to the transport for each read.
+MIN_READ_SIZE = 4096
+
+class LineProtocol( asyncio.BufferedProtocol ):
+    # Stream protocol for newline delimited text messages shared by the client and server. The
+    # transport reads straight into a preallocated buffer. Newlines are searched for in place, and only
+    # complete frames are decoded, so a message is copied exactly once (when it is decoded to a str).
+    #
+    # Subclasses implement message_received, which is called with each complete message minus its
+    # trailing newline, and may override frame_too_large to react to peers that exceed the frame size
+    # limit (e.g., by disconnecting them).
+    #
+    # When binary frames are allowed, the first byte the peer sends decides how the rest of the stream
+    # is framed. A zero byte can only be the start of a length prefixed binary frame (see binary.py),
+    # in which case binary_frame_received is called with the type and body of each frame instead.
+    def __init__( self, max_frame_size=DEFAULT_MAX_FRAME_SIZE, allow_binary_frames=False ):
+        self._max_frame_size = max_frame_size
+        self._binary_frames = False if not allow_binary_frames else None
+        self._frame_buffer = bytearray( min( max_frame_size + 1, 4 * MIN_READ_SIZE ) )
+
+        # Valid data lives between _frame_start and _frame_end. Everything before _scan_start is
+        # known not to contain a newline.
+        self._frame_start = 0
+        self._frame_end = 0
+        self._scan_start = 0
+
+        # Set while discarding the remainder of an oversized frame.
+        self._discarding = False
+
+    @property
+    def binary_frames( self ):
+        return bool( self._binary_frames )
+
+    def message_received( self, message ):
+        raise NotImplementedError()
+
+    def binary_frame_received( self, message_type, body ):
+        raise NotImplementedError()
+
+    def frame_too_large( self ):
+        pass
+
+    def get_buffer( self, sizehint ):
+        if len( self._frame_buffer ) - self._frame_end < MIN_READ_SIZE:
+            self._make_room()
+        return memoryview( self._frame_buffer )[self._frame_end:]
+
+    def buffer_updated( self, nbytes ):
+        self._frame_end += nbytes
+        buffer = self._frame_buffer
+
+        if self._binary_frames is None:
+            self._binary_frames = buffer[0] == 0
+        if self._binary_frames:
+            self._binary_buffer_updated()
+            return
+
+        with memoryview( buffer ) as view:
+            while True:
+                newline = buffer.find( b"\n", self._scan_start, self._frame_end )
+                if newline < 0:
+                    break
+
+                frame_start = self._frame_start
+                self._frame_start = self._scan_start = newline + 1
+
+                if self._discarding:
+                    # This newline terminates the oversized frame. Resume with the next one.
+                    self._discarding = False
+                    continue
+
+                self.message_received( str( view[frame_start:newline], "utf-8" ) )
+
+        if self._frame_start == self._frame_end:
+            # Everything has been consumed, so the next read can start at the front of the buffer.
+            self._frame_start = self._frame_end = self._scan_start = 0
+        else:
+            self._scan_start = self._frame_end
+            if self._frame_end - self._frame_start > self._max_frame_size:
+                self._discard_partial_frame()
+
+    def _binary_buffer_updated( self ):
+        buffer = self._frame_buffer
+        header_size = FRAME_HEADER.size
+
+        if self._discarding:
+            self._frame_start = self._frame_end = self._scan_start = 0
+            return
+
+        while self._frame_end - self._frame_start >= header_size:
+            length, message_type = FRAME_HEADER.unpack_from( buffer, self._frame_start )
+            if length == 0 or length > self._max_frame_size:
+                # There's no way to find the start of the next frame after a bad length, so the rest
+                # of the stream is unusable.
+                self._frame_start = self._frame_end = self._scan_start = 0
+                self._discarding = True
+                self.frame_too_large()
+                return
+
+            frame_end = self._frame_start + 4 + length
+            if frame_end > self._frame_end:
+                break
+
+            body = bytes( buffer[self._frame_start + header_size:frame_end] )
+            self._frame_start = frame_end
+            self.binary_frame_received( message_type, body )
+
+        if self._frame_start == self._frame_end:
+            self._frame_start = self._frame_end = self._scan_start = 0
+
+    def _discard_partial_frame( self ):
+        self._frame_start = self._frame_end = self._scan_start = 0
+        if not self._discarding:
+            self._discarding = True
+            self.frame_too_large()
+
+    def _make_room( self ):
+        pending = self._frame_end - self._frame_start
+
+        if self._frame_start > 0:
+            # Slide the partial frame to the front of the buffer.
+            self._frame_buffer[:pending] = self._frame_buffer[self._frame_start:self._frame_end]
+            self._scan_start -= self._frame_start
+            self._frame_start = 0
+            self._frame_end = pending
+
+        if len( self._frame_buffer ) - pending < MIN_READ_SIZE:
+            # The partial frame fills most of the buffer. Grow it, but never much past the largest
+            # frame we're willing to hold on to.
+            new_size = min( 2 * len( self._frame_buffer ), self._max_frame_size + MIN_READ_SIZE )
+            self._frame_buffer.extend( bytes( new_size - len( self._frame_buffer ) ) )
@@ -1,9 +1,13 @@
 class ChatMember:
-    def __init__( self, screen_name, address, port ):
+    def __init__( self, screen_name, address, port, binary=False ):
         self.screen_name = screen_name
         self.address = address
         self.port = port
 
+        # Whether the member understands binary chat messages. Only binary rosters carry this, so
+        # members learned about through the text protocol are always assumed to speak text.
+        self.binary = binary
+
     def __eq__( self, other ):
         if isinstance( other, ChatMember ):
             return self.screen_name == other.screen_name
@@ -1,3 +1,4 @@
+from . import binary
 from .member import *
 
 class ACPT:
@@ -9,13 +10,20 @@ class ACPT:
         members = [ChatMember( *member_data.split( " " ) ) for member_data in data.split( ":" )]
         return cls( members )
 
+class ROST( ACPT ):
+    # The rest of a roster that didn't fit in the ACPT datagram when joining over UDP.
+    pass
+
 class RJCT:
-    def __init__( self, screen_name ):
+    # The reason is one of binary.REJECT_REASONS, or None when the screen name is in use.
+    def __init__( self, screen_name, reason=None ):
         self.screen_name = screen_name
+        self.reason = reason
 
     @classmethod
     def new( cls, data ):
-        return cls( screen_name=data )
+        screen_name, _, reason = data.partition( " " )
+        return cls( screen_name, reason or None )
 
 class JOIN:
     def __init__( self, member ):
@@ -43,11 +51,134 @@ class MESG:
         screen_name, _, message = data.partition( ": " )
         return cls( screen_name, message )
 
+class FWRD:
+    # A chat message spreading down the tree overlay, tagged with an id so that members can drop any
+    # copies they have already seen.
+    def __init__( self, screen_name, message_id, message ):
+        self.screen_name = screen_name
+        self.message_id = int( message_id )
+        self.message = message
+
+    @classmethod
+    def new( cls, data ):
+        header, _, message = data.partition( ": " )
+        screen_name, message_id = header.split( " " )
+        return cls( screen_name, message_id, message )
+
+class MCST:
+    def __init__( self, group, port ):
+        self.group = group
+        self.port = int( port )
+
+    @classmethod
+    def new( cls, data ):
+        return cls( *data.split( " " ) )
+
+class RLAY:
+    # Sent ahead of the roster when the server relays chat messages. Servers that don't relay never
+    # send it, so without one our chat messages have to go straight to the other members.
+    @classmethod
+    def new( cls, data ):
+        return cls()
+
+class VERS:
+    # The roster version that the ACPT or RSYN right behind it brings us up to, and the sequence number
+    # of the last membership event the server sent before that roster.
+    def __init__( self, roster_id, version, event_sequence ):
+        self.roster_version = (int( roster_id ), int( version ))
+        self.event_sequence = int( event_sequence )
+
+    @classmethod
+    def new( cls, data ):
+        return cls( *data.split( " " ) )
+
+class RSYN:
+    # Sent instead of an ACPT when we rejoin with a roster the server still has the changes for. Each
+    # joined member replaces whatever we have under its screen name, and each departed screen name is
+    # removed if we have it.
+    def __init__( self, joined, departed ):
+        self.joined = joined
+        self.departed = departed
+
+    @classmethod
+    def new( cls, data ):
+        joined = []
+        departed = []
+        for change in data.split( ":" ):
+            if change.startswith( "+" ):
+                joined.append( ChatMember( *change[1:].split( " " ) ) )
+            elif change.startswith( "-" ):
+                departed.append( change[1:] )
+        return cls( joined, departed )
+
+class SEQN:
+    # Heads every datagram of membership events with the sequence number of its first event. The
+    # events after it are numbered consecutively.
+    def __init__( self, sequence ):
+        self.sequence = int( sequence )
+
+    @classmethod
+    def new( cls, data ):
+        return cls( data )
+
+class MessageBatch:
+    # Several messages delivered in one datagram, one per line. The membership server sends these
+    # when it coalesces bursts of JOIN and EXIT events.
+    def __init__( self, messages ):
+        self.messages = messages
+
+    @classmethod
+    def new( cls, data ):
+        return cls( [parse_message( message ) for message in data.split( "\n" ) if message] )
+
+def parse_binary_message( message_type, body ):
+    if message_type in (binary.ACPT, binary.ROST):
+        members = [ChatMember( screen_name, ip_address, port, bool( flags & binary.FLAG_BINARY ) )
+            for (screen_name, ip_address, port, flags) in binary.decode_members( body )]
+        return ACPT( members ) if message_type == binary.ACPT else ROST( members )
+    elif message_type == binary.RJCT:
+        return RJCT( *binary.decode_reject( body ) )
+    elif message_type == binary.JOIN:
+        (screen_name, ip_address, port, flags), _ = binary.decode_member( body )
+        return JOIN( ChatMember( screen_name, ip_address, port, bool( flags & binary.FLAG_BINARY ) ) )
+    elif message_type == binary.EXIT:
+        return EXIT( binary.decode_name( body )[0] )
+    elif message_type == binary.MESG:
+        return MESG( *binary.decode_message( body ) )
+    elif message_type == binary.FWRD:
+        return FWRD( *binary.decode_forward( body ) )
+    elif message_type == binary.MCST:
+        return MCST( *binary.decode_multicast_group( body ) )
+    elif message_type == binary.VERS:
+        return VERS( *binary.decode_roster_version( body ) )
+    elif message_type == binary.RLAY:
+        return RLAY()
+    elif message_type == binary.SEQN:
+        return SEQN( *binary.SEQUENCE.unpack( body ) )
+    elif message_type == binary.RSYN:
+        joined, departed = binary.decode_roster_changes( body )
+        return RSYN( [ChatMember( screen_name, ip_address, port, bool( flags & binary.FLAG_BINARY ) )
+            for (screen_name, ip_address, port, flags) in joined], departed )
+
+def parse_datagram( data ):
+    # Datagrams are either one or more binary frames or newline terminated text.
+    if binary.is_binary( data ):
+        messages = [parse_binary_message( message_type, body ) for message_type, body in binary.split_frames( data )]
+        return messages[0] if len( messages ) == 1 else MessageBatch( messages )
+
+    # Decode the bytes into our message and pull everything but the trailing newline.
+    return parse_message( data.decode()[:-1] )
+
 def parse_message( message ):
+    if "\n" in message:
+        return MessageBatch.new( message )
+
     message_type, _, message_data = message.partition( " " )
 
     if message_type == "ACPT":
         return ACPT.new( message_data )
+    elif message_type == "ROST":
+        return ROST.new( message_data )
     elif message_type == "RJCT":
         return RJCT.new( message_data )
     elif message_type == "JOIN":
@@ -56,3 +187,15 @@ def parse_message( message ):
         return EXIT.new( message_data )
     elif message_type == "MESG":
         return MESG.new( message_data )
+    elif message_type == "FWRD":
+        return FWRD.new( message_data )
+    elif message_type == "MCST":
+        return MCST.new( message_data )
+    elif message_type == "VERS":
+        return VERS.new( message_data )
+    elif message_type == "RLAY":
+        return RLAY.new( message_data )
+    elif message_type == "RSYN":
+        return RSYN.new( message_data )
+    elif message_type == "SEQN":
+        return SEQN.new( message_data )
@@ -0,0 +1,325 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import sys
+import threading
+
+# Batched datagram I/O built on top of the Linux sendmmsg and recvmmsg system calls. Python's socket
+# module doesn't expose either, so they are called through ctypes. On platforms without them (or for
+# sockets they can't handle), sending falls back to one sendto per destination through the asyncio
+# transport, and receiving is left to the transport.
+
+# The kernel refuses to process more than UIO_MAXIOV messages in a single sendmmsg call.
+MAX_BATCH_SIZE = 1024
+
+# Number of datagrams read by a single recvmmsg call.
+DEFAULT_RECEIVE_BATCH_SIZE = 64
+
+# Receive buffers hold the largest UDP payload IPv4 can carry, so no datagram is ever truncated.
+MAX_DATAGRAM_SIZE = 65507
+
+MSG_DONTWAIT = getattr( socket, "MSG_DONTWAIT", 0 )
+MSG_TRUNC = getattr( socket, "MSG_TRUNC", 0 )
+
+class _IOVec( ctypes.Structure ):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t)
+    ]
+
+class _MsgHdr( ctypes.Structure ):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.c_void_p),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int)
+    ]
+
+class _MMsgHdr( ctypes.Structure ):
+    _fields_ = [
+        ("msg_hdr", _MsgHdr),
+        ("msg_len", ctypes.c_uint)
+    ]
+
+# Filling in thousands of ctypes structures one attribute at a time is slow, so the mmsghdr array is
+# packed with a struct that mirrors its native layout, including any trailing padding.
+_MMSGHDR_FORMAT = "@PIPNPNiI"
+_MMSGHDR_STRUCT = struct.Struct( _MMSGHDR_FORMAT + f"{ctypes.sizeof( _MMsgHdr ) - struct.calcsize( _MMSGHDR_FORMAT )}x" )
+
+# What the kernel reports back for each datagram received, read straight out of the mmsghdr array.
+_MSG_FLAGS_OFFSET = _MMsgHdr.msg_hdr.offset + _MsgHdr.msg_flags.offset
+_MSG_LEN_OFFSET = _MMsgHdr.msg_len.offset
+_C_INT = struct.Struct( "@i" )
+_C_UINT = struct.Struct( "@I" )
+
+# A sockaddr_in is the address family in host byte order followed by the port and IPv4 address in
+# network byte order, padded out to 16 bytes.
+_SOCKADDR_IN_SIZE = 16
+_AF_INET_BYTES = socket.AF_INET.to_bytes( 2, sys.byteorder )
+
+def _load_libc_function( name, argtypes ):
+    if not sys.platform.startswith( "linux" ):
+        return None
+
+    try:
+        libc = ctypes.CDLL( ctypes.util.find_library( "c" ), use_errno=True )
+        function = getattr( libc, name )
+    except (OSError, AttributeError):
+        return None
+
+    function.argtypes = argtypes
+    function.restype = ctypes.c_int
+    return function
+
+_sendmmsg = _load_libc_function( "sendmmsg", [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int] )
+_recvmmsg = _load_libc_function( "recvmmsg", [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p] )
+
+def encode_sockaddr_in( address ):
+    ip_address, port = address
+    return _AF_INET_BYTES + int( port ).to_bytes( 2, "big" ) + socket.inet_aton( ip_address ) + bytes( 8 )
+
+class BatchSender:
+    # Upper bound on the number of destination addresses whose encoded mmsghdr entries are cached.
+    # Once exceeded, the cache is flushed and rebuilt from the addresses seen afterward.
+    MAX_CACHED_ADDRESSES = 65536
+
+    def __init__( self, transport ):
+        self._transport = transport
+        self._fileno = None
+
+        # Every datagram in a batch points at this one iovec, which is retargeted at the payload on
+        # each send. Because its address never changes, the mmsghdr entry for a given destination is
+        # the same from one send to the next and can be cached along with its sockaddr.
+        self._iov = _IOVec()
+        self._entries = {}
+        self._sockaddrs = {}
+
+        sock = transport.get_extra_info( "socket" )
+        if _sendmmsg and sock is not None and sock.family == socket.AF_INET:
+            self._fileno = sock.fileno()
+
+    @property
+    def batched( self ):
+        return self._fileno is not None
+
+    def send_to_many( self, data, addresses ):
+        # Sends the same datagram to every address in the given list of (ip address, port) tuples.
+        # Returns the number of destinations that were handled through sendmmsg. Anything that could
+        # not be sent that way is passed to the transport, which buffers it if the socket is full.
+        if not addresses:
+            return 0
+
+        # If the transport has datagrams buffered, going around it would reorder our output.
+        if not self.batched or self._transport.get_write_buffer_size():
+            self._send_unbatched( data, addresses )
+            return 0
+
+        try:
+            entries = self._entries
+            headers = b"".join( [entries.get( address ) or self._cache_entry( address ) for address in addresses] )
+        except (OSError, ValueError, OverflowError):
+            # At least one address isn't a dotted IPv4 address, so let the transport resolve them.
+            self._send_unbatched( data, addresses )
+            return 0
+
+        count = len( addresses )
+        payload_buffer = ctypes.create_string_buffer( data, len( data ) )
+        self._iov.iov_base = ctypes.addressof( payload_buffer )
+        self._iov.iov_len = len( data )
+
+        headers_buffer = ctypes.create_string_buffer( headers, len( headers ) )
+        headers_address = ctypes.addressof( headers_buffer )
+        entry_size = _MMSGHDR_STRUCT.size
+        sent = 0
+        while sent < count:
+            result = _sendmmsg( self._fileno,
+                headers_address + sent * entry_size,
+                min( count - sent, MAX_BATCH_SIZE ),
+                MSG_DONTWAIT )
+
+            if result > 0:
+                sent += result
+                continue
+
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            elif error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS) or result == 0:
+                # The socket's send buffer is full. Let the transport queue up the rest.
+                break
+            else:
+                # The datagram at the head of the batch failed on its own (e.g., unreachable host).
+                # Report it the same way the transport would and move on to the rest of the batch.
+                self._transport.get_protocol().error_received( OSError( error, f"sendmmsg to {addresses[sent]} failed" ) )
+                sent += 1
+                continue
+
+        if sent < count:
+            self._send_unbatched( data, addresses[sent:] )
+        return sent
+
+    def _cache_entry( self, address ):
+        if len( self._entries ) >= BatchSender.MAX_CACHED_ADDRESSES:
+            self._entries.clear()
+            self._sockaddrs.clear()
+
+        sockaddr = encode_sockaddr_in( address )
+        sockaddr_buffer = ctypes.create_string_buffer( sockaddr, len( sockaddr ) )
+        entry = _MMSGHDR_STRUCT.pack( ctypes.addressof( sockaddr_buffer ), _SOCKADDR_IN_SIZE,
+            ctypes.addressof( self._iov ), 1, 0, 0, 0, 0 )
+
+        self._sockaddrs[address] = sockaddr_buffer
+        self._entries[address] = entry
+        return entry
+
+    def _send_unbatched( self, data, addresses ):
+        for address in addresses:
+            self._transport.sendto( data, address )
+
+class _ReceiveRing:
+    # The buffers recvmmsg reads a batch of datagrams into: a slot of MAX_DATAGRAM_SIZE bytes per
+    # datagram, the iovec pointing at each slot, room for the sockaddr of each sender, and the mmsghdr
+    # array tying them together. The mmsghdr array is restored from a template before every call,
+    # since the kernel writes the lengths of what it received back into it.
+    def __init__( self, size ):
+        self.size = size
+        self.slots = ctypes.create_string_buffer( size * MAX_DATAGRAM_SIZE )
+        self.sockaddrs = ctypes.create_string_buffer( size * _SOCKADDR_IN_SIZE )
+        self.iovecs = (_IOVec * size)()
+
+        slots_address = ctypes.addressof( self.slots )
+        sockaddrs_address = ctypes.addressof( self.sockaddrs )
+        iovecs_address = ctypes.addressof( self.iovecs )
+        entries = []
+        for index, iov in enumerate( self.iovecs ):
+            iov.iov_base = slots_address + index * MAX_DATAGRAM_SIZE
+            iov.iov_len = MAX_DATAGRAM_SIZE
+            entries.append( _MMSGHDR_STRUCT.pack( sockaddrs_address + index * _SOCKADDR_IN_SIZE, _SOCKADDR_IN_SIZE,
+                iovecs_address + index * ctypes.sizeof( _IOVec ), 1, 0, 0, 0, 0 ) )
+
+        self.template = b"".join( entries )
+        self.headers = ctypes.create_string_buffer( self.template, len( self.template ) )
+
+# Receivers copy every datagram out of the ring before handing a batch on, so all the receivers on a
+# thread can share one ring rather than each holding megabytes of buffers of their own.
+_receive_rings = threading.local()
+
+def _get_receive_ring( size ):
+    rings = _receive_rings.__dict__
+    ring = rings.get( size )
+    if ring is None:
+        ring = rings[size] = _ReceiveRing( size )
+    return ring
+
+class BatchReceiver:
+    # Upper bound on the number of sender addresses whose decoded form is cached. Once exceeded, the
+    # cache is flushed and rebuilt from the addresses seen afterward.
+    MAX_CACHED_ADDRESSES = 65536
+
+    # Batches read in a row before giving the rest of the loop a turn, so that a flood of datagrams
+    # can't starve it.
+    MAX_BATCHES_PER_WAKEUP = 16
+
+    def __init__( self, transport, handler, batch_size=DEFAULT_RECEIVE_BATCH_SIZE ):
+        # Once started, takes over reading from the transport's socket and drains it with recvmmsg, a
+        # batch of datagrams per system call instead of asyncio's one recvfrom per wakeup. The handler
+        # is called with a list of (data, addr) tuples for each batch.
+        self._transport = transport
+        self._handler = handler
+        self._batch_size = batch_size
+        self._fileno = None
+        self._loop = None
+        self._reader_fileno = None
+        self._addresses = {}
+
+        sock = transport.get_extra_info( "socket" )
+        if _recvmmsg and sock is not None and sock.family == socket.AF_INET:
+            self._fileno = sock.fileno()
+
+    @property
+    def batched( self ):
+        return self._fileno is not None
+
+    def start( self, loop ):
+        # Returns whether batched reading started. If it didn't, the transport carries on reading one
+        # datagram at a time. The loop only lets the transport itself watch its socket's descriptor,
+        # so the transport's reading is paused and a duplicate of the descriptor is watched instead.
+        # Datagram transports only support pausing from Python 3.8 (and not on every loop), which
+        # leaves receiving to the transport.
+        if not self.batched or self._reader_fileno is not None:
+            return self._reader_fileno is not None
+        try:
+            self._transport.pause_reading()
+        except NotImplementedError:
+            self._fileno = None
+            return False
+        self._loop = loop
+        self._reader_fileno = os.dup( self._fileno )
+        loop.add_reader( self._reader_fileno, self._read_ready )
+        return True
+
+    def stop( self ):
+        # Must be called once the transport is closed, which doesn't know about our descriptor.
+        if self._reader_fileno is not None:
+            self._loop.remove_reader( self._reader_fileno )
+            os.close( self._reader_fileno )
+            self._reader_fileno = None
+
+    def _read_ready( self ):
+        for _ in range( BatchReceiver.MAX_BATCHES_PER_WAKEUP ):
+            if self._transport.is_closing():
+                self.stop()
+                return
+            datagrams = self._receive()
+            if datagrams:
+                self._handler( datagrams )
+            if len( datagrams ) < self._batch_size:
+                return
+
+    def _receive( self ):
+        ring = _get_receive_ring( self._batch_size )
+        ctypes.memmove( ring.headers, ring.template, len( ring.template ) )
+
+        while True:
+            result = _recvmmsg( self._reader_fileno, ctypes.addressof( ring.headers ), ring.size, MSG_DONTWAIT, None )
+            if result >= 0:
+                break
+
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            elif error not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # Same as the transport, errors such as an ICMP port unreachable for something we sent
+                # earlier go to the protocol.
+                self._transport.get_protocol().error_received( OSError( error, os.strerror( error ) ) )
+            return []
+
+        datagrams = []
+        slots_address = ctypes.addressof( ring.slots )
+        sockaddrs_address = ctypes.addressof( ring.sockaddrs )
+        entry_size = _MMSGHDR_STRUCT.size
+        for index in range( result ):
+            entry_offset = index * entry_size
+            flags, = _C_INT.unpack_from( ring.headers, entry_offset + _MSG_FLAGS_OFFSET )
+            if flags & MSG_TRUNC:
+                continue
+
+            sockaddr = ctypes.string_at( sockaddrs_address + index * _SOCKADDR_IN_SIZE, 8 )
+            address = self._addresses.get( sockaddr ) or self._cache_address( sockaddr )
+            length, = _C_UINT.unpack_from( ring.headers, entry_offset + _MSG_LEN_OFFSET )
+            datagrams.append( (ctypes.string_at( slots_address + index * MAX_DATAGRAM_SIZE, length ), address) )
+        return datagrams
+
+    def _cache_address( self, sockaddr ):
+        if len( self._addresses ) >= BatchReceiver.MAX_CACHED_ADDRESSES:
+            self._addresses.clear()
+
+        address = (socket.inet_ntoa( sockaddr[4:8] ), int.from_bytes( sockaddr[2:4], "big" ))
+        self._addresses[sockaddr] = address
+        return address
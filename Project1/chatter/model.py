@@ -7,11 +7,46 @@ from .util import *
 from PyQt5.QtCore import (Qt, QObject, QAbstractListModel, QModelIndex, QVariant,
     pyqtProperty, pyqtSignal, pyqtSlot, Q_ENUM)
 
+class ChatMemberChanges:
+    # Changes to the member list collected over one UI frame, so that the member list model and the
+    # datagram channel can each apply all of them at once. Any order of joins and leaves comes down to
+    # the members that left or were replaced, followed by the members that joined. A new roster
+    # replaces the whole list before that.
+    def __init__( self ):
+        self.roster = None
+        self.joined = {}
+        self.departed = set()
+
+    def __bool__( self ):
+        return self.roster is not None or bool( self.joined ) or bool( self.departed )
+
+    def reset( self, members ):
+        self.roster = list( members )
+        self.joined.clear()
+        self.departed.clear()
+
+    def join( self, member ):
+        self.joined[member.screen_name] = member
+
+    def leave( self, screen_name ):
+        self.joined.pop( screen_name, None )
+        self.departed.add( screen_name )
+
+    def apply_to( self, members ):
+        # Returns a new member list with these changes applied to the given one.
+        if self.roster is not None:
+            members = self.roster
+        replaced = self.departed.union( self.joined )
+        return [member for member in members if member.screen_name not in replaced] + list( self.joined.values() )
+
 class ChatMemberListModel( QAbstractListModel ):
     def __init__( self, parent=None ):
         super().__init__( parent )
         self._members = []
 
+        # Row of each member by screen name.
+        self._rows = {}
+
     def rowCount( self, parent=QModelIndex() ):
         return len( self._members )
 
@@ -25,35 +60,178 @@ class ChatMemberListModel( QAbstractListModel ):
 
         return QVariant()
 
-    def add_member( self, member ):
-        self.beginInsertRows( QModelIndex(), self.rowCount(), self.rowCount() )
-        if member not in self._members:
-            self._members.append( member )
-        self.endInsertRows()
+    def apply_changes( self, changes ):
+        # Applies a batch of changes as a diff against the rows already there, new rosters included, so
+        # that views keep their place rather than being reset. Members that are gone have their rows
+        # removed, a contiguous run of rows at a time. Members that are still there keep their rows, even
+        # if their address changed, since only screen names are shown. Members that are new are inserted
+        # together at the end.
+        if changes.roster is not None:
+            updated = {member.screen_name: member for member in changes.apply_to( [] )}
+            stale = [screen_name for screen_name in self._rows if screen_name not in updated]
+        else:
+            updated = changes.joined
+            stale = [screen_name for screen_name in changes.departed
+                if screen_name in self._rows and screen_name not in updated]
+
+        if stale:
+            self._remove_rows( sorted( self._rows.pop( screen_name ) for screen_name in stale ) )
+
+        added = []
+        for screen_name, member in updated.items():
+            row = self._rows.get( screen_name )
+            if row is None:
+                added.append( member )
+            else:
+                self._members[row] = member
+
+        if added:
+            first = len( self._members )
+            self.beginInsertRows( QModelIndex(), first, first + len( added ) - 1 )
+            self._members += added
+            for row, member in enumerate( added, first ):
+                self._rows[member.screen_name] = row
+            self.endInsertRows()
+
+    def _remove_rows( self, rows ):
+        # Removes the given rows, which are in ascending order, last run first so the rows of the runs
+        # still to go don't move, and then renumbers the rows that moved up.
+        last = len( rows ) - 1
+        while last >= 0:
+            first = last
+            while first > 0 and rows[first - 1] == rows[first] - 1:
+                first -= 1
+            self.beginRemoveRows( QModelIndex(), rows[first], rows[last] )
+            del self._members[rows[first]:rows[last] + 1]
+            self.endRemoveRows()
+            last = first - 1
 
-    def add_members( self, members ):
-        self.beginInsertRows( QModelIndex(), self.rowCount(), self.rowCount() + len( members ) - 1 )
-        self._members += members
-        self.endInsertRows()
+        for row in range( rows[0], len( self._members ) ):
+            self._rows[self._members[row].screen_name] = row
+
+class ChatHistoryModel( QAbstractListModel ):
+    # The chat transcript as a list of message records, one row each. New records are inserted as rows
+    # at the end, so the view only has to lay out the rows it shows rather than the whole transcript.
+    # Only the most recent max_messages records are kept. Older ones are removed from the front as new
+    # ones arrive, which keeps memory flat over a long session.
+    Info, Error, Message = range( 3 )
 
-    def remove_member_by_name( self, screen_name ):
-        remove_idx = None
-        for (member_idx, member) in enumerate( self._members ):
-            if member.screen_name == screen_name:
-                remove_idx = member_idx
-                break
-
-        if remove_idx is not None:
-            print( f"Removing {screen_name} from index {remove_idx} in main chat member list." )
-            self.beginRemoveRows( QModelIndex(), remove_idx, remove_idx )
-            del self._members[remove_idx]
+    KindRole = Qt.UserRole + 1
+    ScreenNameRole = Qt.UserRole + 2
+    TextRole = Qt.UserRole + 3
+
+    DEFAULT_MAX_MESSAGES = 10000
+
+    def __init__( self, max_messages=DEFAULT_MAX_MESSAGES, parent=None ):
+        super().__init__( parent )
+        self._max_messages = max( max_messages, 1 )
+
+        # Records are (kind, screen name, text), kept in a ring buffer so that any row can be read in
+        # O(1) and trimming the front is O(1) too. The list grows until the history first overflows,
+        # from then on it stays max_messages long and the oldest record sits at the start offset.
+        self._records = []
+        self._start = 0
+        self._count = 0
+
+    def rowCount( self, parent=QModelIndex() ):
+        return self._count
+
+    def roleNames( self ):
+        return {
+            Qt.DisplayRole: b"display",
+            ChatHistoryModel.KindRole: b"kind",
+            ChatHistoryModel.ScreenNameRole: b"screenName",
+            ChatHistoryModel.TextRole: b"text"
+        }
+
+    def data( self, index, role=Qt.DisplayRole ):
+        if not index.isValid() or index.row() >= self._count:
+            return QVariant()
+
+        kind, screen_name, text = self._records[(self._start + index.row()) % len( self._records )]
+        if role == Qt.DisplayRole:
+            return ChatHistoryModel.format_record( kind, screen_name, text )
+        elif role == ChatHistoryModel.KindRole:
+            return kind
+        elif role == ChatHistoryModel.ScreenNameRole:
+            return screen_name
+        elif role == ChatHistoryModel.TextRole:
+            return text
+
+        return QVariant()
+
+    @staticmethod
+    def format_record( kind, screen_name, text ):
+        if kind == ChatHistoryModel.Error:
+            return f"<span style='color: #DC322F'><strong>[ERROR]</strong> {text}</span>"
+        elif kind == ChatHistoryModel.Info:
+            return f"<span style='color: #586E75'><strong>[INFO]</strong> {text}</span>"
+        return f"<span style='color: #268BD2'>[{screen_name}]</span> {text}"
+
+    def extend( self, records ):
+        # Appends a batch of (kind, screen name, text) records as a single insert, after making room
+        # for them with at most a single removal.
+        records = records[-self._max_messages:]
+        if not records:
+            return
+
+        capacity = self._max_messages
+        excess = self._count + len( records ) - capacity
+        if excess > 0:
+            # Removing rows from the front just moves the start offset. The slots they leave behind are
+            # exactly the ones the new records are written to.
+            self.beginRemoveRows( QModelIndex(), 0, excess - 1 )
+            if len( self._records ) < capacity:
+                self._records.extend( [None] * (capacity - len( self._records )) )
+            self._start = (self._start + excess) % capacity
+            self._count -= excess
             self.endRemoveRows()
 
-    def clear( self ):
-        if self.rowCount() > 0:
-            self.beginResetModel()
-            self._members.clear()
-            self.endResetModel()
+        first = self._count
+        self.beginInsertRows( QModelIndex(), first, first + len( records ) - 1 )
+        if len( self._records ) < capacity:
+            # The history hasn't overflowed yet, so the records still start at the front of the list.
+            self._records.extend( records )
+        else:
+            # Write the records from the end of the history around to the front of the list.
+            position = (self._start + self._count) % capacity
+            head = records[:capacity - position]
+            self._records[position:position + len( head )] = head
+            self._records[:len( records ) - len( head )] = records[len( head ):]
+        self._count += len( records )
+        self.endInsertRows()
+
+class FrameMetrics:
+    # Counts the incoming events each UI frame applied, and the frames that were dropped because a
+    # frame finished (or the main loop got around to it) after the next one was already due. A summary
+    # is printed every REPORT_INTERVAL seconds while there are events coming in.
+    REPORT_INTERVAL = 10
+
+    def __init__( self, frame_interval ):
+        self._frame_interval = frame_interval
+        self._report_start = None
+        self._reset()
+
+    def record( self, events, due, finished ):
+        if self._report_start is None:
+            self._report_start = due
+        self.frames += 1
+        self.events += events
+        self.max_events = max( self.max_events, events )
+        self.dropped_frames += int( (finished - due) / self._frame_interval )
+
+        if finished - self._report_start >= FrameMetrics.REPORT_INTERVAL:
+            print( f"UI frames: {self.frames} frames applied {self.events} events "
+                f"({self.events / self.frames:.1f} per frame, at most {self.max_events}), "
+                f"{self.dropped_frames} frames dropped." )
+            self._report_start = None
+            self._reset()
+
+    def _reset( self ):
+        self.frames = 0
+        self.events = 0
+        self.max_events = 0
+        self.dropped_frames = 0
 
 class AppModel( QObject ):
     class ClientStatus:
@@ -65,32 +243,87 @@ class AppModel( QObject ):
     screenNameChanged = pyqtSignal()
     serverAddressChanged = pyqtSignal()
     serverPortChanged = pyqtSignal()
+    roomChanged = pyqtSignal()
     clientStatusChanged = pyqtSignal( ClientStatus, arguments=["clientStatus"] )
-    chatBufferChanged = pyqtSignal()
 
-    def __init__( self, main_loop, datagram_channel_thread, parent=None ):
+    # Incoming messages are applied to the UI at most once per frame.
+    FRAME_INTERVAL = 1 / 60
+
+    def __init__( self, main_loop, datagram_channel_thread, udp_membership=False, binary_protocol=False,
+        relay_chat=False, tree_fanout=0, max_chat_history=ChatHistoryModel.DEFAULT_MAX_MESSAGES, trace_datagrams=False,
+        parent=None ):
         super().__init__( parent )
         self._client_stopped = main_loop.create_future()
         self._main_loop = main_loop
+
+        # The datagram channel runs on its own thread where the main loop can't serve UDP, and on the
+        # main loop everywhere else, in which case there's no thread. Calls from one loop to the other
+        # go through handoffs that run them in batches.
         self._datagram_channel_thread = datagram_channel_thread
+        threaded = datagram_channel_thread is not None
+        self._main_handoff = LoopHandoff( main_loop, threadsafe=threaded )
+        self._datagram_channel_handoff = LoopHandoff( self.datagram_channel_loop, threadsafe=threaded )
         self._screen_name = None
         self._server_address = None
         self._server_port = None
+        self._room = ""
         self._client_status = AppModel.ClientStatus.Disconnected
         self._chat_members = ChatMemberListModel()
-        self._chat_buffer = ""
-        self._server_connection = ServerConnection( self )
-        self._datagram_channel = DatagramChannel( self )
+        self._chat_history = ChatHistoryModel( max_chat_history )
+        self._datagram_channel = DatagramChannel( self, binary_protocol, tree_fanout, trace_datagrams=trace_datagrams )
+        if udp_membership:
+            self._server_connection = DatagramServerConnection( self, binary_protocol )
+        else:
+            self._server_connection = ServerConnection( self, binary_protocol )
         self._exit_acked = None
 
+        # When the server relays chat, each message is sent to it once instead of to every member. We
+        # only know the server relays once it says so with an RLAY, and until then (or if it never
+        # does) chat messages go to every member directly.
+        self._relay_chat = relay_chat
+        self._server_relays_chat = False
+        self._relay_fallback_noted = False
+
+        # The version of the roster our member list holds, which we hand the server when we rejoin so
+        # it can send just what changed since then. A VERS message announces the version of the ACPT
+        # or RSYN behind it, which only becomes ours once that roster has been applied.
+        self._roster_version = None
+        self._pending_roster_version = None
+        self._pending_event_sequence = None
+
+        # Messages from the server and from peers arrive in floods at times. They are queued up and
+        # applied once per frame, and the changes they make to the member list and chat history go out
+        # to the views (and the datagram channel) as one batch per frame.
+        self._incoming = []
+        self._frame_requested = False
+        self._in_frame = False
+        self._last_frame = 0.0
+        self._member_changes = ChatMemberChanges()
+        self._history_records = []
+        self._frame_metrics = FrameMetrics( AppModel.FRAME_INTERVAL )
+
     @property
     def main_loop( self ):
         return self._main_loop
 
     @property
     def datagram_channel_loop( self ):
+        if self._datagram_channel_thread is None:
+            return self._main_loop
         return self._datagram_channel_thread.loop
 
+    @property
+    def main_handoff( self ):
+        return self._main_handoff
+
+    @property
+    def datagram_channel_handoff( self ):
+        return self._datagram_channel_handoff
+
+    @property
+    def datagram_channel( self ):
+        return self._datagram_channel
+
     @pyqtProperty( bool, notify=clientStoppedChanged )
     def clientStopped( self ):
         return self._client_stopped.done()
@@ -130,6 +363,21 @@ class AppModel( QObject ):
         self._server_port = serverPort
         self.serverPortChanged.emit()
 
+    @pyqtProperty( "QString", notify=roomChanged )
+    def room( self ):
+        return self._room
+
+    @room.setter
+    def room( self, room ):
+        room = room or ""
+        if self._room == room:
+            return
+        self._room = room
+
+        # Roster versions are per room, so the one we have is no use for resyncing with another room.
+        self._roster_version = None
+        self.roomChanged.emit()
+
     @pyqtProperty( ClientStatus, notify=clientStatusChanged )
     def clientStatus( self ):
         return self._client_status
@@ -145,25 +393,23 @@ class AppModel( QObject ):
     def chatMembers( self ):
         return self._chat_members
 
-    @pyqtProperty( "QString", notify=chatBufferChanged )
-    def chatBuffer( self ):
-        return self._chat_buffer
+    @pyqtProperty( ChatHistoryModel, constant=True )
+    def chatHistory( self ):
+        return self._chat_history
 
     def write_chat_error( self, error ):
-        error = f"<span style='color: #DC322F'><strong>[ERROR]</strong> {error}</span>"
-        self.write_to_chat_buffer( error )
+        self.write_to_chat_history( ChatHistoryModel.Error, error )
 
     def write_chat_info( self, info ):
-        info = f"<span style='color: #586E75'><strong>[INFO]</strong> {info}</span>"
-        self.write_to_chat_buffer( info )
+        self.write_to_chat_history( ChatHistoryModel.Info, info )
 
     def write_chat_message( self, message, screen_name ):
-        message = f"<span style='color: #268BD2'>[{screen_name}]</span> {message}"
-        self.write_to_chat_buffer( message )
+        self.write_to_chat_history( ChatHistoryModel.Message, message, screen_name )
 
-    def write_to_chat_buffer( self, message ):
-        self._chat_buffer += f"<p style='margin-top: 0; margin-bottom: 1em;'>{message}</p>"
-        self.chatBufferChanged.emit()
+    def write_to_chat_history( self, kind, text, screen_name="" ):
+        self._history_records.append( (kind, screen_name, text) )
+        if not self._in_frame:
+            self._request_frame()
 
     @pyqtSlot()
     def connect_client( self ):
@@ -171,15 +417,19 @@ class AppModel( QObject ):
         screen_name = self.screenName.strip()
         server_address = self.serverAddress.strip()
         server_port = self.serverPort.strip()
+        room = self.room.strip()
 
         # Asynchronously connect our client.
-        create_task( self.connect_client_async( screen_name, server_address, server_port ) )
+        create_task( self.connect_client_async( screen_name, server_address, server_port, room ) )
 
-    async def connect_client_async( self, screen_name, server_address, server_port ):
+    async def connect_client_async( self, screen_name, server_address, server_port, room="" ):
         self.write_chat_info( "Connecting to membership server" )
         self.clientStatus = AppModel.ClientStatus.Connecting
 
         try:
+            # Check the room up front, since the server would only reject it after we've connected.
+            validate_room( room )
+
             # Connect to the membership server over TCP.
             await self._server_connection.connect( screen_name, server_address, server_port )
 
@@ -205,28 +455,37 @@ class AppModel( QObject ):
             # get the port the OS gave us for that channel.
             #
             # All this because quamash's QEventLoop on Windows doesn't support creating UDP
-            # endpoints. :sob:
+            # endpoints. :sob: (Elsewhere the datagram channel loop is the main loop, and this just
+            # takes a detour through the main loop's own queue.)
             #
             # NOTE: The future we await on to know when the datagram channel is fully closed MUST be
             # created on the same thread as the main loop. This is because asyncio.Future objects
             # are NOT thread safe.
             #
             closed_future = self._main_loop.create_future()
-            open_coro = self._datagram_channel.open( local_host, closed_future )
+            open_coro = self._datagram_channel.open( local_host, closed_future, screen_name )
             await asyncio.wrap_future( asyncio.run_coroutine_threadsafe( open_coro, self.datagram_channel_loop ) )
 
             _, local_port, *_ = self._datagram_channel.get_local_address()
             print( f"Datagram channel port: {local_port}" )
 
             # Use the local port info to say hello to the server.
-            self._server_connection.send_hello( screen_name, local_host, local_port )
+            self._server_relays_chat = False
+            self._relay_fallback_noted = False
+            self._pending_roster_version = None
+            self._pending_event_sequence = None
+            # Without a room, the server puts us in its default one.
+            self._server_connection.send_hello( screen_name, local_host, local_port, self._roster_version, room or None )
         except Exception as ex:
             self.write_chat_error( str( ex ) )
             # XXX: Might need to cleanup connections here.
             self.clientStatus = AppModel.ClientStatus.Disconnected
             return
 
-        self.write_chat_info( f"Connected to membership server {server_address}:{server_port}." )
+        if room:
+            self.write_chat_info( f"Connected to membership server {server_address}:{server_port} in room {room}." )
+        else:
+            self.write_chat_info( f"Connected to membership server {server_address}:{server_port}." )
         self.clientStatus = AppModel.ClientStatus.Connected
 
     @pyqtSlot()
@@ -269,8 +528,15 @@ class AppModel( QObject ):
         print( f"Sending message: {message}" )
         self.write_chat_message( message, self._screen_name )
 
-        send_message_coro = self._datagram_channel.send_message( self._screen_name, message )
-        asyncio.run_coroutine_threadsafe( send_message_coro, self.datagram_channel_loop )
+        if self._relay_chat and self._server_relays_chat:
+            self._server_connection.send_chat_message( self._screen_name, message )
+            return
+        elif self._relay_chat and not self._relay_fallback_noted:
+            self._relay_fallback_noted = True
+            self.write_chat_info( "The server doesn't relay chat messages, so they're sent to each member directly." )
+
+        self._datagram_channel_handoff.create_task(
+            self._datagram_channel.send_message( self._screen_name, message ) )
 
     @pyqtSlot()
     def stop_client( self ):
@@ -283,24 +549,117 @@ class AppModel( QObject ):
         self._client_stopped.set_result( None )
         self.clientStoppedChanged.emit()
 
-        print( "Stopping datagram channel loop" )
-        self.datagram_channel_loop.call_soon_threadsafe( self.datagram_channel_loop.stop )
+        if self._datagram_channel_thread is not None:
+            print( "Stopping datagram channel loop" )
+            self.datagram_channel_loop.call_soon_threadsafe( self.datagram_channel_loop.stop )
 
     def handle_message( self, message ):
-        create_task( self.handle_message_async( message ) )
-
-    async def handle_message_async( self, message ):
-        if isinstance( message, ACPT ):
-            self._chat_members.clear()
-            self._chat_members.add_members( message.members )
-
-            # Update the channel members on the datagram channel, which runs on the datagram channel
-            # thread as opposed to the main loop. Do so my scheduling a task on the datagram
-            # channel's event loop.
-            set_members_coro = self._datagram_channel.set_chat_members( message.members )
-            asyncio.run_coroutine_threadsafe( set_members_coro, self.datagram_channel_loop )
+        # Called on the main loop with each message from the server or a peer. The datagram channel
+        # hands its messages over through the main handoff, a batch at a time.
+        self._incoming.append( message )
+        self._request_frame()
+
+    def handle_messages( self, messages ):
+        self._incoming += messages
+        self._request_frame()
+
+    def _request_frame( self ):
+        # A frame starts right away if the last one was long enough ago. Otherwise whatever arrives in
+        # the meantime waits for the next frame and is applied along with it.
+        if self._frame_requested:
+            return
+        self._frame_requested = True
+        due = max( self._last_frame + AppModel.FRAME_INTERVAL, self._main_loop.time() )
+        self._main_loop.call_at( due, self._run_frame, due )
+
+    def _run_frame( self, due ):
+        incoming, self._incoming = self._incoming, []
+        self._frame_requested = False
+
+        self._in_frame = True
+        try:
+            for message in incoming:
+                # A message that can't be applied is reported and skipped, rather than taking the rest
+                # of the frame down with it.
+                try:
+                    self._apply_message( message )
+                except Exception as ex:
+                    self._main_loop.call_exception_handler( {
+                        "message": f"Exception applying message {message!r}",
+                        "exception": ex
+                    } )
+            self._apply_member_changes()
+            if self._history_records:
+                self._chat_history.extend( self._history_records )
+                self._history_records = []
+        finally:
+            self._in_frame = False
+
+        self._last_frame = self._main_loop.time()
+        self._frame_metrics.record( len( incoming ), due, self._last_frame )
+
+    def _apply_member_changes( self ):
+        changes = self._member_changes
+        if not changes:
+            return
+        self._member_changes = ChatMemberChanges()
+        self._chat_members.apply_changes( changes )
+
+        # The datagram channel keeps its own copy of the member list on the datagram channel loop,
+        # which is brought up to date in one go as well.
+        if changes.roster is not None:
+            update_coro = self._datagram_channel.set_chat_members( changes.apply_to( [] ) )
+        else:
+            update_coro = self._datagram_channel.apply_roster_changes( list( changes.joined.values() ),
+                list( changes.departed ) )
+        self._datagram_channel_handoff.create_task( update_coro )
+
+    def _apply_message( self, message ):
+        if isinstance( message, MessageBatch ):
+            for batched_message in message.messages:
+                self._apply_message( batched_message )
+        elif isinstance( message, MCST ):
+            # The server multicasts membership events, and chat messages go to the same group. Join
+            # it on the datagram channel loop.
+            self._datagram_channel_handoff.create_task(
+                self._datagram_channel.join_multicast_group( message.group, message.port ) )
+        elif isinstance( message, RLAY ):
+            self._server_relays_chat = True
+        elif isinstance( message, VERS ):
+            self._pending_roster_version = message.roster_version
+            self._pending_event_sequence = message.event_sequence
+        elif isinstance( message, RSYN ):
+            # Our member list is still the roster from before we rejoined, so just apply what changed
+            # since then. A joined member replaces any stale entry under the same screen name.
+            self._roster_version = self._pending_roster_version
+            self._start_event_sequence()
+            for screen_name in message.departed:
+                self._member_changes.leave( screen_name )
+            for member in message.joined:
+                self._member_changes.join( member )
+        elif isinstance( message, SEQN ):
+            self._datagram_channel_handoff.create_task(
+                self._datagram_channel.update_event_sequence( message.sequence ) )
+        elif isinstance( message, ROST ):
+            # More of the roster we were just accepted with. Unlike a JOIN, these members aren't new
+            # to the chat, so they're added quietly.
+            for member in message.members:
+                self._member_changes.join( member )
+        elif isinstance( message, ACPT ):
+            self._roster_version = self._pending_roster_version
+            self._start_event_sequence()
+            self._member_changes.reset( message.members )
         elif isinstance( message, RJCT ):
-            self.write_chat_error( f"Cannot connect to server. Screen name {self._screen_name} in use." )
+            if message.reason is None:
+                self.write_chat_error( f"Cannot connect to server. Screen name {self._screen_name} in use." )
+            elif message.reason == "BUSY":
+                self.write_chat_error( "Cannot connect to server. Server is too busy accepting other members. Try again later." )
+            elif message.reason == "RATE":
+                self.write_chat_error( "Cannot connect to server. Too many connection attempts from this address. Try again later." )
+            elif message.reason == "ROOM":
+                self.write_chat_error( "Cannot connect to server. Room names cannot have spaces." )
+            else:
+                self.write_chat_error( f"Cannot connect to server. Server rejected us ({message.reason})." )
             # NOTE: On a RJCT, we do NOT send EXIT because the server will NOT send an
             # acknowledgement back. If we were to await an acknowledgement during our disconnection
             # logic, our client would wait indefinitely.
@@ -309,20 +668,25 @@ class AppModel( QObject ):
             self.write_chat_info( f"{message.member.screen_name} has entered the chat." )
             # Don't add the member if that member is our client.
             if message.member.screen_name != self._screen_name:
-                self._chat_members.add_member( message.member )
-
-                # Also add the member to the datagram channel's list of members to send messages to.
-                add_member_coro = self._datagram_channel.add_chat_member( message.member )
-                asyncio.run_coroutine_threadsafe( add_member_coro, self.datagram_channel_loop )
+                self._member_changes.join( message.member )
         elif isinstance( message, EXIT ):
             self.write_chat_info( f"{message.screen_name} has left the building!" )
             if message.screen_name == self._screen_name:
-                self._exit_acked.set_result( None )
+                # The acknowledgement may come more than once, or when we never asked to leave, as when
+                # the server evicts us or gives up on us.
+                if self._exit_acked is not None and not self._exit_acked.done():
+                    self._exit_acked.set_result( None )
             else:
-                self._chat_members.remove_member_by_name( message.screen_name )
-
-                # Also remove the member from the datagram channel's list of members.
-                remove_member_coro = self._datagram_channel.remove_chat_member_by_name( message.screen_name )
-                asyncio.run_coroutine_threadsafe( remove_member_coro, self.datagram_channel_loop )
+                self._member_changes.leave( message.screen_name )
         elif isinstance( message, MESG ):
-            self.write_chat_message( message.message, message.screen_name )
+            # In multicast mode our own messages come back to us, whether we sent them to the group or
+            # the server relayed them there, but they were already written to the chat history when
+            # they were sent.
+            if message.screen_name != self._screen_name:
+                self.write_chat_message( message.message, message.screen_name )
+
+    def _start_event_sequence( self ):
+        # Membership events held back until now are the ones that came after the roster we just
+        # applied, and can now be delivered in order.
+        self._datagram_channel_handoff.create_task(
+            self._datagram_channel.start_event_sequence( self._pending_event_sequence ) )
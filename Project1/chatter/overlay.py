@@ -0,0 +1,86 @@
+import collections
+import random
+
+# Number of members each member passes a chat message on to when spreading it down the tree overlay.
+DEFAULT_TREE_FANOUT = 4
+
+class TreeOverlay:
+    # Spreads chat messages peer to peer down a k-ary tree, so that nobody has to send a message to every
+    # member of the room themselves. Every member orders the room by screen name, which lets all of them
+    # work out the same tree from the same roster without talking to each other. The tree for a message
+    # is rooted at its sender: counting positions around the ordered roster starting from the sender at
+    # position 0, the member at position p passes the message on to the members at positions k*p+1
+    # through k*p+k. The sender sends at most k datagrams, every other member forwards at most k, and a
+    # message reaches everybody in about log_k(N) hops.
+    #
+    # Each message carries its sender's screen name and an id the sender picked, and members drop copies
+    # they have already seen. Members only disagree about the tree while a join or leave is still on its
+    # way to some of them, which can briefly cause duplicates (which are dropped) or missed members
+    # (which aren't made up for, same as a lost datagram sent straight to a peer).
+    HISTORY_SIZE = 4096
+
+    def __init__( self, fanout=DEFAULT_TREE_FANOUT ):
+        self.fanout = fanout
+        self._screen_name = None
+        self._members = []
+
+        # The room ordered by screen name, as (screen name, member) pairs, along with each screen
+        # name's position. Rebuilt the next time it's needed after the roster changes.
+        self._ring = None
+        self._positions = None
+
+        # Message ids start somewhere random, so that a member that restarts doesn't reuse ids its
+        # peers still remember from before.
+        self._next_message_id = random.getrandbits( 48 )
+        self._seen = set()
+        self._seen_order = collections.deque()
+
+    def reset( self, screen_name ):
+        self._screen_name = screen_name
+        self._ring = None
+        self._seen.clear()
+        self._seen_order.clear()
+
+    def update_members( self, members ):
+        # Called with the member list whenever it changes.
+        self._members = members
+        self._ring = None
+
+    def new_message_id( self ):
+        message_id = self._next_message_id
+        self._next_message_id = (self._next_message_id + 1) % (1 << 64)
+        self.seen( self._screen_name, message_id )
+        return message_id
+
+    def seen( self, screen_name, message_id ):
+        # Returns whether the message was seen before, and remembers it if it wasn't.
+        key = (screen_name, message_id)
+        if key in self._seen:
+            return True
+
+        self._seen.add( key )
+        self._seen_order.append( key )
+        if len( self._seen_order ) > TreeOverlay.HISTORY_SIZE:
+            self._seen.discard( self._seen_order.popleft() )
+        return False
+
+    def children( self, sender ):
+        # The members we pass a message from the given sender on to.
+        if self._ring is None:
+            self._build_ring()
+
+        sender_position = self._positions.get( sender )
+        if sender_position is None:
+            # We don't know the sender yet, so we can't tell where we are in its tree.
+            return []
+
+        ring_size = len( self._ring )
+        first = ((self._positions[self._screen_name] - sender_position) % ring_size) * self.fanout + 1
+        return [self._ring[(sender_position + position) % ring_size][1]
+            for position in range( first, min( first + self.fanout, ring_size ) )]
+
+    def _build_ring( self ):
+        members = {member.screen_name: member for member in self._members}
+        members.setdefault( self._screen_name, None )
+        self._ring = sorted( members.items(), key=lambda entry: entry[0] )
+        self._positions = {screen_name: position for position, (screen_name, _) in enumerate( self._ring )}
@@ -2,15 +2,47 @@ import asyncio
 import socket
 import weakref
 
+from . import binary
+from .framing import *
 from .message import *
+from .mmsg import BatchReceiver
+from .overlay import TreeOverlay
 from .util import *
 
-class ServerConnection( asyncio.Protocol ):
-    def __init__( self, app_model ):
+def encode_hello( screen_name, local_ip, local_port, roster_version=None, binary_protocol=False, room=None ):
+    # A rejoining client passes along the version of the roster it still has, so the server can send
+    # just the changes since then. Without a room, the server puts us in its default room. The text
+    # HELO ends in SEQN to ask for sequenced membership events, which binary clients always get.
+    if binary_protocol:
+        return binary.encode_hello( screen_name, local_ip, local_port, roster_version, room )
+
+    hello = f"HELO {screen_name} {local_ip} {local_port}"
+    if room:
+        hello += f" {room}"
+    if roster_version:
+        hello += f" {roster_version[0]} {roster_version[1]}"
+    return f"{hello} SEQN\n".encode()
+
+def encode_chat_message( screen_name, message, binary_protocol=False ):
+    if binary_protocol:
+        return binary.encode_message( screen_name, message )
+    return f"MESG {screen_name}: {message}\n".encode()
+
+class ServerConnection( LineProtocol ):
+    # ACPT messages carry the entire roster, so allow for fairly large frames from the server.
+    MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+    # Seconds between PING heartbeats, which keep a server with an idle timeout from evicting us.
+    HEARTBEAT_INTERVAL = 15
+
+    def __init__( self, app_model, binary_protocol=False ):
+        # Whether or not we asked for it, a binary answer from the server switches how we read it.
+        super().__init__( max_frame_size=ServerConnection.MAX_FRAME_SIZE, allow_binary_frames=True )
         self._app_model = weakref.proxy( app_model )
+        self._binary_protocol = binary_protocol
         self._transport = None
         self._transport_closed = None
-        self._message_chunks = []
+        self._heartbeat = None
 
     async def connect( self, screen_name, server_address, server_port ):
         validate_screen_name( screen_name )
@@ -32,89 +64,430 @@ class ServerConnection( asyncio.Protocol ):
             raise RuntimeError( "Cannot get local address used for server connection. Not connected to server." )
         return self._transport.get_extra_info( "sockname" )
 
-    def send_hello( self, screen_name, local_ip, local_port ):
-        self._send_server_message( f"HELO {screen_name} {local_ip} {local_port}\n" )
+    def send_hello( self, screen_name, local_ip, local_port, roster_version=None, room=None ):
+        self._send_server_data( encode_hello( screen_name, local_ip, local_port, roster_version, self._binary_protocol, room ) )
 
     def send_exit( self ):
-        self._send_server_message( "EXIT\n" )
+        if self._binary_protocol:
+            self._send_server_data( binary.encode_frame( binary.EXIT ) )
+        else:
+            self._send_server_message( "EXIT\n" )
+
+    def send_chat_message( self, screen_name, message ):
+        # Hands a chat message to a server relaying chat, which sends it on to the rest of our room.
+        self._send_server_data( encode_chat_message( screen_name, message, self._binary_protocol ) )
+
+    def connection_made( self, transport ):
+        self._schedule_heartbeat()
 
     def connection_lost( self, ex ):
         print( "Disconnected from server." )
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            self._heartbeat = None
         self._transport_closed.set_result( None )
         self._transport = None
         self._transport_closed = None
 
-    def data_received( self, data ):
-        print( f"TCP data received: {data}" )
-        for message in self._feed_data( data ):
-            print( f"New message: {message}")
-            self._app_model.handle_message( parse_message( message ) )
+    def message_received( self, message ):
+        print( f"New message: {message}")
+        self._app_model.handle_message( parse_message( message ) )
+
+    def binary_frame_received( self, message_type, body ):
+        print( f"New binary {binary.MESSAGE_TYPES.get( message_type, message_type )} message." )
+        self._app_model.handle_message( parse_binary_message( message_type, body ) )
+
+    def frame_too_large( self ):
+        print( f"Server sent a message larger than {ServerConnection.MAX_FRAME_SIZE} bytes. Disconnecting." )
+        self.disconnect()
 
     def eof_received( self ):
         print( f"EOF received." )
 
     def _send_server_message( self, message ):
+        self._send_server_data( message.encode() )
+
+    def _send_server_data( self, data ):
         if self._transport:
-            self._transport.write( message.encode() )
-
-    def _feed_data( self, data ):
-        # We keep feeding chunks until one contains at least one newline character. The presence of
-        # a newline indicates that at least one complete message has arrived. In this case, we want
-        # to find the last newline in the current chunk and preserve everything after it as the
-        # start of the next message that has yet to be completed.
-        #
-        # For everything before the last newline, this gets concatenated with the other message
-        # chunks previously stored. The concatenated string is then split across newline boundaries
-        # (since it may be the rare case there are mutliple messages buffered up), and each portion
-        # corresponds to a protocol message that needs parsing.
-        #
-        chunk = data.decode()
-        left_chunk, newline, right_chunk = chunk.rpartition( "\n" )
-
-        if newline:
-            # There was a newline in the latest chunk. The one we partitioned on is either at the
-            # beginning of our chunk (in which case left_chunk is empty), it's at the end of our
-            # chunk (in which case right_chunk is empty), or it's somewhere in the middle.
-
-            if left_chunk:
-                # There is content prior to the newline we partitioned on. The preceding content
-                # needs to be appened to the list of chunks that will be concatenated and parsed.
-                self._message_chunks.append( left_chunk )
-
-            # Concatenate all of our message chunks into one large string. Split the string on
-            # message boundaries (newlines) and yield each message found.
-            for message in "".join( self._message_chunks ).split( "\n" ):
-                yield message
-
-            # Discard the chunks we've exhausted in terms of messages that can be parsed.
-            self._message_chunks = []
-
-            if right_chunk:
-                # There is content following the newline we partitioned on. This content forms the
-                # first chunk save in the new set of message chunks.
-                self._message_chunks.append( right_chunk )
+            self._transport.write( data )
+
+    def _schedule_heartbeat( self ):
+        self._heartbeat = self._app_model.main_loop.call_later( ServerConnection.HEARTBEAT_INTERVAL, self._send_heartbeat )
+
+    def _send_heartbeat( self ):
+        if self._binary_protocol:
+            self._send_server_data( binary.encode_frame( binary.PING ) )
+        else:
+            self._send_server_message( "PING\n" )
+        self._schedule_heartbeat()
+
+class DatagramServerConnection:
+    # Stands in for ServerConnection when joining the membership server over UDP (its --udp-membership
+    # mode). There is no connection to hold open: HELO, EXIT, and PING refreshes are sent from our
+    # datagram channel to the server's welcome port, and the server answers on the same channel.
+    # Because datagrams can be lost, HELO and EXIT are resent until the server answers them, and the
+    # membership is refreshed often enough that a lost PING or two doesn't let it expire.
+    HELLO_RETRY_INTERVAL = 1
+    EXIT_RETRY_INTERVAL = 1
+    EXIT_RETRIES = 5
+    REFRESH_INTERVAL = 10
+
+    # Ask for a receive buffer big enough to absorb the burst of ROST datagrams a large roster arrives
+    # in. The kernel caps this at its own configured maximum.
+    RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+    def __init__( self, app_model, binary_protocol=False ):
+        self._app_model = weakref.proxy( app_model )
+        self._binary_protocol = binary_protocol
+        self._server_address = None
+        self._screen_name = None
+        self._hello = None
+        self._answered = False
+        self._timer = None
+
+    @property
+    def server_address( self ):
+        return self._server_address
+
+    async def connect( self, screen_name, server_address, server_port ):
+        validate_screen_name( screen_name )
+        validate_port( server_port )
+        addresses = await self._app_model.main_loop.getaddrinfo( server_address, server_port,
+            family=socket.AF_INET, type=socket.SOCK_DGRAM )
+        self._server_address = addresses[0][4]
+        self._screen_name = screen_name
+
+    def disconnect( self ):
+        self._cancel_timer()
+        if self._server_address:
+            print( "Leaving membership server." )
+            self._server_address = None
+            self._app_model.datagram_channel_handoff.create_task(
+                self._app_model.datagram_channel.detach_server_connection() )
+
+    def get_local_address( self ):
+        if not self._server_address:
+            raise RuntimeError( "Cannot get local address used for server connection. Not connected to server." )
+
+        # Connecting a UDP socket doesn't send anything, but it does make the OS pick the local
+        # address that routes to the server.
+        with socket.socket( socket.AF_INET, socket.SOCK_DGRAM ) as sock:
+            sock.connect( self._server_address )
+            return sock.getsockname()
+
+    def send_hello( self, screen_name, local_ip, local_port, roster_version=None, room=None ):
+        self._hello = encode_hello( screen_name, local_ip, local_port, roster_version, self._binary_protocol, room )
+        self._answered = False
+        self._app_model.datagram_channel_handoff.create_task(
+            self._app_model.datagram_channel.attach_server_connection( self ) )
+        self._send_hello()
+
+    def send_exit( self, retries=EXIT_RETRIES ):
+        self._cancel_timer()
+        if retries == 0:
+            # The server never acknowledged us. It will expire our membership on its own, so carry on
+            # as if it had.
+            print( "EXIT was never acknowledged. Giving up." )
+            self._app_model.handle_message( EXIT( self._screen_name ) )
+            return
+
+        self._send( binary.encode_frame( binary.EXIT ) if self._binary_protocol else b"EXIT\n" )
+        self._timer = self._app_model.main_loop.call_later( DatagramServerConnection.EXIT_RETRY_INTERVAL,
+            self.send_exit, retries - 1 )
+
+    def send_chat_message( self, screen_name, message ):
+        # Unlike HELO and EXIT, a lost chat message isn't resent, same as one sent straight to a peer.
+        self._send( encode_chat_message( screen_name, message, self._binary_protocol ) )
+
+    def datagram_received( self, message ):
+        # Called with each message the server sends our datagram channel, after membership events
+        # have been put in order.
+        if isinstance( message, MessageBatch ):
+            if any( isinstance( event, EXIT ) and event.screen_name == self._screen_name for event in message.messages ):
+                self._cancel_timer()
+        elif isinstance( message, (ACPT, RSYN, RJCT) ) and not isinstance( message, ROST ):
+            # Answers to HELOs we resent before the first answer arrived are just repeats.
+            if self._answered:
+                return
+            self._answered = True
+            self._cancel_timer()
+            if not isinstance( message, RJCT ):
+                self._schedule_refresh()
+        elif isinstance( message, EXIT ) and message.screen_name == self._screen_name:
+            self._cancel_timer()
+
+        self._app_model.handle_message( message )
+
+    def _send_hello( self ):
+        if not self._answered:
+            print( "Sending HELO to server." )
+            self._send( self._hello )
+            self._timer = self._app_model.main_loop.call_later( DatagramServerConnection.HELLO_RETRY_INTERVAL,
+                self._send_hello )
+
+    def _schedule_refresh( self ):
+        self._timer = self._app_model.main_loop.call_later( DatagramServerConnection.REFRESH_INTERVAL, self._refresh )
+
+    def _refresh( self ):
+        self._send( binary.encode_frame( binary.PING ) if self._binary_protocol else b"PING\n" )
+        self._schedule_refresh()
+
+    def _send( self, data ):
+        if self._server_address:
+            self._app_model.datagram_channel_handoff.create_task(
+                self._app_model.datagram_channel.send_to( data, self._server_address ) )
+
+    def _cancel_timer( self ):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+class MulticastListener( asyncio.DatagramProtocol ):
+    # Receives datagrams sent to the multicast group the membership server told us about and hands
+    # them to the datagram channel as if they had arrived on its own socket.
+    def __init__( self, datagram_channel ):
+        self._datagram_channel = weakref.proxy( datagram_channel )
+
+    def datagram_received( self, data, addr ):
+        self._datagram_channel.datagram_received( data, addr )
+
+class EventSequencer:
+    # Delivers the membership events the server numbers in order, so a lost JOIN or EXIT can't leave
+    # our member lists out of step with the server's. Events arriving after a gap are held back while
+    # just the missing ones are asked for again with a NACK. If they still haven't turned up after a
+    # few tries, the server has most likely forgotten them, so we give up on them and carry on.
+    #
+    # A gap only shows once a later event arrives. So that losing the last events of a burst doesn't
+    # go unnoticed, the server answers our heartbeats with the number its next event will get (a SEQN
+    # with no events behind it).
+    #
+    # The server tells us the sequence number our events start after in the VERS ahead of our roster.
+    # Events that arrive before we've applied that roster are held until then.
+    REPAIR_TIMEOUT = 0.25
+    REPAIR_RETRIES = 5
+    MAX_HELD_EVENTS = 4096
+
+    def __init__( self, deliver, request_repair, loop ):
+        self._deliver = deliver
+        self._request_repair = request_repair
+        self._loop = loop
+        self._started = False
+        self._next_sequence = None
+        self._held = {}
+
+        # One past the highest sequence number known to have been sent, and where the server sends
+        # its events from, which is where repair requests go.
+        self._horizon = 0
+        self._source = None
+
+        self._repair_timer = None
+        self._repair_retries = 0
+        self._repair_from = None
+
+    def start( self, last_sequence ):
+        # Without a sequence number to start after (say, the VERS was lost), pick up with the earliest
+        # event we have.
+        self._started = True
+        if last_sequence is not None:
+            self._next_sequence = last_sequence + 1
+            for sequence in [sequence for sequence in self._held if sequence <= last_sequence]:
+                del self._held[sequence]
+        elif self._held:
+            self._next_sequence = min( self._held )
+        self._deliver_ready()
+
+    def stop( self ):
+        self._cancel_repair()
+        self._held.clear()
+        self._started = False
+        self._next_sequence = None
+        self._horizon = 0
+
+    def receive( self, sequence, events, source=None ):
+        if source:
+            self._source = source
+        self._horizon = max( self._horizon, sequence + len( events ) )
+        for offset, event in enumerate( events ):
+            if self._next_sequence is None or sequence + offset >= self._next_sequence:
+                self._held.setdefault( sequence + offset, (event, self._source) )
+
+        if not self._started:
+            while len( self._held ) > EventSequencer.MAX_HELD_EVENTS:
+                del self._held[min( self._held )]
+            return
+
+        if self._next_sequence is None:
+            self._next_sequence = sequence
+        elif len( self._held ) > EventSequencer.MAX_HELD_EVENTS:
+            print( f"Too many membership events held back. Giving up on events {self._next_sequence} through {min( self._held ) - 1}." )
+            self._next_sequence = min( self._held )
+        self._deliver_ready()
+
+    def _deliver_ready( self ):
+        ready = []
+        while self._next_sequence in self._held:
+            ready.append( self._held.pop( self._next_sequence ) )
+            self._next_sequence += 1
+        if ready:
+            self._deliver( [event for event, _ in ready], ready[0][1] )
+
+        # Ask for the next gap as soon as the last one is filled rather than when the repair times out.
+        if not self._missing():
+            self._cancel_repair()
+        elif not self._repair_timer or self._next_sequence != self._repair_from:
+            self._cancel_repair()
+            self._repair_retries = 0
+            self._send_repair_request()
+
+    def _missing( self ):
+        # Returns the first and last sequence numbers of the gap we're waiting on, if any.
+        if self._next_sequence is None:
+            return None
+        elif self._held:
+            return self._next_sequence, min( self._held ) - 1
+        elif self._next_sequence < self._horizon:
+            return self._next_sequence, self._horizon - 1
+        return None
+
+    def _send_repair_request( self ):
+        first, last = self._missing()
+        self._repair_from = first
+        print( f"Missed membership events {first} through {last}. Asking for them again." )
+        if self._source:
+            self._request_repair( first, last, self._source )
+        self._repair_timer = self._loop.call_later( EventSequencer.REPAIR_TIMEOUT, self._repair_timed_out )
+
+    def _repair_timed_out( self ):
+        self._repair_timer = None
+        missing = self._missing()
+        if not missing:
+            return
+
+        self._repair_retries += 1
+        if self._repair_retries >= EventSequencer.REPAIR_RETRIES:
+            print( f"Giving up on membership events {missing[0]} through {missing[1]}." )
+            self._next_sequence = missing[1] + 1
+            self._deliver_ready()
         else:
-            # There was no newline in the current chunk. Add it to our list of message chunks.
-            self._message_chunks.append( chunk )
+            self._send_repair_request()
+
+    def _cancel_repair( self ):
+        if self._repair_timer:
+            self._repair_timer.cancel()
+            self._repair_timer = None
 
 class DatagramChannel( asyncio.DatagramProtocol ):
-    def __init__( self, app_model ):
+    def __init__( self, app_model, binary_protocol=False, tree_fanout=0, batch_receive=True, trace_datagrams=False ):
         self._app_model = weakref.proxy( app_model )
+        self._binary_protocol = binary_protocol
         self._transport = None
         self._transport_closed = None
         self._chat_members = []
+        self._local_host = None
+        self._multicast_group = None
+        self._multicast_transport = None
+
+        # Drains the socket a batch of datagrams at a time where recvmmsg is available. The messages
+        # from a batch that are meant for the app model are collected and handed over together.
+        self._batch_receive = batch_receive
+        self._receiver = None
+        self._dispatched = None
+
+        # Printing every datagram that arrives is handy for debugging but costs far more than handling
+        # it, so it's only done when asked for.
+        self._trace_datagrams = trace_datagrams
+
+        # Set when membership is kept with the server over this channel instead of over TCP.
+        self._server_connection = None
+        self._server_address = None
+
+        # Puts the server's membership events in order while the channel is open.
+        self._event_sequencer = None
+
+        # With a tree fanout, chat messages spread peer to peer down a tree of members rather than
+        # being sent to every member by their sender.
+        self._overlay = TreeOverlay( tree_fanout ) if tree_fanout else None
 
-    async def open( self, local_host, closed_future ):
+    async def open( self, local_host, closed_future, screen_name=None ):
         self._transport_closed = closed_future
+        self._local_host = local_host
+        if self._overlay:
+            self._overlay.reset( screen_name )
+        self._event_sequencer = EventSequencer( self._deliver_events, self._request_repair,
+            self._app_model.datagram_channel_loop )
         self._transport, _ = await self._app_model.datagram_channel_loop.create_datagram_endpoint( lambda: self,
             (local_host, None) )
+        if self._batch_receive:
+            self._receiver = BatchReceiver( self._transport, self.datagrams_received )
+            self._receiver.start( self._app_model.datagram_channel_loop )
 
     async def close( self ):
+        if self._event_sequencer:
+            self._event_sequencer.stop()
+            self._event_sequencer = None
+
+        if self._multicast_transport:
+            self._multicast_transport.close()
+            self._multicast_transport = None
+            self._multicast_group = None
+
         if self._transport:
             print( "Closing datagram channel." )
             self._transport.close()
             return self._transport_closed
 
+    async def join_multicast_group( self, group, port ):
+        if self._multicast_group == (group, port) or not self._transport:
+            return
+
+        print( f"Joining multicast group {group}:{port}." )
+
+        # Every client on this host listens on the same group port, so the port has to be shareable.
+        # Membership is added on the interface we use to reach the server, which is also the one our
+        # own multicast traffic goes out on.
+        sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        if hasattr( socket, "SO_REUSEPORT" ):
+            sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEPORT, 1 )
+        sock.bind( ("", port) )
+        sock.setsockopt( socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+            socket.inet_aton( group ) + socket.inet_aton( self._local_host ) )
+
+        self._multicast_transport, _ = await self._app_model.datagram_channel_loop.create_datagram_endpoint(
+            lambda: MulticastListener( self ), sock=sock )
+
+        unicast_sock = self._transport.get_extra_info( "socket" )
+        unicast_sock.setsockopt( socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton( self._local_host ) )
+        unicast_sock.setsockopt( socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1 )
+        self._multicast_group = (group, port)
+
+    async def attach_server_connection( self, server_connection ):
+        # From now on, datagrams from the server go to the server connection rather than straight to
+        # the app model.
+        self._server_connection = server_connection
+        self._server_address = server_connection.server_address
+        if self._transport:
+            sock = self._transport.get_extra_info( "socket" )
+            sock.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, DatagramServerConnection.RECEIVE_BUFFER_SIZE )
+
+    async def start_event_sequence( self, last_sequence ):
+        if self._event_sequencer:
+            self._event_sequencer.start( last_sequence )
+
+    async def update_event_sequence( self, next_sequence ):
+        # The server's answer to a heartbeat sent over TCP, which says what number its next membership
+        # event will get.
+        if self._event_sequencer:
+            self._event_sequencer.receive( next_sequence, [] )
+
+    async def detach_server_connection( self ):
+        self._server_connection = None
+        self._server_address = None
+
+    async def send_to( self, data, address ):
+        if self._transport:
+            self._transport.sendto( data, address )
+
     def get_local_address( self ):
         if not self._transport:
             raise RuntimeError( "Cannot get local address used for datagram channel. datagram channel not open." )
@@ -123,13 +496,20 @@ class DatagramChannel( asyncio.DatagramProtocol ):
     async def set_chat_members( self, members ):
         print( "Resetting datagram member list" )
         self._chat_members = members
+        self._members_changed()
 
     async def add_chat_member( self, member ):
         print( f"{self._chat_members}")
         if member not in self._chat_members:
             self._chat_members.append( member )
+            self._members_changed()
             print( f"Adding member {member.screen_name} to datagram member list" )
 
+    async def add_chat_members( self, members ):
+        print( f"Adding {len( members )} members to datagram member list" )
+        self._chat_members += members
+        self._members_changed()
+
     async def remove_chat_member_by_name( self, screen_name ):
         remove_idx = None
         for (member_idx, member) in enumerate( self._chat_members ):
@@ -140,27 +520,120 @@ class DatagramChannel( asyncio.DatagramProtocol ):
         if remove_idx is not None:
             print( f"Removing {screen_name} from index {remove_idx} in datagram member list." )
             del self._chat_members[remove_idx]
+            self._members_changed()
+
+    async def apply_roster_changes( self, joined, departed ):
+        print( f"Applying {len( joined )} joins and {len( departed )} departures to datagram member list" )
+        changed = set( departed ) | {member.screen_name for member in joined}
+        self._chat_members = [member for member in self._chat_members if member.screen_name not in changed] + joined
+        self._members_changed()
 
     async def send_message( self, screen_name, message ):
-        data = f"MESG {screen_name}: {message}\n".encode()
+        data = encode_chat_message( screen_name, message )
+        if self._multicast_group:
+            # One datagram reaches everybody. We'll hear our own message too, which the app model
+            # knows to ignore.
+            print( f"Sending '{message}' to multicast group {self._multicast_group}." )
+            if self._transport:
+                self._transport.sendto( data, self._multicast_group )
+            return
+
+        if self._overlay:
+            # We're the root of our own message's tree, so we only send it to our children in it.
+            message_id = self._overlay.new_message_id()
+            print( f"Sending '{message}' down the tree overlay as message {message_id}." )
+            self._send_forward( screen_name, message_id, message, self._overlay.children( screen_name ) )
+            return
+
+        # Members known to speak binary get the more compact binary encoding.
+        binary_data = encode_chat_message( screen_name, message, binary_protocol=True )
         for member in self._chat_members:
             if member.screen_name != screen_name:
                 print( f"Sending '{message}' to {member.screen_name}:{member.address}:{member.port}." )
-                self._send_datagram( data, member )
+                self._send_datagram( binary_data if member.binary else data, member )
 
     def connection_lost( self, ex ):
         print( "Closed datagram channel." )
+        if self._receiver:
+            self._receiver.stop()
+            self._receiver = None
         future_loop = self._transport_closed.get_loop()
         future_loop.call_soon_threadsafe( self._transport_closed.set_result, None )
         self._transport = None
         self._transport_closed = None
 
     def datagram_received( self, data, addr ):
-        print( f"UDP data received from {addr}: {data}" )
-        # Decode the bytes into our message and pull everything but the trailing newline.
-        message = data.decode()[:-1]
-        handle_message_coro = self._app_model.handle_message_async( parse_message( message ) )
-        asyncio.run_coroutine_threadsafe( handle_message_coro, self._app_model.main_loop )
+        self.datagrams_received( [(data, addr)] )
+
+    def datagrams_received( self, datagrams ):
+        # Takes a list of (data, addr) tuples. A datagram that can't be handled is dropped on its own,
+        # and the rest of the batch still goes through.
+        self._dispatched = []
+        for data, addr in datagrams:
+            if self._trace_datagrams:
+                print( f"UDP data received from {addr}: {data}" )
+            try:
+                message = parse_datagram( data )
+                messages = message.messages if isinstance( message, MessageBatch ) else [message]
+                if messages and isinstance( messages[0], SEQN ):
+                    if self._event_sequencer:
+                        self._event_sequencer.receive( messages[0].sequence, messages[1:], addr )
+                elif isinstance( message, FWRD ):
+                    self._forward_received( message, addr )
+                else:
+                    self._dispatch( message, addr )
+            except Exception as ex:
+                print( f"Dropping datagram from {addr} that could not be handled: {ex!r}" )
+        self._flush_dispatched()
+        self._dispatched = None
+
+    def _forward_received( self, message, addr ):
+        # Pass the message on down its sender's tree before handing it to the app model. Without an
+        # overlay of our own, we can still read it, but whoever we were supposed to pass it on to
+        # misses out.
+        if self._overlay:
+            if self._overlay.seen( message.screen_name, message.message_id ):
+                return
+            self._send_forward( message.screen_name, message.message_id, message.message,
+                self._overlay.children( message.screen_name ) )
+        self._dispatch( MESG( message.screen_name, message.message ), addr )
+
+    def _send_forward( self, screen_name, message_id, message, members ):
+        if not members:
+            return
+        data = f"FWRD {screen_name} {message_id}: {message}\n".encode()
+        binary_data = binary.encode_forward( screen_name, message_id, message )
+        for member in members:
+            self._send_datagram( binary_data if member.binary else data, member )
+
+    def _members_changed( self ):
+        if self._overlay:
+            self._overlay.update_members( self._chat_members )
+
+    def _deliver_events( self, events, source ):
+        self._dispatch( events[0] if len( events ) == 1 else MessageBatch( events ), source )
+
+    def _request_repair( self, first, last, address ):
+        if self._transport:
+            if self._binary_protocol:
+                self._transport.sendto( binary.encode_repair_request( first, last ), address )
+            else:
+                self._transport.sendto( f"NACK {first} {last}\n".encode(), address )
+
+    def _dispatch( self, message, addr ):
+        if self._server_connection and addr == self._server_address:
+            # Anything collected so far goes first, so the app model sees messages in order.
+            self._flush_dispatched()
+            self._app_model.main_handoff.call_soon( self._server_connection.datagram_received, message )
+        elif self._dispatched is not None:
+            self._dispatched.append( message )
+        else:
+            self._app_model.main_handoff.call_soon( self._app_model.handle_messages, [message] )
+
+    def _flush_dispatched( self ):
+        if self._dispatched:
+            self._app_model.main_handoff.call_soon( self._app_model.handle_messages, self._dispatched )
+            self._dispatched = []
 
     def _send_datagram( self, data, member ):
         if self._transport:
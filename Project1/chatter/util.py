@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import string
 
 def create_task( coro ):
@@ -13,10 +14,58 @@ def create_task( coro ):
     #
     return asyncio.get_event_loop().create_task( coro )
 
+class LoopHandoff:
+    # Hands calls over to an event loop in batches. Calls are queued on a deque, whose appends and pops
+    # are atomic, and the loop is woken once to run all the calls queued since it last ran them, rather
+    # than once per call as with call_soon_threadsafe or run_coroutine_threadsafe. A handoff that is
+    # only ever used from the loop's own thread doesn't need to be threadsafe, and then skips the
+    # wakeup altogether.
+    def __init__( self, loop, threadsafe=True ):
+        self._loop = loop
+        self._threadsafe = threadsafe
+        self._calls = collections.deque()
+        self._scheduled = False
+
+    @property
+    def loop( self ):
+        return self._loop
+
+    def call_soon( self, callback, *args ):
+        self._calls.append( (callback, args) )
+        if not self._scheduled:
+            self._scheduled = True
+            if self._threadsafe:
+                self._loop.call_soon_threadsafe( self._run_calls )
+            else:
+                self._loop.call_soon( self._run_calls )
+
+    def create_task( self, coro ):
+        # Like run_coroutine_threadsafe, but without a future to report back with.
+        self.call_soon( self._loop.create_task, coro )
+
+    def _run_calls( self ):
+        # Cleared before the calls are run, so that a call queued while they run wakes the loop again
+        # rather than being left behind. Only the calls queued by then are run, for the same reason.
+        self._scheduled = False
+        for _ in range( len( self._calls ) ):
+            callback, args = self._calls.popleft()
+            try:
+                callback( *args )
+            except Exception as ex:
+                self._loop.call_exception_handler( {
+                    "message": f"Exception in handed off call {callback!r}",
+                    "exception": ex
+                } )
+
 def validate_screen_name( screen_name ):
     if not all( c not in string.whitespace for c in screen_name ):
         raise ValueError( f"Invalid screen name {screen_name}. Screen name cannot have spaces." )
 
+def validate_room( room ):
+    # Room names are sent as a single token in the text protocol, and the server rejects any others.
+    if not all( c not in string.whitespace for c in room ):
+        raise ValueError( f"Invalid room name {room}. Room name cannot have spaces." )
+
 def validate_port( port ):
     # Try to convert the port to an integer and validate that it's positive.
     port = int( port )
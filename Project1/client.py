@@ -31,11 +31,71 @@ class ClientApp( QGuiApplication ):
             metavar="<server port>",
             help="Port on the chat membership server to connect to" )
 
+        parser.add_argument( "--room",
+            default="",
+            help="Room on the membership server to chat in. Only members of the same room see each other. "
+                "The server's default room is used if none is given. Room names cannot contain spaces." )
+
+        parser.add_argument( "--udp-membership",
+            action="store_true",
+            help="Join the membership server over UDP instead of holding a TCP connection open to it. The "
+                "server must be running with --udp-membership." )
+
+        parser.add_argument( "--binary-protocol",
+            action="store_true",
+            help="Talk to the membership server and to other binary capable clients using the compact "
+                "binary encoding instead of text. Requires a membership server that supports it." )
+
+        parser.add_argument( "--relay-chat",
+            action="store_true",
+            help="Send each chat message once to the membership server, which relays it to the rest of the "
+                "room, instead of sending it to every member directly. The server must be running with "
+                "--relay-chat." )
+
+        parser.add_argument( "--tree-fanout",
+            type=int,
+            default=0,
+            metavar="K",
+            help="Spread chat messages peer to peer down a tree in which each member passes a message on to "
+                "at most K others, instead of sending each message to every member directly. Every member of "
+                "the room should use the same fanout. Disabled by default." )
+
+        parser.add_argument( "--chat-history",
+            type=int,
+            default=ChatHistoryModel.DEFAULT_MAX_MESSAGES,
+            metavar="MESSAGES",
+            help="Number of the most recent chat messages to keep in the chat window. Older messages are "
+                "dropped from the top as new ones arrive." )
+
+        parser.add_argument( "--datagram-thread",
+            action="store_true",
+            help="Run the UDP datagram channel on its own thread and event loop, as is always done on "
+                "Windows, instead of on the main loop." )
+
+        parser.add_argument( "--trace-datagrams",
+            action="store_true",
+            help="Print every datagram received on the datagram channel. Slows the client down considerably "
+                "under heavy traffic." )
+
         # argparse parser wants only the command line arguments. Typically the app arguments, which
         # were initialized from sys.argv, also contain as the first entry the name of the script
         # that was executed. We strip that off before calling the command line parser.
         arguments = self.arguments()
-        return parser.parse_args( arguments[1:] )
+        cli = parser.parse_args( arguments[1:] )
+
+        if cli.tree_fanout < 0:
+            parser.error( "The tree fanout must not be negative." )
+        if cli.chat_history < 1:
+            parser.error( "The chat history must hold at least one message." )
+        if cli.tree_fanout and cli.relay_chat:
+            parser.error( "Chat messages can either be relayed by the server or spread down a tree, not both." )
+        if cli.room:
+            try:
+                validate_room( cli.room )
+            except ValueError as ex:
+                parser.error( str( ex ) )
+
+        return cli
 
 class DatagramChannelThread( threading.Thread ):
     def __init__( self, datagram_channel_loop ):
@@ -66,19 +126,28 @@ def main( argv ):
     #
     # To avoid gutting the asynchronous code from the app and starting over with a different socket
     # API, we setup a separate thread to handle UDP traffic with a SelectorEventLoop. We then
-    # communicate between the two event loops by submitting coroutines as tasks to the appropriate
+    # communicate between the two event loops by handing calls and coroutines over to the appropriate
     # event loop. It sucks and is ugly but better than rearchitecting late in the game.
     #
-    datagram_channel_loop = asyncio.SelectorEventLoop( selectors.SelectSelector() )
-    datagram_channel_thread = DatagramChannelThread( datagram_channel_loop )
+    # Everywhere else quamash's loop is selector based and serves UDP just fine, so the datagram
+    # channel runs on the main loop and nothing has to cross threads, unless --datagram-thread asks
+    # for the thread anyway.
+    #
+    cli = app.parse_command_line()
+    if sys.platform == "win32" or cli.datagram_thread:
+        datagram_channel_loop = asyncio.SelectorEventLoop( selectors.SelectSelector() )
+        datagram_channel_thread = DatagramChannelThread( datagram_channel_loop )
+    else:
+        datagram_channel_thread = None
 
     # Create the top-level app model state for the chat client.
-    app_model = AppModel( main_loop, datagram_channel_thread )
-
-    cli = app.parse_command_line()
+    app_model = AppModel( main_loop, datagram_channel_thread, udp_membership=cli.udp_membership,
+        binary_protocol=cli.binary_protocol, relay_chat=cli.relay_chat, tree_fanout=cli.tree_fanout,
+        max_chat_history=cli.chat_history, trace_datagrams=cli.trace_datagrams )
     app_model.screenName = cli.screen_name
     app_model.serverAddress = cli.server_address
     app_model.serverPort = cli.server_port
+    app_model.room = cli.room
 
     # Initialize the UI.
     qmlRegisterUncreatableType( AppModel, "Chatter.Client", 1, 0, "AppModel", "AppModel cannot be craeted in QML." )
@@ -87,9 +156,11 @@ def main( argv ):
     engine.load( "client.qml" )
 
     with main_loop:
-        datagram_channel_thread.start()
+        if datagram_channel_thread:
+            datagram_channel_thread.start()
         main_loop.run_until_complete( app_model._client_stopped )
-        datagram_channel_thread.join()
+        if datagram_channel_thread:
+            datagram_channel_thread.join()
         print( "Leaving app" )
 
 if __name__ == "__main__":
@@ -31,13 +31,39 @@ ApplicationWindow {
             Layout.fillHeight: true
             orientation: Qt.Horizontal
 
-            TextArea {
+            ScrollView {
                 Layout.fillWidth: true
-                font.pointSize: 10
-                readOnly: true
+                frameVisible: true
                 enabled: appModel.clientStatus == AppModel.Connected
-                textFormat: TextEdit.RichText
-                text: appModel.chatBuffer
+
+                // Only the visible rows of the chat history are laid out, so a long session doesn't
+                // get slower with every message.
+                ListView {
+                    id: chatHistoryView
+                    model: appModel.chatHistory
+                    spacing: 8
+                    topMargin: 4
+                    bottomMargin: 4
+
+                    // Keep showing the newest messages as they arrive, unless the user has scrolled
+                    // back through the history.
+                    property bool followTail: true
+                    onMovementEnded: followTail = atYEnd
+                    onCountChanged: {
+                        if( followTail ) {
+                            positionViewAtEnd()
+                        }
+                    }
+
+                    delegate: Text {
+                        x: 4
+                        width: chatHistoryView.width - 8
+                        font.pointSize: 10
+                        wrapMode: Text.Wrap
+                        textFormat: Text.RichText
+                        text: model.display
+                    }
+                }
             }
 
             ColumnLayout {
@@ -50,7 +76,7 @@ ApplicationWindow {
                     GridLayout {
                         anchors.fill: parent
                         columns: 2
-                        rows: 4
+                        rows: 5
 
                         Label {
                             text: "Screen name"
@@ -103,8 +129,26 @@ ApplicationWindow {
                             }
                         }
 
+                        Label {
+                            text: "Room"
+                        }
+
+                        TextField {
+                            id: roomInput
+                            Layout.fillWidth: true
+                            text: appModel.room
+                            placeholderText: "Default room"
+                            enabled: appModel.clientStatus == AppModel.Disconnected
+
+                            Binding {
+                                target: appModel
+                                property: "room"
+                                value: roomInput.text
+                            }
+                        }
+
                         RowLayout {
-                            Layout.row: 3
+                            Layout.row: 4
                             Layout.column: 1
                             Layout.fillWidth: true
 
@@ -141,11 +185,9 @@ ApplicationWindow {
             id: messageInput
             Layout.fillWidth: true
             enabled: appModel.clientStatus == AppModel.Connected
-            onAccepted: appModel.send_chat_message( text )
-
-            Connections {
-                target: appModel
-                onChatBufferChanged: messageInput.remove( 0, messageInput.text.length )
+            onAccepted: {
+                appModel.send_chat_message( text )
+                remove( 0, text.length )
             }
         }
     }
@@ -0,0 +1,1283 @@
+import argparse
+import asyncio
+import contextlib
+import itertools
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from server import (DEFAULT_ROSTER_CHANGELOG_SIZE, EVENT_LOOP_BACKENDS, BatchSender, Member,
+    MemberConnection, MemberRegistry, Server, binary, parse_binary_message, parse_message, raise_open_file_limit)
+
+# The client's half of the protocol, for timing how it decodes what the server sends, and its
+# datagram channel, for simulating chat between many headless clients.
+from chatter import message as client_message
+from chatter.member import ChatMember
+from chatter.remoting import DatagramChannel
+from chatter.util import LoopHandoff
+
+def format_rate( seconds, count ):
+    return f"{seconds / count * 1e6:8.3f} us/op"
+
+def bench_registry( cli ):
+    # Grow the registry to each target size and then measure the cost of a batch of joins followed by
+    # the matching batch of leaves. With an indexed registry the per-operation cost should stay flat
+    # regardless of how many members are already registered.
+    registry = MemberRegistry()
+    connections = []
+
+    print( f"{'members':>10} {'join':>16} {'leave':>16}" )
+    for size in cli.sizes:
+        while len( registry ) < size:
+            conn = object()
+            index = len( connections )
+            registry.add( Member( f"member{index}", "127.0.0.1", 10000 + index % 50000 ), conn )
+            connections.append( conn )
+
+        probe_connections = [object() for _ in range( cli.ops )]
+        probe_members = [Member( f"probe{index}", "127.0.0.1", 9999 ) for index in range( cli.ops )]
+
+        start = time.perf_counter()
+        for member, conn in zip( probe_members, probe_connections ):
+            if member.screen_name not in registry:
+                registry.add( member, conn )
+        join_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for conn in probe_connections:
+            registry.remove_by_connection( conn )
+        leave_time = time.perf_counter() - start
+
+        print( f"{size:>10} {format_rate( join_time, cli.ops ):>16} {format_rate( leave_time, cli.ops ):>16}" )
+
+def format_accept_legacy( members ):
+    # The original ACPT formatting, which rebuilt the entire roster string on every accept.
+    return f"ACPT {':'.join( f'{member.screen_name} {member.ip_address} {member.port}' for member in members)}\n".encode()
+
+def bench_accept( cli ):
+    # For each roster size, time a batch of joins where each join produces the ACPT message sent to
+    # the new member. This is compared against formatting the roster from scratch on each join.
+    print( f"{'members':>10} {'encoded roster':>16} {'legacy format':>16}" )
+    for size in cli.sizes:
+        registry = MemberRegistry()
+        for index in range( size ):
+            registry.add( Member( f"member{index}", "127.0.0.1", 10000 + index % 50000 ), object() )
+
+        probe_members = [Member( f"probe{index}", "127.0.0.1", 9999 ) for index in range( cli.ops )]
+        probe_connections = [object() for _ in range( cli.ops )]
+
+        start = time.perf_counter()
+        for member, conn in zip( probe_members, probe_connections ):
+            registry.add( member, conn )
+            registry.accept_message
+        encoded_time = time.perf_counter() - start
+
+        for conn in probe_connections:
+            registry.remove_by_connection( conn )
+
+        start = time.perf_counter()
+        for member, conn in zip( probe_members, probe_connections ):
+            registry.add( member, conn )
+            format_accept_legacy( registry )
+        legacy_time = time.perf_counter() - start
+
+        print( f"{size:>10} {format_rate( encoded_time, cli.ops ):>16} {format_rate( legacy_time, cli.ops ):>16}" )
+
+def drain_receivers( receivers ):
+    received = 0
+    for receiver in receivers:
+        while True:
+            try:
+                receiver.recv( 2048 )
+                received += 1
+            except BlockingIOError:
+                break
+    return received
+
+async def run_fanout( cli, receivers ):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint( asyncio.DatagramProtocol, local_addr=("127.0.0.1", 0) )
+    sock = transport.get_extra_info( "socket" )
+    sock.setsockopt( socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024 )
+
+    sender = BatchSender( transport )
+    addresses = [receiver.getsockname() for receiver in receivers]
+    data = b"JOIN somebody 127.0.0.1 12345\n"
+
+    def fan_out( mode ):
+        if mode == "batched":
+            sender.send_to_many( data, addresses )
+        else:
+            for address in addresses:
+                transport.sendto( data, address )
+
+    for mode in ("batched", "unbatched"):
+        if mode == "batched" and not sender.batched:
+            print( f"{mode:>10} {'unavailable on this platform':>32}" )
+            continue
+
+        # Warm up so the batched sender's address cache is populated before timing starts.
+        fan_out( mode )
+        while transport.get_write_buffer_size():
+            await asyncio.sleep( 0.001 )
+        drain_receivers( receivers )
+
+        elapsed = 0.0
+        received = 0
+        for _ in range( cli.rounds ):
+            start = time.perf_counter()
+            fan_out( mode )
+            elapsed += time.perf_counter() - start
+
+            # Let the transport flush anything it had to buffer before counting what arrived.
+            while transport.get_write_buffer_size():
+                await asyncio.sleep( 0.001 )
+            received += drain_receivers( receivers )
+
+        sent = cli.rounds * len( addresses )
+        print( f"{mode:>10} {sent / elapsed:>14,.0f} pkts/s {received:>10} of {sent} received" )
+
+    transport.close()
+
+def bench_fanout( cli ):
+    # Fan a JOIN sized datagram out to a set of loopback receivers using both sendmmsg and a plain
+    # sendto per receiver, and report the packet rate achieved by each.
+    receivers = []
+    try:
+        for _ in range( cli.receivers ):
+            receiver = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+            receiver.bind( ("127.0.0.1", 0) )
+            receiver.setblocking( False )
+            receivers.append( receiver )
+
+        print( f"Fanning out to {len( receivers )} loopback receivers for {cli.rounds} rounds." )
+        asyncio.run( run_fanout( cli, receivers ) )
+    finally:
+        for receiver in receivers:
+            receiver.close()
+
+class IdleMember( asyncio.Protocol ):
+    # A bare-bones member that optionally says hello, waits for the server's response, and then sits
+    # idle on its connection, discarding anything else the server sends it.
+    def __init__( self, hello ):
+        self._hello = hello
+        self._transport = None
+        self.responded = asyncio.get_event_loop().create_future()
+
+    def close( self ):
+        if self._transport:
+            self._transport.close()
+
+    def send( self, data ):
+        if self._transport:
+            self._transport.write( data )
+
+    def connection_made( self, transport ):
+        self._transport = transport
+        if self._hello:
+            transport.write( self._hello )
+        else:
+            self.responded.set_result( None )
+
+    def connection_lost( self, ex ):
+        self._transport = None
+        if not self.responded.done():
+            self.responded.set_exception( ConnectionError( "Server closed the connection." ) )
+
+    def data_received( self, data ):
+        if not self.responded.done() and b"\n" in data:
+            self.responded.set_result( None )
+
+def read_resident_memory( pid ):
+    try:
+        with open( f"/proc/{pid}/status" ) as status:
+            for line in status:
+                if line.startswith( "VmRSS:" ):
+                    return line.split( ":", 1 )[1].strip()
+    except OSError:
+        pass
+    return "unknown"
+
+async def connect_member( port, hello ):
+    loop = asyncio.get_running_loop()
+    _, member = await loop.create_connection( lambda: IdleMember( hello ), "127.0.0.1", port )
+    await member.responded
+    return member
+
+async def run_connections( cli, server_pid, sink_port ):
+    members = []
+    try:
+        start = time.perf_counter()
+        while len( members ) < cli.members:
+            # Ramp up in waves so the server's listen backlog doesn't overflow.
+            wave = range( len( members ), min( cli.members, len( members ) + cli.wave_size ) )
+            members += await asyncio.gather( *[
+                connect_member( cli.port, None if cli.connect_only else f"HELO idle{index} 127.0.0.1 {sink_port}\n".encode() )
+                for index in wave] )
+
+            if len( members ) % cli.report_interval < cli.wave_size:
+                elapsed = time.perf_counter() - start
+                print( f"{len( members ):>10} members {elapsed:>10.2f} s  server RSS {read_resident_memory( server_pid )}" )
+
+        elapsed = time.perf_counter() - start
+        print( f"Holding {len( members )} idle members (ramp took {elapsed:.2f} s)." )
+
+        # While everybody is idle, see how quickly the server can still accept one more member.
+        for probe in range( cli.probes ):
+            start = time.perf_counter()
+            member = await connect_member( cli.port, f"HELO probe{probe} 127.0.0.1 {sink_port}\n".encode() )
+            print( f"Probe {probe} HELO/ACPT round trip: {(time.perf_counter() - start) * 1000:.2f} ms" )
+            member.close()
+            await asyncio.sleep( cli.hold / max( cli.probes, 1 ) )
+
+        print( f"Server RSS with {len( members )} idle members: {read_resident_memory( server_pid )}" )
+    finally:
+        for member in members:
+            member.close()
+
+def bench_connections( cli ):
+    # Starts a server on the requested event loop backend and opens the requested number of idle
+    # member connections to it. Every member registers the same UDP sink, which is never read, as its
+    # datagram port. Note that every join fans a JOIN out to all existing members and sends a full
+    # ACPT, so registering N members costs O(N^2) datagrams and roster bytes. Use --connect-only to
+    # measure just the cost of holding the TCP connections open.
+    raise_open_file_limit()
+
+    sink = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+    sink.bind( ("127.0.0.1", 0) )
+    server = start_server( cli.port, "--event-loop", cli.event_loop )
+
+    try:
+        # Give the server a moment to start listening.
+        time.sleep( cli.startup_delay )
+        asyncio.run( run_connections( cli, server.pid, sink.getsockname()[1] ) )
+    finally:
+        stop_server( server )
+        sink.close()
+
+async def run_helo_clients( cli, sink_port ):
+    # Each client repeatedly connects, says hello under a fresh screen name, waits for its ACPT, and
+    # disconnects, so the roster stays small and the measurement is dominated by the HELO path.
+    deadline = time.perf_counter() + cli.duration
+    completed = 0
+
+    async def helo_client( client_index ):
+        nonlocal completed
+        for attempt in itertools.count():
+            if time.perf_counter() >= deadline:
+                break
+            member = await connect_member( cli.port, f"HELO c{client_index}x{attempt} 127.0.0.1 {sink_port}\n".encode() )
+            member.close()
+            completed += 1
+
+    start = time.perf_counter()
+    await asyncio.gather( *[helo_client( index ) for index in range( cli.clients )] )
+    return completed / (time.perf_counter() - start)
+
+def bench_helo_rate( cli ):
+    # Measures how many HELO/ACPT exchanges per second the server sustains for each worker count.
+    # Scaling with the worker count is only expected on a machine with enough cores to spare for
+    # both the workers and this load generator.
+    raise_open_file_limit()
+
+    sink = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+    sink.bind( ("127.0.0.1", 0) )
+
+    print( f"{'workers':>10} {'HELOs/s':>12}" )
+    try:
+        for workers in cli.workers:
+            server = start_server( cli.port, "--event-loop", cli.event_loop, "--workers", str( workers ) )
+            try:
+                time.sleep( cli.startup_delay )
+                rate = asyncio.run( run_helo_clients( cli, sink.getsockname()[1] ) )
+                print( f"{workers:>10} {rate:>12,.0f}" )
+            finally:
+                stop_server( server )
+    finally:
+        sink.close()
+
+def start_server( port, *args ):
+    # Runs the server in its own session so that it and all of its workers can be stopped together.
+    server_path = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "server.py" )
+    return subprocess.Popen( [sys.executable, server_path, str( port ), *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True )
+
+def stop_server( server ):
+    os.killpg( server.pid, signal.SIGTERM )
+    server.wait()
+
+class NullTransport:
+    # Stands in for a TCP transport so messages can be pushed through a MemberConnection without
+    # touching any sockets.
+    def __init__( self, protocol, peer ):
+        self._protocol = protocol
+        self._peer = peer
+        self._closing = False
+
+    def get_extra_info( self, name, default=None ):
+        if name in ("peername", "sockname"):
+            return self._peer
+        return default
+
+    def set_write_buffer_limits( self, high=None, low=None ):
+        pass
+
+    def get_write_buffer_size( self ):
+        return 0
+
+    def write( self, data ):
+        pass
+
+    def close( self ):
+        if not self._closing:
+            self._closing = True
+            asyncio.get_event_loop().call_soon( self._protocol.connection_lost, None )
+
+def feed_message( conn, data ):
+    buffer = conn.get_buffer( len( data ) )
+    buffer[:len( data )] = data
+    conn.buffer_updated( len( data ) )
+
+async def run_dispatch( cli ):
+    # The datagram channel is never opened, so no JOIN or EXIT is actually sent and only message
+    # framing, parsing, and dispatch (including numbering the membership events) are measured. Members
+    # ask for sequenced events the way the chat client does.
+    server = Server( 0 )
+    server._server = await asyncio.get_running_loop().create_server( asyncio.Protocol, "127.0.0.1", 0 )
+
+    connections = []
+    for index in range( cli.members ):
+        conn = MemberConnection( server )
+        conn.connection_made( NullTransport( conn, ("127.0.0.1", 10000 + index % 50000) ) )
+        connections.append( conn )
+
+    hellos = [f"HELO member{index} 127.0.0.1 9999 SEQN\n".encode() for index in range( cli.members )]
+
+    start = time.perf_counter()
+    for conn, hello in zip( connections, hellos ):
+        feed_message( conn, hello )
+    for conn in connections:
+        feed_message( conn, b"EXIT\n" )
+
+    # Let anything dispatched to a task finish before stopping the clock.
+    await asyncio.sleep( 0 )
+    await asyncio.sleep( 0 )
+    elapsed = time.perf_counter() - start
+
+    server._server.close()
+    return 2 * cli.members / elapsed
+
+def bench_dispatch( cli ):
+    # Pushes a HELO and an EXIT for every member through MemberConnection's receive path and reports
+    # the number of messages handled per second.
+    rate = asyncio.run( run_dispatch( cli ) )
+    print( f"{2 * cli.members} messages dispatched at {rate:,.0f} messages/s" )
+
+class EventObserver( asyncio.DatagramProtocol ):
+    # Records when each membership event first reaches an observing member and how many datagrams it
+    # took to deliver them.
+    def __init__( self, arrivals ):
+        self._arrivals = arrivals
+        self.datagrams = 0
+
+    def datagram_received( self, data, addr ):
+        now = time.perf_counter()
+        self.datagrams += 1
+        for event in data.split( b"\n" ):
+            if event:
+                # Key arrivals by event type and screen name, e.g., b"JOIN churn1".
+                key = b" ".join( event.split( b" ", 2 )[:2] )
+                self._arrivals.setdefault( key, [] ).append( now )
+
+def format_percentiles( samples ):
+    if not samples:
+        return "n/a"
+    samples = sorted( samples )
+    def percentile( fraction ):
+        return samples[min( len( samples ) - 1, int( fraction * len( samples ) ) )] * 1000
+    return f"p50 {percentile( 0.5 ):7.2f} ms  p99 {percentile( 0.99 ):7.2f} ms  max {samples[-1] * 1000:7.2f} ms"
+
+async def wait_for_arrivals( arrivals, keys, count, timeout ):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if all( len( arrivals.get( key, () ) ) >= count for key in keys ):
+            return
+        await asyncio.sleep( 0.005 )
+
+async def run_churn( cli, sink_port ):
+    loop = asyncio.get_running_loop()
+    arrivals = {}
+    observers = []
+    members = []
+
+    try:
+        # Bring the observers in first and wait for the server to settle before starting the burst.
+        for index in range( cli.observers ):
+            transport, observer = await loop.create_datagram_endpoint( lambda: EventObserver( arrivals ),
+                local_addr=("127.0.0.1", 0) )
+            observers.append( (transport, observer) )
+            port = transport.get_extra_info( "sockname" )[1]
+            members.append( await connect_member( cli.port, f"HELO observer{index} 127.0.0.1 {port} SEQN\n".encode() ) )
+        await asyncio.sleep( 0.5 )
+        arrivals.clear()
+        for _, observer in observers:
+            observer.datagrams = 0
+
+        # A burst of joins followed by a burst of exits.
+        names = [f"churn{index}".encode() for index in range( cli.churn )]
+        join_sent = dict.fromkeys( names, time.perf_counter() )
+        members += await asyncio.gather( *[
+            connect_member( cli.port, b"HELO " + name + f" 127.0.0.1 {sink_port}\n".encode() ) for name in names] )
+        await wait_for_arrivals( arrivals, [b"JOIN " + name for name in names], cli.observers, cli.timeout )
+
+        exit_sent = dict.fromkeys( names, time.perf_counter() )
+        for member in members[cli.observers:]:
+            member.send( b"EXIT\n" )
+        await wait_for_arrivals( arrivals, [b"EXIT " + name for name in names], cli.observers, cli.timeout )
+
+        delays = []
+        for name in names:
+            delays += [arrival - join_sent[name] for arrival in arrivals.get( b"JOIN " + name, [] )]
+            delays += [arrival - exit_sent[name] for arrival in arrivals.get( b"EXIT " + name, [] )]
+
+        datagrams = sum( observer.datagrams for _, observer in observers )
+        return datagrams / cli.observers, delays
+    finally:
+        for member in members:
+            member.close()
+        for transport, _ in observers:
+            transport.close()
+
+def bench_churn( cli ):
+    # Measures how many datagrams each member receives, and how long events take to reach it, while a
+    # burst of members joins and then leaves, for each event batch window.
+    sink = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+    sink.bind( ("127.0.0.1", 0) )
+
+    print( f"{2 * cli.churn} membership events observed by {cli.observers} members." )
+    print( f"{'window':>10} {'datagrams/member':>18}  propagation delay" )
+    try:
+        for window in cli.windows:
+            server = start_server( cli.port,
+                "--event-batch-window", str( window ),
+                "--event-batch-size", str( cli.batch_size ) )
+            try:
+                time.sleep( cli.startup_delay )
+                datagrams, delays = asyncio.run( run_churn( cli, sink.getsockname()[1] ) )
+                print( f"{window:>8g}ms {datagrams:>18.1f}  {format_percentiles( delays )}" )
+            finally:
+                stop_server( server )
+    finally:
+        sink.close()
+
+def time_codec( function, argument, ops ):
+    start = time.perf_counter()
+    for _ in range( ops ):
+        function( argument )
+    return (time.perf_counter() - start) / ops
+
+def decode_binary_frame( parse, data ):
+    message_type, body = next( binary.split_frames( data ) )
+    return parse( message_type, body )
+
+def bench_codec( cli ):
+    # Compares the text and binary encodings of each message: bytes on the wire, the time for the
+    # sending side to encode it, and the time for the receiving side to decode it. HELO, EXIT, and PING
+    # are decoded the way the server does and everything else the way the client does. The roster
+    # is encoded from scratch here, whereas the server normally reuses its cached encoding.
+    roster = [(f"member{index}", f"10.0.{index // 256 % 256}.{index % 256}", 10000 + index % 50000)
+        for index in range( cli.roster_size )]
+    name, ip_address, port = "alice", "10.0.0.1", 5000
+    message = "The quick brown fox jumps over the lazy dog."
+
+    cases = [
+        ("HELO",
+            lambda _: f"HELO {name} {ip_address} {port}\n".encode(),
+            lambda _: binary.encode_hello( name, ip_address, port ),
+            lambda data: parse_message( data[:-1].decode() ),
+            lambda data: decode_binary_frame( parse_binary_message, data )),
+        ("EXIT",
+            lambda _: b"EXIT\n",
+            lambda _: binary.encode_frame( binary.EXIT ),
+            lambda data: parse_message( data[:-1].decode() ),
+            lambda data: decode_binary_frame( parse_binary_message, data )),
+        (f"ACPT ({cli.roster_size})",
+            lambda _: ("ACPT " + ":".join( f"{name} {ip} {port}" for name, ip, port in roster ) + "\n").encode(),
+            lambda _: binary.encode_frame( binary.ACPT, b"".join( binary.encode_member( *member ) for member in roster ) ),
+            lambda data: client_message.parse_message( data[:-1].decode() ),
+            lambda data: decode_binary_frame( client_message.parse_binary_message, data )),
+        ("RJCT",
+            lambda _: f"RJCT {name}\n".encode(),
+            lambda _: binary.encode_reject( name ),
+            lambda data: client_message.parse_message( data[:-1].decode() ),
+            lambda data: decode_binary_frame( client_message.parse_binary_message, data )),
+        ("JOIN",
+            lambda _: f"JOIN {name} {ip_address} {port}\n".encode(),
+            lambda _: binary.encode_frame( binary.JOIN, binary.encode_member( name, ip_address, port ) ),
+            lambda data: client_message.parse_message( data[:-1].decode() ),
+            lambda data: decode_binary_frame( client_message.parse_binary_message, data )),
+        ("EXIT (event)",
+            lambda _: f"EXIT {name}\n".encode(),
+            lambda _: binary.encode_exit( name ),
+            lambda data: client_message.parse_message( data[:-1].decode() ),
+            lambda data: decode_binary_frame( client_message.parse_binary_message, data )),
+        ("MESG",
+            lambda _: f"MESG {name}: {message}\n".encode(),
+            lambda _: binary.encode_message( name, message ),
+            lambda data: client_message.parse_message( data[:-1].decode() ),
+            lambda data: decode_binary_frame( client_message.parse_binary_message, data )),
+    ]
+
+    print( f"{'message':<14} {'text bytes':>11} {'binary bytes':>13} {'text encode':>16} {'binary encode':>16} "
+        f"{'text decode':>16} {'binary decode':>16}" )
+    for label, encode_text, encode_binary, decode_text, decode_binary in cases:
+        # Large rosters take long enough per operation that far fewer of them are needed.
+        ops = max( 1, cli.ops // (cli.roster_size // 10) ) if label.startswith( "ACPT" ) else cli.ops
+        text_data = encode_text( None )
+        binary_data = encode_binary( None )
+        print( f"{label:<14} {len( text_data ):>11} {len( binary_data ):>13} "
+            f"{format_rate( time_codec( encode_text, None, ops ), 1 ):>16} "
+            f"{format_rate( time_codec( encode_binary, None, ops ), 1 ):>16} "
+            f"{format_rate( time_codec( decode_text, text_data, ops ), 1 ):>16} "
+            f"{format_rate( time_codec( decode_binary, binary_data, ops ), 1 ):>16}" )
+
+def bench_resync( cli ):
+    # Simulates a reconnect storm. A number of members drop while the roster keeps changing, and then
+    # they all rejoin with the roster version they had. Each rejoin is answered with either the full
+    # ACPT roster or, with the roster changelog, an RSYN carrying only what changed since that
+    # version. Reports the average bytes sent and server time per rejoin for each.
+    print( f"{'members':>10} {'changes':>8} {'ACPT bytes':>11} {'RSYN bytes':>11} {'ACPT':>16} {'RSYN':>16}" )
+    for size in cli.sizes:
+        for change_count in cli.changes:
+            results = []
+            for changelog_size in (0, DEFAULT_ROSTER_CHANGELOG_SIZE):
+                registry = MemberRegistry( changelog_size )
+                connections = [object() for _ in range( size )]
+                for index, conn in enumerate( connections ):
+                    registry.add( Member( f"member{index}", "127.0.0.1", 10000 + index % 50000 ), conn )
+
+                # The rejoining members dropped at this version. While they were gone, half of the
+                # changes were departures and the other half newcomers.
+                roster_version = registry.roster_version
+                for conn in connections[:cli.rejoins]:
+                    registry.remove_by_connection( conn )
+                for conn in connections[cli.rejoins:cli.rejoins + change_count // 2]:
+                    registry.remove_by_connection( conn )
+                for index in range( change_count - change_count // 2 ):
+                    registry.add( Member( f"newcomer{index}", "127.0.0.1", 9999 ), object() )
+
+                sent_bytes = 0
+                start = time.perf_counter()
+                for index in range( cli.rejoins ):
+                    registry.add( Member( f"member{index}", "127.0.0.1", 10000 + index % 50000 ), object() )
+                    sent_bytes += len( registry.version_message( 0 ) )
+                    sent_bytes += len( registry.resync_message( roster_version ) or registry.accept_message )
+                results.append( (sent_bytes // cli.rejoins, time.perf_counter() - start) )
+
+            (accept_bytes, accept_time), (resync_bytes, resync_time) = results
+            print( f"{size:>10} {change_count:>8} {accept_bytes:>11} {resync_bytes:>11} "
+                f"{format_rate( accept_time, cli.rejoins ):>16} {format_rate( resync_time, cli.rejoins ):>16}" )
+
+class HelloProbe( asyncio.Protocol ):
+    # Says hello and records whether the server answered with an ACPT or a RJCT.
+    def __init__( self, hello ):
+        self._hello = hello
+        self._transport = None
+        self._buffer = b""
+        self.answer = asyncio.get_event_loop().create_future()
+
+    def close( self ):
+        if self._transport:
+            self._transport.close()
+
+    def connection_made( self, transport ):
+        self._transport = transport
+        transport.write( self._hello )
+
+    def connection_lost( self, ex ):
+        self._transport = None
+        if not self.answer.done():
+            self.answer.set_exception( ConnectionError( "Server closed the connection." ) )
+
+    def data_received( self, data ):
+        self._buffer += data
+        for line in self._buffer.split( b"\n" )[:-1]:
+            if line[:4] in (b"ACPT", b"RJCT") and not self.answer.done():
+                self.answer.set_result( line[:4] )
+
+async def say_hello( port, hello, local_ip, timeout ):
+    loop = asyncio.get_running_loop()
+    _, probe = await loop.create_connection( lambda: HelloProbe( hello ), "127.0.0.1", port, local_addr=(local_ip, 0) )
+    try:
+        return await asyncio.wait_for( probe.answer, timeout )
+    finally:
+        probe.close()
+
+async def run_admission( cli, sink_port ):
+    # A handful of flooders reconnect from one address in a tight loop, while ordinary members join
+    # from addresses of their own at a steady pace and stay.
+    deadline = time.perf_counter() + cli.duration
+    flood_answers = {}
+    latencies = []
+    members = []
+
+    async def flooder( flooder_index ):
+        for attempt in itertools.count():
+            if time.perf_counter() >= deadline:
+                break
+            try:
+                answer = await say_hello( cli.port, f"HELO flood{flooder_index}x{attempt} 127.0.0.2 {sink_port}\n".encode(),
+                    "127.0.0.2", cli.timeout )
+            except (OSError, ConnectionError, asyncio.TimeoutError):
+                answer = b"lost"
+            flood_answers[answer] = flood_answers.get( answer, 0 ) + 1
+
+    async def member( member_index ):
+        await asyncio.sleep( member_index * cli.duration / cli.members )
+        local_ip = f"127.0.{1 + member_index // 250}.{1 + member_index % 250}"
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            _, probe = await loop.create_connection(
+                lambda: HelloProbe( f"HELO member{member_index} {local_ip} {sink_port}\n".encode() ),
+                "127.0.0.1", cli.port, local_addr=(local_ip, 0) )
+            members.append( probe )
+            if await asyncio.wait_for( probe.answer, cli.timeout ) == b"ACPT":
+                latencies.append( time.perf_counter() - start )
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            pass
+
+    try:
+        await asyncio.gather( *[flooder( index ) for index in range( cli.flooders )],
+            *[member( index ) for index in range( cli.members )] )
+    finally:
+        for probe in members:
+            probe.close()
+    return latencies, flood_answers
+
+def bench_admission( cli ):
+    # Compares how long ordinary members wait for their ACPT while flooders hammer the server with
+    # HELOs, with and without admission control, and how much of the flood was shed.
+    raise_open_file_limit()
+
+    sink = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+    sink.bind( ("127.0.0.1", 0) )
+
+    configs = [("unlimited", []),
+        ("limited", ["--helo-rate", str( cli.helo_rate ), "--helo-burst", str( cli.helo_burst ),
+            "--accept-rate", str( cli.accept_rate ), "--accept-burst", str( cli.accept_burst )])]
+
+    print( f"{cli.flooders} flooders against {cli.members} members joining over {cli.duration:g} s." )
+    print( f"{'config':>10} {'joined':>7} {'flood ACPT':>11} {'flood RJCT':>11} {'flood lost':>11}  member ACPT latency" )
+    try:
+        for label, args in configs:
+            server = start_server( cli.port, *args )
+            try:
+                time.sleep( cli.startup_delay )
+                latencies, flood_answers = asyncio.run( run_admission( cli, sink.getsockname()[1] ) )
+                print( f"{label:>10} {len( latencies ):>7} {flood_answers.get( b'ACPT', 0 ):>11} "
+                    f"{flood_answers.get( b'RJCT', 0 ):>11} {flood_answers.get( b'lost', 0 ):>11}  "
+                    f"{format_percentiles( latencies )}" )
+            finally:
+                stop_server( server )
+    finally:
+        sink.close()
+
+class ChatObserver( asyncio.DatagramProtocol ):
+    # Records when each chat message reaches a member, keyed by the text of the message.
+    def __init__( self, arrivals ):
+        self._arrivals = arrivals
+
+    def datagram_received( self, data, addr ):
+        now = time.perf_counter()
+        for line in data.split( b"\n" ):
+            if line.startswith( b"MESG " ):
+                self._arrivals.setdefault( line.partition( b": " )[2], [] ).append( now )
+
+async def run_chat( cli, relay ):
+    loop = asyncio.get_running_loop()
+    arrivals = {}
+    endpoints = []
+    members = []
+
+    try:
+        for index in range( cli.members ):
+            transport, _ = await loop.create_datagram_endpoint( lambda: ChatObserver( arrivals ),
+                local_addr=("127.0.0.1", 0) )
+            transport.get_extra_info( "socket" ).setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024 )
+            endpoints.append( transport )
+            port = transport.get_extra_info( "sockname" )[1]
+            members.append( await connect_member( cli.port, f"HELO member{index} 127.0.0.1 {port}\n".encode() ) )
+
+        # The sender joins too, since the server only relays for members. It sends peer to peer the
+        # way the client does, with one sendto per member.
+        sender_transport, _ = await loop.create_datagram_endpoint( asyncio.DatagramProtocol, local_addr=("127.0.0.1", 0) )
+        endpoints.append( sender_transport )
+        sender_transport.get_extra_info( "socket" ).setsockopt( socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024 )
+        sender_port = sender_transport.get_extra_info( "sockname" )[1]
+        sender = await connect_member( cli.port, f"HELO sender 127.0.0.1 {sender_port}\n".encode() )
+        members.append( sender )
+        addresses = [endpoint.get_extra_info( "sockname" ) for endpoint in endpoints[:cli.members]]
+        await asyncio.sleep( 0.5 )
+        arrivals.clear()
+
+        padding = "x" * max( cli.size - 8, 0 )
+        sent = {}
+        uplink_bytes = 0
+        start = time.perf_counter()
+        for index in range( cli.messages ):
+            text = f"{index:08d}{padding}".encode()
+            data = b"MESG sender: " + text + b"\n"
+            sent[text] = time.perf_counter()
+            if relay:
+                sender.send( data )
+                uplink_bytes += len( data )
+            else:
+                for address in addresses:
+                    sender_transport.sendto( data, address )
+                uplink_bytes += len( data ) * len( addresses )
+            await asyncio.sleep( cli.interval / 1000 )
+        await wait_for_arrivals( arrivals, list( sent ), cli.members, cli.timeout )
+
+        delays = []
+        last_arrival = start
+        for text, sent_time in sent.items():
+            for arrival in arrivals.get( text, [] ):
+                delays.append( arrival - sent_time )
+                last_arrival = max( last_arrival, arrival )
+        return uplink_bytes, len( delays ), last_arrival - start, delays
+    finally:
+        for member in members:
+            member.close()
+        for transport in endpoints:
+            transport.close()
+
+def bench_relay( cli ):
+    # Sends a stream of chat messages from one member to the rest of its room, first peer to peer as
+    # the client normally does and then once to a server relaying chat. Reports the bytes the sender
+    # had to send, how many copies of the messages were delivered and how fast, and how long each
+    # one took to arrive.
+    raise_open_file_limit()
+
+    print( f"{cli.messages} chat messages of {cli.size} bytes sent to {cli.members} members, "
+        f"{cli.interval:g} ms apart." )
+    print( f"{'mode':>10} {'uplink bytes':>13} {'delivered':>10} {'deliveries/s':>13}  delivery latency" )
+    for label, relay in (("p2p", False), ("relay", True)):
+        server = start_server( cli.port, "--relay-chat" )
+        try:
+            time.sleep( cli.startup_delay )
+            uplink_bytes, delivered, elapsed, delays = asyncio.run( run_chat( cli, relay ) )
+            print( f"{label:>10} {uplink_bytes:>13,} {delivered:>10} {delivered / elapsed:>13,.0f}  "
+                f"{format_percentiles( delays )}" )
+        finally:
+            stop_server( server )
+
+class HeadlessClient:
+    # Stands in for the client's app model, so that the client's real datagram channel can run without
+    # a UI, and records when each chat message reaches it.
+    def __init__( self, loop, arrivals ):
+        self.main_loop = loop
+        self.datagram_channel_loop = loop
+        self.main_handoff = LoopHandoff( loop, threadsafe=False )
+        self.datagram_channel = None
+        self._arrivals = arrivals
+
+    def handle_messages( self, messages ):
+        for message in messages:
+            if isinstance( message, client_message.MESG ):
+                self._arrivals.setdefault( message.message, [] ).append( time.perf_counter() )
+
+class ObservedDatagramChannel( DatagramChannel ):
+    # Counts the datagrams each client sends, by where they arrive from and whose chat message they
+    # carry, and works out how many hops each chat message took to reach each client from the hops it
+    # took to reach the client that passed it on.
+    def __init__( self, app_model, tree_fanout, observations ):
+        super().__init__( app_model, tree_fanout=tree_fanout )
+        self._observations = observations
+
+    def datagrams_received( self, datagrams ):
+        sent, hops = self._observations
+        for data, addr in datagrams:
+            message = client_message.parse_datagram( data )
+            sent[(addr, message.screen_name)] = sent.get( (addr, message.screen_name), 0 ) + 1
+            key = (self.get_local_address(), message.message)
+            if key not in hops:
+                hops[key] = hops.get( (addr, message.message), 0 ) + 1
+        super().datagrams_received( datagrams )
+
+async def run_overlay( cli, tree_fanout ):
+    loop = asyncio.get_running_loop()
+    arrivals = {}
+    sent = {}
+    hops = {}
+    clients = []
+    channels = []
+
+    try:
+        for _ in range( cli.clients ):
+            client = HeadlessClient( loop, arrivals )
+            client.datagram_channel = ObservedDatagramChannel( client, tree_fanout, (sent, hops) )
+            clients.append( client )
+        for index, client in enumerate( clients ):
+            await client.datagram_channel.open( "127.0.0.1", loop.create_future(), f"client{index}" )
+            channels.append( client.datagram_channel )
+
+        # Every client starts from the same roster, as if they had all just been accepted by the
+        # membership server.
+        roster = [ChatMember( f"client{index}", "127.0.0.1", channel.get_local_address()[1] )
+            for index, channel in enumerate( channels )]
+        for channel in channels:
+            await channel.set_chat_members( list( roster ) )
+
+        # Each client works out the overlay's tree the first time it needs it, and in a simulation they
+        # all take turns doing it on the same loop, so warm them up before anything is timed.
+        senders = random.sample( range( cli.clients ), cli.senders )
+        for sender in senders:
+            await channels[sender].send_message( f"client{sender}", f"warm up from client{sender}" )
+        await wait_for_arrivals( arrivals, [f"warm up from client{sender}" for sender in senders],
+            cli.clients - 1, cli.timeout )
+        arrivals.clear()
+        sent.clear()
+        hops.clear()
+
+        sent_at = {}
+        send_time = 0.0
+        for round_index in range( cli.messages ):
+            for sender in senders:
+                text = f"round{round_index} from client{sender}"
+                sent_at[text] = start = time.perf_counter()
+                await channels[sender].send_message( f"client{sender}", text )
+                send_time += time.perf_counter() - start
+            await asyncio.sleep( cli.interval / 1000 )
+        await wait_for_arrivals( arrivals, list( sent_at ), cli.clients - 1, cli.timeout )
+
+        delays = [arrival - sent_at[text] for text, times in arrivals.items() for arrival in times]
+        sender_datagrams = sum( sent.get( (channels[sender].get_local_address(), f"client{sender}"), 0 ) for sender in senders )
+        message_count = cli.messages * cli.senders
+        return (sender_datagrams / message_count, send_time / message_count, len( delays ),
+            sum( sent.values() ) - len( delays ), max( hops.values(), default=0 ), delays)
+    finally:
+        for channel in channels:
+            await channel.close()
+
+def bench_overlay( cli ):
+    # Simulates a room of headless clients on loopback, each running the client's datagram channel,
+    # and has a few of them chat. Compares sending every message to every member with spreading it
+    # down the tree overlay for each fanout: the datagrams and time each sender spends per message,
+    # how many copies were delivered, how many extra datagrams that took, the most hops any message
+    # needed, and how long messages took to arrive.
+    raise_open_file_limit()
+
+    expected = cli.messages * cli.senders * (cli.clients - 1)
+    print( f"{cli.senders} senders each sending {cli.messages} chat messages to a room of {cli.clients} clients." )
+    print( f"{'mode':>10} {'dgrams/msg':>11} {'send time':>16} {'delivered':>10} {'extra':>7} {'hops':>5}  delivery latency" )
+    for tree_fanout in [0] + cli.fanouts:
+        # The client narrates everything it does, which would swamp the results.
+        with open( os.devnull, "w" ) as devnull, contextlib.redirect_stdout( devnull ):
+            results = asyncio.run( run_overlay( cli, tree_fanout ) )
+        sender_datagrams, send_time, delivered, extra, max_hops, delays = results
+        label = f"tree k={tree_fanout}" if tree_fanout else "unicast"
+        print( f"{label:>10} {sender_datagrams:>11.1f} {format_rate( send_time, 1 ):>16} "
+            f"{delivered:>10} {extra:>7} {max_hops:>5}  {format_percentiles( delays )}" )
+    print( f"{expected} deliveries expected per mode." )
+
+class ReceiveCounter:
+    # Stands in for the client's app model and counts the messages the datagram channel hands it, and
+    # how many handoffs that took.
+    def __init__( self, loop ):
+        self.main_loop = loop
+        self.datagram_channel_loop = loop
+        self.main_handoff = LoopHandoff( loop, threadsafe=False )
+        self.received = 0
+        self.handoffs = 0
+        self._expected = 0
+        self._done = None
+
+    def expect( self, count ):
+        self._expected = self.received + count
+        self._done = self.main_loop.create_future()
+        return self._done
+
+    def handle_messages( self, messages ):
+        self.received += len( messages )
+        self.handoffs += 1
+        if self.received >= self._expected and not self._done.done():
+            self._done.set_result( None )
+
+async def run_receive( cli, batch_receive ):
+    loop = asyncio.get_running_loop()
+    counter = ReceiveCounter( loop )
+    channel = DatagramChannel( counter, batch_receive=batch_receive )
+    await channel.open( "127.0.0.1", loop.create_future(), "receiver" )
+    address = channel.get_local_address()
+    sock = channel._transport.get_extra_info( "socket" )
+    sock.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024 )
+
+    sender = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+    sender.bind( ("127.0.0.1", 0) )
+    padding = "x" * max( cli.size - 32, 0 )
+    try:
+        elapsed = 0.0
+        received = 0
+        handoffs = 0
+        for burst in range( cli.bursts + 1 ):
+            # The first burst is a warm up.
+            counter.received = counter.handoffs = 0
+            done = counter.expect( cli.burst_size )
+            datagrams = [f"MESG sender: {burst} {index} {padding}\n".encode() for index in range( cli.burst_size )]
+            for data in datagrams:
+                sender.sendto( data, address )
+
+            # Everything is already waiting in the socket's receive buffer, so the clock only runs
+            # while the channel works through it.
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for( done, cli.timeout )
+            except asyncio.TimeoutError:
+                pass
+            if burst:
+                elapsed += time.perf_counter() - start
+                received += counter.received
+                handoffs += counter.handoffs
+        return received, elapsed, handoffs
+    finally:
+        sender.close()
+        await channel.close()
+
+def bench_receive( cli ):
+    # Fills a client datagram channel's socket with bursts of chat messages and times how long the
+    # channel takes to parse them and hand them to the app model, reading one datagram per callback
+    # through the transport and a batch at a time through recvmmsg.
+    sent = cli.bursts * cli.burst_size
+    print( f"{cli.bursts} bursts of {cli.burst_size} chat messages of {cli.size} bytes." )
+    print( f"{'mode':>10} {'received':>14} {'handoffs/burst':>15}" )
+    for mode, batch_receive in (("callback", False), ("batched", True)):
+        # The client narrates everything it does, which would swamp the results.
+        with open( os.devnull, "w" ) as devnull, contextlib.redirect_stdout( devnull ):
+            received, elapsed, handoffs = asyncio.run( run_receive( cli, batch_receive ) )
+        print( f"{mode:>10} {received / elapsed:>10,.0f} msg/s {handoffs / cli.bursts:>15.1f}"
+            f"  {received} of {sent} received" )
+
+def parse_command_line( argv ):
+    parser = argparse.ArgumentParser( description="EE382V Project 2 Chatter Server Benchmarks" )
+    subparsers = parser.add_subparsers( dest="benchmark", metavar="<benchmark>" )
+    subparsers.required = True
+
+    registry_parser = subparsers.add_parser( "registry",
+        help="Measure member join/leave cost as the member registry grows." )
+    registry_parser.add_argument( "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="Registry sizes at which to measure join/leave cost." )
+    registry_parser.add_argument( "--ops",
+        type=int,
+        default=1000,
+        help="Number of joins and leaves to time at each registry size." )
+    registry_parser.set_defaults( run=bench_registry )
+
+    accept_parser = subparsers.add_parser( "accept",
+        help="Measure per-join ACPT encoding latency as the roster grows." )
+    accept_parser.add_argument( "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+        help="Roster sizes at which to measure per-join latency." )
+    accept_parser.add_argument( "--ops",
+        type=int,
+        default=200,
+        help="Number of joins to time at each roster size." )
+    accept_parser.set_defaults( run=bench_accept )
+
+    fanout_parser = subparsers.add_parser( "fanout",
+        help="Measure the packet rate of fanning out a datagram to many loopback receivers." )
+    fanout_parser.add_argument( "--receivers",
+        type=int,
+        default=10000,
+        help="Number of loopback receivers to fan out to." )
+    fanout_parser.add_argument( "--rounds",
+        type=int,
+        default=10,
+        help="Number of fan-outs to time for each send mode." )
+    fanout_parser.set_defaults( run=bench_fanout )
+
+    connections_parser = subparsers.add_parser( "connections",
+        help="Hold a large number of idle member connections open against a server." )
+    connections_parser.add_argument( "--members",
+        type=int,
+        default=20000,
+        help="Number of idle members to connect." )
+    connections_parser.add_argument( "--event-loop",
+        choices=EVENT_LOOP_BACKENDS,
+        default="auto",
+        help="Event loop backend the server should run on." )
+    connections_parser.add_argument( "--port",
+        type=int,
+        default=29500,
+        help="Welcome port to run the server on." )
+    connections_parser.add_argument( "--connect-only",
+        action="store_true",
+        help="Only open TCP connections without sending HELO." )
+    connections_parser.add_argument( "--wave-size",
+        type=int,
+        default=250,
+        help="Number of members to connect concurrently while ramping up." )
+    connections_parser.add_argument( "--report-interval",
+        type=int,
+        default=1000,
+        help="Print progress every time this many members have connected." )
+    connections_parser.add_argument( "--hold",
+        type=float,
+        default=5.0,
+        help="Seconds to hold the members idle once they are all connected." )
+    connections_parser.add_argument( "--probes",
+        type=int,
+        default=5,
+        help="Number of probe HELOs to time while the members are idle." )
+    connections_parser.add_argument( "--startup-delay",
+        type=float,
+        default=1.0,
+        help="Seconds to wait for the server to start listening." )
+    connections_parser.set_defaults( run=bench_connections )
+
+    helo_rate_parser = subparsers.add_parser( "helo-rate",
+        help="Measure HELO/ACPT throughput for different worker counts." )
+    helo_rate_parser.add_argument( "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="Worker counts to measure." )
+    helo_rate_parser.add_argument( "--clients",
+        type=int,
+        default=64,
+        help="Number of concurrent clients issuing HELOs." )
+    helo_rate_parser.add_argument( "--duration",
+        type=float,
+        default=10.0,
+        help="Seconds to run each measurement for." )
+    helo_rate_parser.add_argument( "--event-loop",
+        choices=EVENT_LOOP_BACKENDS,
+        default="auto",
+        help="Event loop backend the server should run on." )
+    helo_rate_parser.add_argument( "--port",
+        type=int,
+        default=29500,
+        help="Welcome port to run the server on." )
+    helo_rate_parser.add_argument( "--startup-delay",
+        type=float,
+        default=1.0,
+        help="Seconds to wait for the server to start listening." )
+    helo_rate_parser.set_defaults( run=bench_helo_rate )
+
+    dispatch_parser = subparsers.add_parser( "dispatch",
+        help="Measure messages/sec through a member connection's receive path." )
+    dispatch_parser.add_argument( "--members",
+        type=int,
+        default=20000,
+        help="Number of members that each send a HELO and an EXIT." )
+    dispatch_parser.set_defaults( run=bench_dispatch )
+
+    churn_parser = subparsers.add_parser( "churn",
+        help="Measure datagram counts and propagation delay during membership churn." )
+    churn_parser.add_argument( "--windows",
+        type=float,
+        nargs="+",
+        default=[0, 5, 20],
+        help="Event batch windows, in milliseconds, to measure." )
+    churn_parser.add_argument( "--batch-size",
+        type=int,
+        default=32,
+        help="Maximum number of events per datagram when batching." )
+    churn_parser.add_argument( "--observers",
+        type=int,
+        default=50,
+        help="Number of members that observe the churn." )
+    churn_parser.add_argument( "--churn",
+        type=int,
+        default=200,
+        help="Number of members that join and then leave." )
+    churn_parser.add_argument( "--timeout",
+        type=float,
+        default=10.0,
+        help="Seconds to wait for each burst of events to reach the observers." )
+    churn_parser.add_argument( "--port",
+        type=int,
+        default=29500,
+        help="Welcome port to run the server on." )
+    churn_parser.add_argument( "--startup-delay",
+        type=float,
+        default=1.0,
+        help="Seconds to wait for the server to start listening." )
+    churn_parser.set_defaults( run=bench_churn )
+
+    codec_parser = subparsers.add_parser( "codec",
+        help="Compare bytes on the wire and encode/decode time of the text and binary encodings." )
+    codec_parser.add_argument( "--roster-size",
+        type=int,
+        default=10000,
+        help="Number of members in the ACPT roster." )
+    codec_parser.add_argument( "--ops",
+        type=int,
+        default=100000,
+        help="Number of times each small message is encoded and decoded." )
+    codec_parser.set_defaults( run=bench_codec )
+
+    resync_parser = subparsers.add_parser( "resync",
+        help="Compare full ACPT rosters with RSYN changes for members rejoining in a reconnect storm." )
+    resync_parser.add_argument( "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+        help="Roster sizes at which to simulate the reconnect storm." )
+    resync_parser.add_argument( "--changes",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000],
+        help="Numbers of joins and leaves by other members while the rejoining members were gone." )
+    resync_parser.add_argument( "--rejoins",
+        type=int,
+        default=500,
+        help="Number of members that drop and rejoin." )
+    resync_parser.set_defaults( run=bench_resync )
+
+    admission_parser = subparsers.add_parser( "admission",
+        help="Measure member ACPT latency during a HELO flood with and without admission control." )
+    admission_parser.add_argument( "--flooders",
+        type=int,
+        default=32,
+        help="Number of concurrent clients reconnecting in a tight loop from one address." )
+    admission_parser.add_argument( "--members",
+        type=int,
+        default=500,
+        help="Number of ordinary members that join, each from its own loopback address." )
+    admission_parser.add_argument( "--duration",
+        type=float,
+        default=5.0,
+        help="Seconds over which the members join while the flood runs." )
+    admission_parser.add_argument( "--helo-rate",
+        type=float,
+        default=5.0,
+        help="Per-source HELO rate for the limited server." )
+    admission_parser.add_argument( "--helo-burst",
+        type=int,
+        default=5,
+        help="Per-source HELO burst for the limited server." )
+    admission_parser.add_argument( "--accept-rate",
+        type=float,
+        default=1000.0,
+        help="Global accept rate for the limited server." )
+    admission_parser.add_argument( "--accept-burst",
+        type=int,
+        default=100,
+        help="Global accept burst for the limited server." )
+    admission_parser.add_argument( "--timeout",
+        type=float,
+        default=10.0,
+        help="Seconds to wait for each HELO to be answered." )
+    admission_parser.add_argument( "--port",
+        type=int,
+        default=29500,
+        help="Welcome port to run the server on." )
+    admission_parser.add_argument( "--startup-delay",
+        type=float,
+        default=1.0,
+        help="Seconds to wait for the server to start listening." )
+    admission_parser.set_defaults( run=bench_admission )
+
+    relay_parser = subparsers.add_parser( "relay",
+        help="Compare sending chat messages peer to peer with having the server relay them." )
+    relay_parser.add_argument( "--members",
+        type=int,
+        default=200,
+        help="Number of members receiving the chat messages." )
+    relay_parser.add_argument( "--messages",
+        type=int,
+        default=500,
+        help="Number of chat messages to send." )
+    relay_parser.add_argument( "--size",
+        type=int,
+        default=100,
+        help="Size of each chat message in bytes." )
+    relay_parser.add_argument( "--interval",
+        type=float,
+        default=1.0,
+        metavar="MILLISECONDS",
+        help="Time between chat messages." )
+    relay_parser.add_argument( "--timeout",
+        type=float,
+        default=10.0,
+        help="Seconds to wait for the chat messages to reach every member." )
+    relay_parser.add_argument( "--port",
+        type=int,
+        default=29500,
+        help="Welcome port to run the server on." )
+    relay_parser.add_argument( "--startup-delay",
+        type=float,
+        default=1.0,
+        help="Seconds to wait for the server to start listening." )
+    relay_parser.set_defaults( run=bench_relay )
+
+    overlay_parser = subparsers.add_parser( "overlay",
+        help="Simulate chat among headless clients sending directly and down the tree overlay." )
+    overlay_parser.add_argument( "--clients",
+        type=int,
+        default=500,
+        help="Number of headless clients in the room." )
+    overlay_parser.add_argument( "--fanouts",
+        type=int,
+        nargs="+",
+        default=[2, 4, 8],
+        help="Tree fanouts to measure." )
+    overlay_parser.add_argument( "--senders",
+        type=int,
+        default=1,
+        help="Number of clients sending chat messages." )
+    overlay_parser.add_argument( "--messages",
+        type=int,
+        default=20,
+        help="Number of chat messages each sender sends." )
+    overlay_parser.add_argument( "--interval",
+        type=float,
+        default=200.0,
+        metavar="MILLISECONDS",
+        help="Time between rounds of chat messages." )
+    overlay_parser.add_argument( "--timeout",
+        type=float,
+        default=10.0,
+        help="Seconds to wait for the chat messages to reach every client." )
+    overlay_parser.set_defaults( run=bench_overlay )
+
+    receive_parser = subparsers.add_parser( "receive",
+        help="Compare receiving chat message bursts a datagram at a time and with recvmmsg." )
+    receive_parser.add_argument( "--bursts",
+        type=int,
+        default=50,
+        help="Number of bursts of chat messages to receive." )
+    receive_parser.add_argument( "--burst-size",
+        type=int,
+        default=1000,
+        help="Number of chat messages in each burst." )
+    receive_parser.add_argument( "--size",
+        type=int,
+        default=64,
+        help="Size of each chat message datagram in bytes." )
+    receive_parser.add_argument( "--timeout",
+        type=float,
+        default=5.0,
+        help="Seconds to wait for each burst to be received." )
+    receive_parser.set_defaults( run=bench_receive )
+
+    return parser.parse_args( argv[1:] )
+
+def main( argv ):
+    cli = parse_command_line( argv )
+    cli.run( cli )
+
+if __name__ == "__main__":
+    main( sys.argv )
@@ -1,29 +1,142 @@
 import argparse
 import asyncio
+import collections
+import ipaddress
+import itertools
 import logging
+import math
+import multiprocessing
+import os
 import platform
+import random
 import selectors
 import signal
 import socket
 import sys
+import tempfile
+import time
 import warnings
 import weakref
 
+# The server shares its lower level networking helpers with the chat client, whose chatter package
+# lives in the Project1 directory next to this one.
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), os.pardir, "Project1" ) )
+
+from chatter import binary
+from chatter.framing import LineProtocol
+from chatter.mmsg import BatchReceiver, BatchSender
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+EVENT_LOOP_BACKENDS = ["auto", "select", "epoll", "uvloop"]
+
+# What to do with a message for a member whose connection has stopped draining its write buffer.
+SLOW_CONSUMER_POLICIES = ["defer", "drop", "disconnect"]
+
+# Resolution, in seconds, of the timer wheel that reaps idle members.
+IDLE_TIMER_TICK = 1.0
+
+# Seconds a member that joined over UDP stays a member without refreshing its membership, unless an
+# idle timeout is given explicitly.
+DEFAULT_UDP_MEMBERSHIP_TIMEOUT = 30.0
+
+# Number of roster changes remembered for bringing rejoining members up to date.
+DEFAULT_ROSTER_CHANGELOG_SIZE = 10000
+
+# Seconds between reports of how many HELOs admission control has admitted, deferred, and shed.
+ADMISSION_REPORT_INTERVAL = 10.0
+
+# Room that members who don't ask for one in their HELO are placed in.
+DEFAULT_ROOM = "lobby"
+
+# Seconds the parent waits for workers to exit on their own before terminating them.
+WORKER_SHUTDOWN_GRACE_PERIOD = 2.0
+
 class HELO:
-    def __init__( self, screen_name, ip_address, port ):
+    def __init__( self, screen_name, ip_address, port, binary=False, roster_version=None, room=None, sequenced=None ):
         self.screen_name = screen_name
         self.ip_address = ip_address
         self.port = int(port)
 
+        # Whether the member said hello in the binary encoding and wants to be spoken to in it.
+        self.binary = binary
+
+        # Whether the member understands membership event datagrams that start with a SEQN and may
+        # carry several events. Binary members always do. Text members have to ask, since older
+        # clients expect every datagram to hold exactly one bare event.
+        self.sequenced = binary if sequenced is None else sequenced
+
+        # The (roster id, version) of the roster a rejoining member still has from before, if any.
+        self.roster_version = roster_version
+
+        # Room names are passed around as a single token in text messages, including the ones between
+        # sharded workers, so they can't contain any whitespace. A HELO asking for such a room is still
+        # parsed so that it can be rejected, rather than dropped and left to be resent.
+        self.valid_room = not room or len( room.split() ) == 1
+        self.room = room or DEFAULT_ROOM
+
     @classmethod
     def new( cls, data ):
-        return cls( *data.split( " " ) )
+        # HELO <screen name> <ip address> <port> [<room>] [<roster id> <roster version>] [SEQN]
+        #
+        # A trailing SEQN is always the request for sequenced events, never a room.
+        screen_name, ip_address, port, *optional = data.split( " " )
+        sequenced = bool( optional ) and optional[-1] == "SEQN"
+        if sequenced:
+            optional.pop()
+        room = optional.pop( 0 ) if len( optional ) % 2 else None
+        if optional:
+            try:
+                roster_id, version = optional
+                return cls( screen_name, ip_address, port, roster_version=(int( roster_id ), int( version )), room=room,
+                    sequenced=sequenced )
+            except ValueError:
+                # Anything other than a roster version after the room is most likely the rest of a room
+                # name with spaces in it.
+                room = " ".join( ([room] if room else []) + optional )
+        return cls( screen_name, ip_address, port, room=room, sequenced=sequenced )
 
 class EXIT:
     @classmethod
     def new( cls, data ):
         return cls()
 
+class PING:
+    @classmethod
+    def new( cls, data ):
+        return cls()
+
+class NACK:
+    # A member's request to resend the membership events it missed, by sequence number.
+    def __init__( self, first, last, binary=False ):
+        self.first = int( first )
+        self.last = int( last )
+        self.binary = binary
+
+    @classmethod
+    def new( cls, data ):
+        return cls( *data.split( " " ) )
+
+class MESG:
+    # A chat message a member hands the server to relay to the rest of its room.
+    def __init__( self, screen_name, message, binary=False ):
+        self.screen_name = screen_name
+        self.message = message
+        self.binary = binary
+
+    @classmethod
+    def new( cls, data ):
+        screen_name, _, message = data.partition( ": " )
+        return cls( screen_name, message )
+
 def parse_message( message ):
     try:
         message_type, _, message_data = message.partition( " " )
@@ -32,22 +145,637 @@ def parse_message( message ):
             return HELO.new( message_data )
         elif message_type == "EXIT":
             return EXIT.new( message_data )
+        elif message_type == "PING":
+            return PING.new( message_data )
+        elif message_type == "NACK":
+            return NACK.new( message_data )
+        elif message_type == "MESG":
+            return MESG.new( message_data )
     except:
         # If the message wasn't anything we recognized or was badly formatted, then we just drop it.
         pass
 
+def parse_binary_message( message_type, body ):
+    try:
+        if message_type == binary.HELO:
+            (screen_name, ip_address, port, flags), offset = binary.decode_member( body )
+            room = None
+            if flags & binary.FLAG_ROOM:
+                room, offset = binary.decode_name( body, offset )
+            roster_version = None
+            if len( body ) >= offset + binary.ROSTER_VERSION.size:
+                roster_version = binary.ROSTER_VERSION.unpack_from( body, offset )
+            return HELO( screen_name, ip_address, port, binary=True, roster_version=roster_version, room=room )
+        elif message_type == binary.EXIT:
+            return EXIT()
+        elif message_type == binary.PING:
+            return PING()
+        elif message_type == binary.NACK:
+            return NACK( *binary.SEQUENCE_RANGE.unpack( body ), binary=True )
+        elif message_type == binary.MESG:
+            return MESG( *binary.decode_message( body ), binary=True )
+    except:
+        # Same as for text messages, anything malformed is dropped.
+        pass
+
+def peek_screen_name( message ):
+    # Pulls the screen name out of a text HELO or the body of a binary one without parsing the rest,
+    # so that a HELO can be rejected before it costs anything more.
+    try:
+        if isinstance( message, str ):
+            return message[5:].partition( " " )[0]
+        return binary.decode_name( message, binary.MEMBER_ADDRESS.size )[0]
+    except (IndexError, UnicodeDecodeError):
+        return ""
+
 class Member:
-    def __init__( self, screen_name, ip_address, port ):
+    def __init__( self, screen_name, ip_address, port, binary=False, sequenced=False ):
         self.screen_name = screen_name
         self.ip_address = ip_address
         self.port = port
+        self.datagram_address = (ip_address, port)
+        self.binary = binary
+        self.sequenced = sequenced
 
-class MemberConnection( asyncio.Protocol ):
-    def __init__( self, server ):
+        # Each member's portion of an ACPT roster never changes, so encode it once up front (in both
+        # encodings) and reuse it every time the roster is sent out.
+        self.roster_entry = f"{screen_name} {ip_address} {port}".encode()
+        self.binary_roster_entry = encode_binary_member( screen_name, ip_address, port, binary )
+
+def encode_binary_member( screen_name, ip_address, port, binary_capable ):
+    return binary.encode_member( screen_name, ip_address, port, binary.FLAG_BINARY if binary_capable else 0 )
+
+class EncodedRoster:
+    # Maintains the wire encoding of the ACPT message for the current set of members so that
+    # accepting a new member doesn't require formatting and encoding every other member again. Joins
+    # append the new member's entry to the end of the buffer. Leaves would require shifting every
+    # entry after the departing member, so instead they mark the buffer stale and it is rebuilt with
+    # a single join the next time the roster is actually needed.
+    #
+    # The binary encoding of the roster is maintained the same way alongside the text one.
+    PREFIX = b"ACPT "
+
+    def __init__( self ):
+        self._entries = {}
+        self._binary_entries = {}
+        self._buffer = bytearray( EncodedRoster.PREFIX )
+        self._binary_buffer = bytearray()
+        self._stale = False
+        self._message = None
+        self._binary_message = None
+
+    @property
+    def accept_message( self ):
+        if self._message is None:
+            self._rebuild_if_stale()
+            self._message = b"".join( (self._buffer, b"\n") )
+        return self._message
+
+    @property
+    def binary_accept_message( self ):
+        if self._binary_message is None:
+            self._rebuild_if_stale()
+            header = binary.FRAME_HEADER.pack( len( self._binary_buffer ) + 1, binary.ACPT )
+            self._binary_message = b"".join( (header, self._binary_buffer) )
+        return self._binary_message
+
+    def add( self, member ):
+        if not self._stale:
+            if self._entries:
+                self._buffer += b":"
+            self._buffer += member.roster_entry
+            self._binary_buffer += member.binary_roster_entry
+        self._entries[member.screen_name] = member.roster_entry
+        self._binary_entries[member.screen_name] = member.binary_roster_entry
+        self._message = None
+        self._binary_message = None
+
+    def remove( self, member ):
+        if self._entries.pop( member.screen_name, None ) is not None:
+            del self._binary_entries[member.screen_name]
+            self._stale = True
+            self._message = None
+            self._binary_message = None
+
+    def _rebuild_if_stale( self ):
+        if self._stale:
+            self._buffer = bytearray( EncodedRoster.PREFIX )
+            self._buffer += b":".join( self._entries.values() )
+            self._binary_buffer = bytearray( b"".join( self._binary_entries.values() ) )
+            self._stale = False
+
+class RosterChangelog:
+    # Numbers every change to the roster and remembers the most recent ones, so that a member who
+    # rejoins after losing its connection can be sent just what changed since the roster it still has
+    # (an RSYN message) rather than the whole roster again. Versions only mean something to the server
+    # process that issued them, so the changelog also has a random roster id that rejoining members
+    # present along with their version.
+    #
+    # Only the net change per screen name is sent: a member that joined and left again since the given
+    # version is sent as having left, and clients treat every change as an upsert or a delete of
+    # whatever they have for that screen name.
+    #
+    # Members that drop together (e.g., in a network outage) tend to rejoin together with the same
+    # version, and every one of them rejoining is itself a change to the roster. So the encoded changes
+    # since each recently asked for version are cached, and brought forward by encoding only the
+    # changes made since they were last asked for.
+    MAX_CACHED_RESYNCS = 16
+
+    def __init__( self, max_changes=DEFAULT_ROSTER_CHANGELOG_SIZE ):
+        self.roster_id = random.getrandbits( 32 )
+        self.version = 0
+        self._changes = collections.deque( maxlen=max_changes )
+        self._resyncs = {}
+
+    def version_message( self, event_sequence ):
+        return f"VERS {self.roster_id} {self.version} {event_sequence}\n".encode()
+
+    def binary_version_message( self, event_sequence ):
+        return binary.encode_roster_version( self.roster_id, self.version, event_sequence )
+
+    def record( self, screen_name, member=None ):
+        # member is None when the screen name left the roster.
+        self.version += 1
+        self._changes.append( (self.version, screen_name, member) )
+
+    def resync_message( self, roster_version, roster_size, binary_encoding=False ):
+        # Returns the RSYN message that brings a member with the given roster version up to date, or
+        # None when it needs a full ACPT instead: the roster id is not ours, the changelog doesn't
+        # reach back far enough, or the changes are no smaller than the roster itself.
+        roster_id, version = roster_version
+        oldest_version = self._changes[0][0] - 1 if self._changes else self.version
+        if roster_id != self.roster_id or not oldest_version <= version <= self.version:
+            return None
+
+        # Popping and reinserting the cached entry keeps the cache in least recently used order.
+        key = (version, binary_encoding)
+        synced_version, entries, message = self._resyncs.pop( key, (version, {}, None) )
+        if synced_version < self.version:
+            new_changes = list( itertools.takewhile( lambda change: change[0] > synced_version, reversed( self._changes ) ) )
+            for _, screen_name, member in reversed( new_changes ):
+                if binary_encoding:
+                    entries[screen_name] = (bytes( (binary.JOIN,) ) + member.binary_roster_entry if member else
+                        bytes( (binary.EXIT,) ) + binary.encode_name( screen_name ))
+                else:
+                    entries[screen_name] = b"+" + member.roster_entry if member else b"-" + screen_name.encode()
+            message = None
+
+        if message is None and len( entries ) < roster_size:
+            if binary_encoding:
+                message = binary.encode_frame( binary.RSYN, b"".join( entries.values() ) )
+            else:
+                message = b"".join( (b"RSYN ", b":".join( entries.values() ), b"\n") )
+
+        self._resyncs[key] = (self.version, entries, message)
+        if len( self._resyncs ) > RosterChangelog.MAX_CACHED_RESYNCS:
+            del self._resyncs[next( iter( self._resyncs ) )]
+        return message if len( entries ) < roster_size else None
+
+class EventStream:
+    # The numbered membership events of one room. Every event gets the next number in the room's
+    # sequence, and each datagram of events starts with the sequence number of its first event, so a
+    # member can tell when it has missed some and ask for just those again.
+    def __init__( self, history_size ):
+        # The last number handed out, and the last one actually sent, which trails it while events are
+        # waiting to be batched.
+        self.sequence = 0
+        self.sent_sequence = 0
+        self.history = collections.deque( maxlen=history_size )
+
+        # Events held back for the next batch, and the timer that sends them if the batch doesn't
+        # fill up first.
+        self.pending = []
+        self.flush_handle = None
+
+class MemberRegistry:
+    # Tracks the current chat members of a room. Members are indexed both by screen name and by the
+    # connection that registered them so that joins, leaves, and duplicate screen name checks are all
+    # O(1). Since dicts preserve insertion order, iterating the registry yields members in the order
+    # they joined, which keeps the ACPT roster order stable.
+    #
+    # When the server is sharded across worker processes, the registry also holds members owned by
+    # other workers. Those members have no connection on this worker and are only tracked by name.
+    #
+    # Every join and leave is also recorded in a changelog that versions the roster, and the room's
+    # membership events are numbered in an event stream of their own.
+    def __init__( self, changelog_size=DEFAULT_ROSTER_CHANGELOG_SIZE, name=DEFAULT_ROOM ):
+        self.name = name
+        self.events = EventStream( DatagramChannel.EVENT_HISTORY_SIZE )
+        self._members_by_name = {}
+        self._members_by_connection = {}
+        self._binary_members_by_connection = {}
+        self._unsequenced_members_by_connection = {}
+        self._unsequenced_addresses = None
+        self._roster = EncodedRoster()
+        self._changelog = RosterChangelog( changelog_size )
+
+    def __len__( self ):
+        return len( self._members_by_name )
+
+    def __iter__( self ):
+        return iter( self._members_by_name.values() )
+
+    def __contains__( self, screen_name ):
+        return screen_name in self._members_by_name
+
+    @property
+    def accept_message( self ):
+        return self._roster.accept_message
+
+    @property
+    def binary_accept_message( self ):
+        return self._roster.binary_accept_message
+
+    @property
+    def roster_version( self ):
+        return (self._changelog.roster_id, self._changelog.version)
+
+    def version_message( self, event_sequence ):
+        # Along with the roster version, a member is told the sequence number of the last membership
+        # event sent before it was accepted, so it knows which event to expect next.
+        return self._changelog.version_message( event_sequence )
+
+    def binary_version_message( self, event_sequence ):
+        return self._changelog.binary_version_message( event_sequence )
+
+    def resync_message( self, roster_version ):
+        return self._changelog.resync_message( roster_version, len( self ) )
+
+    def binary_resync_message( self, roster_version ):
+        return self._changelog.resync_message( roster_version, len( self ), binary_encoding=True )
+
+    @property
+    def connected_members( self ):
+        # Members whose connection lives on this server process.
+        return self._members_by_connection.values()
+
+    @property
+    def binary_connected_members( self ):
+        # The subset of the connected members that speak the binary encoding.
+        return self._binary_members_by_connection.values()
+
+    @property
+    def unsequenced_connected_members( self ):
+        # The subset of the connected members that want their membership events one bare event per
+        # datagram.
+        return self._unsequenced_members_by_connection.values()
+
+    @property
+    def unsequenced_addresses( self ):
+        # The datagram addresses of the unsequenced connected members, which every membership event is
+        # sent to. They're listed once and the list is kept until one of those members comes or goes.
+        if self._unsequenced_addresses is None:
+            self._unsequenced_addresses = [member.datagram_address
+                for member in self._unsequenced_members_by_connection.values()]
+        return self._unsequenced_addresses
+
+    def get_by_name( self, screen_name ):
+        return self._members_by_name.get( screen_name, None )
+
+    def get_by_connection( self, conn ):
+        return self._members_by_connection.get( conn, None )
+
+    def add( self, member, conn=None ):
+        if member.screen_name in self._members_by_name:
+            raise KeyError( f"Member with screen name {member.screen_name} already registered." )
+        if conn in self._members_by_connection:
+            raise KeyError( f"Connection already registered as member {self._members_by_connection[conn].screen_name}." )
+        self._members_by_name[member.screen_name] = member
+        if conn is not None:
+            self._members_by_connection[conn] = member
+            if member.binary:
+                self._binary_members_by_connection[conn] = member
+            if not member.sequenced:
+                self._unsequenced_members_by_connection[conn] = member
+                self._unsequenced_addresses = None
+        self._roster.add( member )
+        self._changelog.record( member.screen_name, member )
+
+    def remove_by_connection( self, conn ):
+        member = self._members_by_connection.pop( conn, None )
+        if member:
+            self._binary_members_by_connection.pop( conn, None )
+            if self._unsequenced_members_by_connection.pop( conn, None ):
+                self._unsequenced_addresses = None
+            del self._members_by_name[member.screen_name]
+            self._roster.remove( member )
+            self._changelog.record( member.screen_name )
+        return member
+
+    def remove_by_name( self, screen_name ):
+        # Only meant for members owned by another worker, which have no connection to unregister.
+        member = self._members_by_name.pop( screen_name, None )
+        if member:
+            self._roster.remove( member )
+            self._changelog.record( screen_name )
+        return member
+
+class RoomDirectory:
+    # Members pick the room they chat in when they say hello, and only ever hear about the members of
+    # that room. Each room is a MemberRegistry of its own, with its own roster, roster version, and
+    # event stream, and screen names only have to be unique within a room. That keeps the cost of
+    # fanning out a membership event proportional to the size of the room rather than the server.
+    #
+    # Rooms come into being with their first member and are dropped along with their last one.
+    def __init__( self, changelog_size=DEFAULT_ROSTER_CHANGELOG_SIZE ):
+        self._changelog_size = changelog_size
+        self._rooms = {}
+        self._rooms_by_connection = {}
+        self._rooms_by_address = {}
+
+    def __len__( self ):
+        return len( self._rooms )
+
+    def __iter__( self ):
+        return iter( self._rooms.values() )
+
+    def get( self, room ):
+        return self._rooms.get( room, None )
+
+    def get_by_connection( self, conn ):
+        return self._rooms_by_connection.get( conn, None )
+
+    def get_by_datagram_address( self, address ):
+        # The room of the connected member that receives its datagrams at the given (ip address, port).
+        return self._rooms_by_address.get( address, None )
+
+    def add( self, room, member, conn=None ):
+        members = self._rooms.get( room )
+        if members is None:
+            members = MemberRegistry( self._changelog_size, room )
+        members.add( member, conn )
+        self._rooms[room] = members
+        if conn is not None:
+            self._rooms_by_connection[conn] = members
+            self._rooms_by_address[member.datagram_address] = members
+        return members
+
+    def remove_by_connection( self, conn ):
+        # Returns the room the connection's member was in and the member, or (None, None).
+        members = self._rooms_by_connection.pop( conn, None )
+        if members is None:
+            return None, None
+        member = members.remove_by_connection( conn )
+        if self._rooms_by_address.get( member.datagram_address ) is members:
+            del self._rooms_by_address[member.datagram_address]
+        self._drop_if_empty( members )
+        return members, member
+
+    def remove_by_name( self, room, screen_name ):
+        # Only meant for members owned by another worker, which have no connection to unregister.
+        members = self._rooms.get( room )
+        if members is None:
+            return None
+        member = members.remove_by_name( screen_name )
+        self._drop_if_empty( members )
+        return member
+
+    def _drop_if_empty( self, members ):
+        if not len( members ) and self._rooms.get( members.name ) is members:
+            del self._rooms[members.name]
+
+class WriteLimits:
+    # Flow control settings for member connections. Once a connection has more than high_water bytes
+    # waiting to go out, it stops accepting writes until it drains below low_water. Messages written
+    # in the meantime are handled according to the slow consumer policy:
+    #
+    #   defer       Hold on to them until the connection drains, but disconnect the member if more
+    #               than max_buffered bytes pile up.
+    #   drop        Discard them.
+    #   disconnect  Drop the connection right away.
+    #
+    # Regardless of the policy, a connection that stays blocked for stall_timeout seconds is dropped.
+    def __init__( self, high_water=64 * 1024, low_water=16 * 1024, max_buffered=4 * 1024 * 1024,
+        policy="defer", stall_timeout=30.0 ):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError( f"Unknown slow consumer policy {policy}." )
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_buffered = max_buffered
+        self.policy = policy
+        self.stall_timeout = stall_timeout
+
+class TimerWheel:
+    # Hashed timer wheel for large numbers of coarse timeouts. Time is divided into ticks, and each
+    # timer lives in the slot its deadline tick hashes to, so scheduling and cancelling a timer are
+    # O(1) and the wheel only needs one event loop timer of its own no matter how many timers it
+    # holds. Deadlines further out than one revolution of the wheel share a slot with earlier ones and
+    # are simply skipped until their tick comes around.
+    #
+    # Timers are keyed by any hashable object, and the expired callback is called with the key of each
+    # timer that goes off.
+    def __init__( self, expired, tick=IDLE_TIMER_TICK, slot_count=256 ):
+        self._expired = expired
+        self._tick = tick
+        self._slots = [{} for _ in range( slot_count )]
+        self._slot_indices = {}
+        self._current_tick = 0
+        self._loop = None
+        self._start_time = None
+        self._handle = None
+
+    @property
+    def tick( self ):
+        return self._tick
+
+    @property
+    def current_tick( self ):
+        return self._current_tick
+
+    def start( self, loop ):
+        self._loop = loop
+        self._start_time = loop.time()
+        self._schedule_advance()
+
+    def stop( self ):
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+    def schedule( self, key, ticks ):
+        # Arms (or rearms) the timer for key to go off the given number of ticks from now.
+        self.cancel( key )
+        deadline = self._current_tick + max( 1, ticks )
+        slot_index = deadline % len( self._slots )
+        self._slots[slot_index][key] = deadline
+        self._slot_indices[key] = slot_index
+
+    def cancel( self, key ):
+        slot_index = self._slot_indices.pop( key, None )
+        if slot_index is not None:
+            del self._slots[slot_index][key]
+
+    def _schedule_advance( self ):
+        self._handle = self._loop.call_at( self._start_time + (self._current_tick + 1) * self._tick, self._advance )
+
+    def _advance( self ):
+        # Catch up on every tick that has passed, in case the event loop was held up for a while.
+        target_tick = int( (self._loop.time() - self._start_time) / self._tick )
+        while self._current_tick < target_tick:
+            self._current_tick += 1
+            slot = self._slots[self._current_tick % len( self._slots )]
+            expired = [key for key, deadline in slot.items() if deadline <= self._current_tick]
+            for key in expired:
+                del slot[key]
+                del self._slot_indices[key]
+            for key in expired:
+                self._expired( key )
+        self._schedule_advance()
+
+class AdmissionControl:
+    # Keeps storms of HELOs from starving the event loop and making every member wait. Each source IP
+    # address has a token bucket that refills at source_rate HELOs per second, holding at most
+    # source_burst of them, and a HELO from a source whose bucket is empty is rejected on the spot.
+    # That stops a client reconnecting in a tight loop. HELOs that get past their source's bucket
+    # draw on a global budget of accept_rate accepts per second (at most accept_burst at once). Once
+    # the budget is spent, HELOs wait in line for it to refill, which spreads a thundering herd (e.g.,
+    # everybody reconnecting after an outage) out over time. When max_deferred HELOs are already
+    # waiting, any more are rejected.
+    #
+    # Either rate may be zero to turn that check off. HELOs are checked before they are parsed, and a
+    # source that repeats its HELO while waiting keeps its place in line rather than taking another.
+    def __init__( self, source_rate=0.0, source_burst=5, accept_rate=0.0, accept_burst=100, max_deferred=1000 ):
+        self._source_rate = source_rate
+        self._source_burst = max( source_burst, 1 )
+        self._accept_rate = accept_rate
+        self._accept_burst = max( accept_burst, 1 )
+        self._max_deferred = max_deferred
+        self._loop = None
+
+        # (tokens, time last refilled) for every source that has sent a HELO recently.
+        self._sources = {}
+
+        self._budget = self._accept_burst
+        self._budget_time = 0.0
+        self._deferred = {}
+        self._drain_handle = None
+        self._report_handle = None
+
+        self.admitted = 0
+        self.deferred = 0
+        self.source_rejected = 0
+        self.budget_rejected = 0
+        self._reported = None
+
+    @property
+    def enabled( self ):
+        return bool( self._source_rate or self._accept_rate )
+
+    def start( self, loop ):
+        self._loop = loop
+        self._budget_time = loop.time()
+        self._report_handle = loop.call_later( ADMISSION_REPORT_INTERVAL, self._report )
+
+    def stop( self ):
+        for handle in (self._drain_handle, self._report_handle):
+            if handle:
+                handle.cancel()
+        self._drain_handle = self._report_handle = None
+        self._deferred.clear()
+        self._log_counters()
+
+    def admit( self, source_ip, key, handle, reject ):
+        # Returns True if the HELO should be handled right away. Otherwise it has either been deferred,
+        # and handle will be called once the accept budget allows, or rejected with a call to reject,
+        # which is passed the reason to give the member. key identifies whoever sent the HELO (a
+        # connection or a datagram address).
+        now = self._loop.time()
+        if self._source_rate and not self._take_source_token( source_ip, now ):
+            self.source_rejected += 1
+            reject( "RATE" )
+            return False
+
+        if not self._accept_rate:
+            self.admitted += 1
+            return True
+
+        self._refill_budget( now )
+        if key in self._deferred:
+            self._deferred[key] = handle
+            return False
+        elif not self._deferred and self._budget >= 1:
+            self._budget -= 1
+            self.admitted += 1
+            return True
+        elif len( self._deferred ) >= self._max_deferred:
+            self.budget_rejected += 1
+            reject( "BUSY" )
+            return False
+
+        self.deferred += 1
+        self._deferred[key] = handle
+        self._schedule_drain()
+        return False
+
+    def cancel( self, key ):
+        # Gives up the place in line of a deferred HELO whose sender has gone away.
+        self._deferred.pop( key, None )
+
+    def _take_source_token( self, source_ip, now ):
+        tokens, refilled = self._sources.get( source_ip, (self._source_burst, now) )
+        tokens = min( self._source_burst, tokens + (now - refilled) * self._source_rate )
+        if tokens < 1:
+            self._sources[source_ip] = (tokens, now)
+            return False
+        self._sources[source_ip] = (tokens - 1, now)
+        return True
+
+    def _refill_budget( self, now ):
+        self._budget = min( self._accept_burst, self._budget + (now - self._budget_time) * self._accept_rate )
+        self._budget_time = now
+
+    def _schedule_drain( self ):
+        if self._deferred and not self._drain_handle:
+            delay = max( 0.0, (1 - self._budget) / self._accept_rate )
+            self._drain_handle = self._loop.call_later( delay, self._drain )
+
+    def _drain( self ):
+        self._drain_handle = None
+        self._refill_budget( self._loop.time() )
+        while self._deferred and self._budget >= 1:
+            self._budget -= 1
+            self.admitted += 1
+            key = next( iter( self._deferred ) )
+            self._deferred.pop( key )()
+        self._schedule_drain()
+
+    def _report( self ):
+        # Sources whose buckets have refilled all the way are indistinguishable from ones never seen,
+        # so forget them to keep the table from growing without bound.
+        now = self._loop.time()
+        self._sources = {source_ip: (tokens, refilled) for source_ip, (tokens, refilled) in self._sources.items()
+            if tokens + (now - refilled) * self._source_rate < self._source_burst}
+        self._log_counters()
+        self._report_handle = self._loop.call_later( ADMISSION_REPORT_INTERVAL, self._report )
+
+    def _log_counters( self ):
+        counters = (self.admitted, self.deferred, self.source_rejected, self.budget_rejected)
+        if counters != self._reported:
+            self._reported = counters
+            logging.info( f"Admission control: {self.admitted} HELOs admitted, {self.deferred} deferred "
+                f"({len( self._deferred )} waiting), {self.source_rejected} rejected over their source's rate, "
+                f"{self.budget_rejected} rejected with the accept budget spent." )
+
+class MemberConnection( LineProtocol ):
+    # Members only ever send the server short HELO and EXIT messages, and chat messages for it to relay,
+    # so anything longer than this is treated as a misbehaving peer.
+    MAX_FRAME_SIZE = 16 * 1024
+
+    def __init__( self, server, write_limits=None ):
+        super().__init__( max_frame_size=MemberConnection.MAX_FRAME_SIZE, allow_binary_frames=True )
         self._server = weakref.proxy( server )
+        self._write_limits = write_limits or WriteLimits()
         self._transport = None
         self._transport_closed = None
-        self._message_chunks = []
+
+        # Timer wheel tick this connection last heard from its peer on, for idle reaping.
+        self.last_active_tick = 0
+
+        # Set between pause_writing and resume_writing, while the peer isn't keeping up.
+        self._writing_paused = False
+        self._stall_timer = None
+        self._deferred = []
+        self._deferred_bytes = 0
 
     @property
     def address( self ):
@@ -57,144 +785,880 @@ class MemberConnection( asyncio.Protocol ):
     def peer( self ):
         return self._transport.get_extra_info( "peername" ) if self._transport else None
 
+    @property
+    def binary( self ):
+        # Set once the peer opens with a binary HELO, after which we answer in binary too.
+        return self.binary_frames
+
+    @property
+    def buffered_bytes( self ):
+        # Bytes written to this connection that haven't been handed to the kernel yet.
+        if not self._transport:
+            return 0
+        return self._transport.get_write_buffer_size() + self._deferred_bytes
+
     def disconnect( self ):
         if self._transport:
             logging.info( f"Closing connection to peer {self.peer}." )
             self._transport.close()
             return self._transport_closed
 
-    def send_accept( self, members ):
+    def abort( self ):
+        # Unlike disconnect, this doesn't wait for buffered data to be flushed, which could take
+        # forever for a peer that has stopped reading.
         if self._transport:
-            message = f"ACPT {':'.join( f'{member.screen_name} {member.ip_address} {member.port}' for member in members)}\n"
-            logging.info( f"Sending ACPT message to peer {self.peer}: {message.rstrip()}" )
-            self._transport.write( message.encode() )
+            logging.info( f"Aborting connection to peer {self.peer}." )
+            self._transport.abort()
+            return self._transport_closed
+
+    def send_accept( self, members, multicast_group=None, roster_version=None, event_sequence=0, relay_chat=False ):
+        if self._transport:
+            # Members only hand the server their chat messages once it says it relays them, so that
+            # one asking a server that doesn't relay still reaches the rest of its room directly.
+            if relay_chat:
+                self._write( binary.encode_frame( binary.RLAY ) if self.binary else b"RLAY\n" )
+
+            # When membership events are multicast, tell the new member which group to listen on
+            # before handing it the roster.
+            if multicast_group:
+                if self.binary:
+                    self._write( binary.encode_multicast_group( *multicast_group ) )
+                else:
+                    self._write( f"MCST {multicast_group[0]} {multicast_group[1]}\n".encode() )
+
+            # The roster version goes first so the member knows what the roster that follows is
+            # current as of. A member that still has an earlier version of the roster is only sent
+            # what changed since then, if the changelog goes back far enough.
+            self._write( members.binary_version_message( event_sequence ) if self.binary else members.version_message( event_sequence ) )
+            if roster_version:
+                resync_message = members.binary_resync_message( roster_version ) if self.binary else members.resync_message( roster_version )
+                if resync_message:
+                    logging.info( f"Sending RSYN message to peer {self.peer} with {len( resync_message )} bytes of changes." )
+                    self._write( resync_message )
+                    return
+
+            # Only log the roster size. Logging the roster itself would format every member on every
+            # accept, which is exactly the work the encoded roster is meant to avoid.
+            logging.info( f"Sending ACPT message to peer {self.peer} with {len( members )} members." )
+            self._write( members.binary_accept_message if self.binary else members.accept_message )
 
-    def send_reject( self, screen_name ):
+    def send_reject( self, screen_name, reason=None ):
         if self._transport:
-            message = f"RJCT {screen_name}\n"
+            message = f"RJCT {screen_name} {reason}\n" if reason else f"RJCT {screen_name}\n"
             logging.info( f"Sending RJCT message to peer {self.peer}: {message.rstrip()}" )
-            self._transport.write( message.encode() )
+            if self.binary:
+                self._write( binary.encode_reject( screen_name, reason ) )
+            else:
+                self._write( message.encode() )
+
+    def send_event_sequence( self, next_sequence ):
+        # Answers a heartbeat with the number of the next membership event, so the member can tell if
+        # it missed the last events sent.
+        if self._transport:
+            self._write( binary.encode_sequence( next_sequence ) if self.binary else f"SEQN {next_sequence}\n".encode() )
 
     def connection_made( self, transport ):
         self._transport = transport
         self._transport_closed = asyncio.get_event_loop().create_future()
+        transport.set_write_buffer_limits( high=self._write_limits.high_water, low=self._write_limits.low_water )
         logging.info( f"Connection established with peer {self.peer}." )
         self._server.register_connection( self )
 
     def connection_lost( self, ex ):
         logging.info( f"Connection closed to peer {self.peer}." )
         self._server.unregister_connection( self )
+        self._cancel_stall_timer()
+        self._deferred.clear()
+        self._deferred_bytes = 0
         self._transport_closed.set_result( None )
         self._transport = None
         self._transport_closed = None
 
-    def data_received( self, data ):
-        for message in self._feed_data( data ):
-            logging.info( f"Received new message: {message}" )
-            message = parse_message( message )
-            if message:
-                self._server.handle_message( message, self )
+    def pause_writing( self ):
+        self._writing_paused = True
+        if self._write_limits.stall_timeout:
+            self._stall_timer = asyncio.get_event_loop().call_later( self._write_limits.stall_timeout,
+                self._writing_stalled )
 
-    def _feed_data( self, data ):
-        # We keep feeding chunks until one contains at least one newline character. The presence of
-        # a newline indicates that at least one complete message has arrived. In this case, we want
-        # to find the last newline in the current chunk and preserve everything after it as the
-        # start of the next message that has yet to be completed.
-        #
-        # For everything before the last newline, this gets concatenated with the other message
-        # chunks previously stored. The concatenated string is then split across newline boundaries
-        # (since it may be the rare case there are mutliple messages buffered up), and each portion
-        # corresponds to a protocol message that needs parsing.
-        #
-        chunk = data.decode()
-        left_chunk, newline, right_chunk = chunk.rpartition( "\n" )
-
-        if newline:
-            # There was a newline in the latest chunk. The one we partitioned on is either at the
-            # beginning of our chunk (in which case left_chunk is empty), it's at the end of our
-            # chunk (in which case right_chunk is empty), or it's somewhere in the middle.
-
-            if left_chunk:
-                # There is content prior to the newline we partitioned on. The preceding content
-                # needs to be appened to the list of chunks that will be concatenated and parsed.
-                self._message_chunks.append( left_chunk )
-
-            # Concatenate all of our message chunks into one large string. Split the string on
-            # message boundaries (newlines) and yield each message found.
-            for message in "".join( self._message_chunks ).split( "\n" ):
-                yield message
-
-            # Discard the chunks we've exhausted in terms of messages that can be parsed.
-            self._message_chunks = []
-
-            if right_chunk:
-                # There is content following the newline we partitioned on. This content forms the
-                # first chunk save in the new set of message chunks.
-                self._message_chunks.append( right_chunk )
+    def resume_writing( self ):
+        self._writing_paused = False
+        self._cancel_stall_timer()
+
+        if self._deferred:
+            deferred = b"".join( self._deferred )
+            self._deferred.clear()
+            self._deferred_bytes = 0
+            self._transport.write( deferred )
+
+    def message_received( self, message ):
+        logging.info( f"Received new message: {message}" )
+        if message.startswith( "HELO " ) and not self._server.admit_hello( self, self.peer[0], message ):
+            return
+        message = parse_message( message )
+        if message:
+            self._server.handle_message( message, self )
+
+    def binary_frame_received( self, message_type, body ):
+        logging.info( f"Received new binary {binary.MESSAGE_TYPES.get( message_type, message_type )} message." )
+        if message_type == binary.HELO and not self._server.admit_hello( self, self.peer[0], body, binary_encoding=True ):
+            return
+        message = parse_binary_message( message_type, body )
+        if message:
+            self._server.handle_message( message, self )
+
+    def frame_too_large( self ):
+        logging.warning( f"Peer {self.peer} sent a message larger than {MemberConnection.MAX_FRAME_SIZE} bytes." )
+        self.disconnect()
+
+    def _write( self, data ):
+        # Every message to the member goes through here, so a member that stops reading can't make
+        # the server buffer data for it without bound.
+        if not self._writing_paused:
+            self._transport.write( data )
+            return
+
+        policy = self._write_limits.policy
+        if policy == "drop":
+            logging.warning( f"Dropping {len( data )} byte message to slow peer {self.peer}." )
+        elif policy == "disconnect":
+            logging.warning( f"Disconnecting slow peer {self.peer} with {self.buffered_bytes} bytes buffered." )
+            self.abort()
+        elif self.buffered_bytes + len( data ) > self._write_limits.max_buffered:
+            logging.warning( f"Disconnecting slow peer {self.peer} after exceeding "
+                f"{self._write_limits.max_buffered} buffered bytes." )
+            self.abort()
         else:
-            # There was no newline in the current chunk. Add it to our list of message chunks.
-            self._message_chunks.append( chunk )
+            self._deferred.append( data )
+            self._deferred_bytes += len( data )
+
+    def _writing_stalled( self ):
+        self._stall_timer = None
+        logging.warning( f"Disconnecting peer {self.peer} after its connection was blocked for "
+            f"{self._write_limits.stall_timeout} seconds with {self.buffered_bytes} bytes buffered." )
+        self.abort()
+
+    def _cancel_stall_timer( self ):
+        if self._stall_timer:
+            self._stall_timer.cancel()
+            self._stall_timer = None
+
+class DatagramMember:
+    # Stands in for a MemberConnection when a member joined over the datagram channel instead of
+    # holding a TCP connection open. Membership is then soft state: the member is identified by the
+    # address its datagrams come from, and it is forgotten once it leaves, is rejected, or stops
+    # refreshing its membership with PING messages for longer than the idle timeout.
+    def __init__( self, server, datagram_channel, peer, binary=False ):
+        self._server = weakref.proxy( server )
+        self._datagram_channel = datagram_channel
+        self.peer = peer
+        self.binary = binary
+        self.last_active_tick = 0
+
+    @property
+    def address( self ):
+        return self.peer
+
+    def disconnect( self ):
+        logging.info( f"Forgetting datagram member {self.peer}." )
+        self._server.unregister_datagram_member( self )
+
+    def abort( self ):
+        self.disconnect()
+
+    def send_accept( self, members, multicast_group=None, roster_version=None, event_sequence=0, relay_chat=False ):
+        # Changes are only sent in place of the roster when they fit in a single datagram. Anything
+        # bigger gets the roster split across ACPT and ROST datagrams as usual.
+        if relay_chat:
+            self._datagram_channel.send_to( binary.encode_frame( binary.RLAY ) if self.binary else b"RLAY\n", self.peer )
+        version_message = members.binary_version_message( event_sequence ) if self.binary else members.version_message( event_sequence )
+        if roster_version:
+            resync_message = members.binary_resync_message( roster_version ) if self.binary else members.resync_message( roster_version )
+            if resync_message and len( resync_message ) <= DatagramChannel.MAX_EVENT_BATCH_BYTES:
+                logging.info( f"Sending RSYN datagram to peer {self.peer} with {len( resync_message )} bytes of changes." )
+                if multicast_group:
+                    self._datagram_channel.send_multicast_group( multicast_group, self.peer, self.binary )
+                self._datagram_channel.send_to( version_message, self.peer )
+                self._datagram_channel.send_to( resync_message, self.peer )
+                return
+
+        logging.info( f"Sending ACPT datagrams to peer {self.peer} with {len( members )} members." )
+        if self.binary:
+            self._datagram_channel.send_binary_accept( members.binary_accept_message, version_message, self.peer, multicast_group )
+        else:
+            self._datagram_channel.send_accept( members.accept_message, version_message, self.peer, multicast_group )
+
+    def send_event_sequence( self, next_sequence ):
+        data = binary.encode_sequence( next_sequence ) if self.binary else f"SEQN {next_sequence}\n".encode()
+        self._datagram_channel.send_to( data, self.peer )
+
+    def send_reject( self, screen_name, reason=None ):
+        message = f"RJCT {screen_name} {reason}\n" if reason else f"RJCT {screen_name}\n"
+        logging.info( f"Sending RJCT datagram to peer {self.peer}: {message.rstrip()}" )
+        if self.binary:
+            self._datagram_channel.send_to( binary.encode_reject( screen_name, reason ), self.peer )
+        else:
+            self._datagram_channel.send_to( message.encode(), self.peer )
+
+class MulticastListener( asyncio.DatagramProtocol ):
+    # Receives the datagrams members send to the multicast group and hands them to the datagram
+    # channel.
+    def __init__( self, datagram_channel ):
+        self._datagram_channel = weakref.proxy( datagram_channel )
+
+    def datagram_received( self, data, addr ):
+        self._datagram_channel.group_datagram_received( data, addr )
 
 class DatagramChannel( asyncio.DatagramProtocol ):
-    def __init__( self ):
+    # Largest datagram a batch of membership events is packed into. This keeps event batches within a
+    # typical Ethernet MTU so they aren't fragmented.
+    MAX_EVENT_BATCH_BYTES = 1400
+
+    # Receive buffer size requested for the channel, which members send repair requests (and with UDP
+    # membership, their membership messages) to.
+    RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+    # Number of recent membership events kept around to resend to members that missed them.
+    EVENT_HISTORY_SIZE = 4096
+
+    # Most events resent for a single repair request, so that one small request can't turn into an
+    # outsized burst of datagrams.
+    MAX_REPAIR_EVENTS = 256
+
+    # Size of the binary SEQN frame that starts each datagram of binary membership events.
+    BINARY_SEQUENCE_HEADER_SIZE = binary.FRAME_HEADER.size + binary.SEQUENCE.size
+
+    def __init__( self, event_batch_window=0.0, event_batch_size=1, multicast_group=None,
+        multicast_interface=None, multicast_ttl=1 ):
         self._transport = None
         self._transport_closed = None
+        self._batch_sender = None
+        self._batch_receiver = None
+
+        # When a multicast group is given, membership events are sent once to the group instead of to
+        # every member individually.
+        self._multicast_group = multicast_group
+        self._multicast_interface = multicast_interface
+        self._multicast_ttl = multicast_ttl
+        self._multicast_transport = None
+
+        # When the event batch window is nonzero, JOIN and EXIT events are held for up to that many
+        # seconds (or until event_batch_size of them are pending) and then sent to each member as a
+        # single datagram with one newline terminated event per line.
+        self._event_batch_window = event_batch_window
+        self._event_batch_size = max( event_batch_size, 1 )
+
+        # Rooms with events waiting to be batched, each of which keeps its pending events in its own
+        # event stream.
+        self._batching_rooms = {}
 
-    async def open( self ):
+        # Called with each message (and the address it came from) that members send to the channel
+        # when they are allowed to join over UDP. HELOs are first run past hello_filter, unparsed, and
+        # dropped unless it says to handle them.
+        self._message_handler = None
+        self._hello_filter = None
+
+        # Called with each chat message (and the address it came from) that members send to the
+        # multicast group.
+        self._group_message_handler = None
+
+    async def open( self, port=None, message_handler=None, hello_filter=None, group_message_handler=None ):
         logging.info( "Opening datagram channel." )
         loop = asyncio.get_running_loop()
+        self._message_handler = message_handler
+        self._hello_filter = hello_filter
+        self._group_message_handler = group_message_handler
         self._transport_closed = loop.create_future()
-        self._transport, _ = await loop.create_datagram_endpoint( lambda: self, local_addr=("0.0.0.0", None) )
-        logging.info( "Datagram channel opened." )
+        self._transport, _ = await loop.create_datagram_endpoint( lambda: self, local_addr=("0.0.0.0", port) )
+        self._batch_sender = BatchSender( self._transport )
+        self._batch_receiver = BatchReceiver( self._transport, self.datagrams_received )
+        self._batch_receiver.start( loop )
+
+        if message_handler:
+            # Members joining over UDP send their HELOs in bursts, as do members asking for events
+            # lost in the same outage, and any that overflow the receive buffer are lost until the
+            # member retries. The kernel caps this at its own maximum.
+            sock = self._transport.get_extra_info( "socket" )
+            sock.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, DatagramChannel.RECEIVE_BUFFER_SIZE )
+
+        if self._multicast_group:
+            sock = self._transport.get_extra_info( "socket" )
+            sock.setsockopt( socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self._multicast_ttl )
+            sock.setsockopt( socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1 )
+            if self._multicast_interface:
+                sock.setsockopt( socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton( self._multicast_interface ) )
+            logging.info( f"Membership events will be multicast to {self._multicast_group}." )
+
+            if group_message_handler:
+                await self._join_multicast_group( loop )
+
+        logging.info( f"Datagram channel opened. Batched sends {'enabled' if self._batch_sender.batched else 'disabled'}, "
+            f"batched receives {'enabled' if self._batch_receiver.batched else 'disabled'}." )
+
+    @property
+    def multicast_group( self ):
+        return self._multicast_group
+
+    def multicast_group_for( self, room ):
+        # There's just the one multicast group, so only the default room's events go out over it. The
+        # members of any other room are sent their events individually.
+        return self._multicast_group if room.name == DEFAULT_ROOM else None
+
+    def event_sequence( self, room ):
+        # Sequence number of the last membership event sent out to the room. A member accepted now
+        # receives every event after it, including any still waiting to be batched.
+        return room.events.sent_sequence
 
     async def close( self ):
         if self._transport:
             logging.info( "Closing datagram channel." )
+            for room in list( self._batching_rooms ):
+                self._flush_events( room )
+            if self._multicast_transport:
+                self._multicast_transport.close()
+                self._multicast_transport = None
             self._transport.close()
             return self._transport_closed
 
-    def send_join( self, new_member, members ):
-        message = f"JOIN {new_member.screen_name} {new_member.ip_address} {new_member.port}\n"
-        data = message.encode()
-        for member in members:
-            logging.info( f"Sending JOIN message to peer ({member.ip_address}, {member.port}): {message.rstrip()}" )
-            self._send_datagram( data, member )
+    async def _join_multicast_group( self, loop ):
+        # Members that never join the group (older clients) can't hear the chat messages the rest of
+        # their room multicasts, so the server listens in and passes those on. Like the members, the
+        # server joins the group on the interface its multicast traffic goes out on.
+        group, port = self._multicast_group
+        sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        if hasattr( socket, "SO_REUSEPORT" ):
+            sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEPORT, 1 )
+        sock.bind( ("", port) )
+        sock.setsockopt( socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+            socket.inet_aton( group ) + socket.inet_aton( self._multicast_interface or "0.0.0.0" ) )
+        self._multicast_transport, _ = await loop.create_datagram_endpoint( lambda: MulticastListener( self ),
+            sock=sock )
+
+    def send_join( self, new_member, room ):
+        # Members that speak the binary encoding (a subset of the room's members) are sent the event
+        # in binary and everybody else in text.
+        event = self._number_event( room.events, b"JOIN " + new_member.roster_entry + b"\n",
+            binary.encode_frame( binary.JOIN, new_member.binary_roster_entry ) )
+        if self._event_batch_window:
+            self._queue_event( room, event )
+        else:
+            logging.info( f"Sending JOIN message to {len( room.connected_members )} peers in room {room.name}: "
+                f"JOIN {new_member.screen_name}" )
+            self._send_events( room, [event] )
 
-    def send_exit( self, departing_member, members ):
+    def send_exit( self, departing_member, room ):
         message = f"EXIT {departing_member.screen_name}\n"
-        data = message.encode()
-        for member in members:
-            logging.info( f"Sending EXIT message to peer ({member.ip_address}, {member.port}): {message.rstrip()}" )
-            self._send_datagram( data, member )
+        event = self._number_event( room.events, message.encode(),
+            binary.encode_exit( departing_member.screen_name ) )
+        if self._event_batch_window:
+            self._queue_event( room, event )
+        else:
+            logging.info( f"Sending EXIT message to {len( room.connected_members )} peers in room {room.name}: "
+                f"{message.rstrip()}" )
+            self._send_events( room, [event] )
+
+    def send_message( self, room, sender, data, binary_data ):
+        # Relays a chat message to every member of the room on this server but its sender, the same
+        # way membership events are fanned out.
+        logging.info( f"Relaying chat message from {sender.screen_name} to {len( room.connected_members )} peers "
+            f"in room {room.name}." )
+        self._send_datagrams( data, binary_data, room, sender )
+
+    def send_group_message( self, room, sender, data ):
+        # Passes a chat message its sender multicast to the room on to the members that aren't in the
+        # multicast group.
+        if self._transport:
+            self._send_unsequenced( data, room, sender )
+
+    def resend_events( self, room, first, last, address, binary_encoding=False ):
+        # Answers a member's repair request with whichever of the requested events are still in the
+        # room's history. Events that haven't been sent yet can't have been missed.
+        history = room.events.history
+        if not self._transport or not history:
+            return
+
+        oldest = history[0][0]
+        first = max( first, oldest )
+        last = min( last, room.events.sent_sequence, first + DatagramChannel.MAX_REPAIR_EVENTS - 1 )
+        if first > last:
+            return
+
+        events = list( itertools.islice( history, first - oldest, last - oldest + 1 ) )
+        logging.info( f"Resending membership events {first} through {last} of room {room.name} to peer {address}." )
+        for data, binary_data in self._pack_events( events, DatagramChannel.MAX_REPAIR_EVENTS ):
+            self._transport.sendto( binary_data if binary_encoding else data, address )
+
+    def send_to( self, data, address ):
+        if self._transport:
+            self._transport.sendto( data, address )
+
+    def send_multicast_group( self, multicast_group, address, binary_encoding=False ):
+        if self._transport:
+            if binary_encoding:
+                self._transport.sendto( binary.encode_multicast_group( *multicast_group ), address )
+            else:
+                self._transport.sendto( f"MCST {multicast_group[0]} {multicast_group[1]}\n".encode(), address )
+
+    def send_accept( self, accept_message, version_message, address, multicast_group=None ):
+        # An ACPT for anything but a small roster won't fit in one datagram, so the roster is split
+        # between members into datagrams of at most MAX_EVENT_BATCH_BYTES. The first one is an
+        # ordinary ACPT message, and the rest of the roster follows in ROST messages that carry more
+        # members in the same format.
+        if not self._transport:
+            return
+
+        if multicast_group:
+            self.send_multicast_group( multicast_group, address )
+        self._transport.sendto( version_message, address )
+
+        prefix = EncodedRoster.PREFIX
+        start = len( prefix )
+        end = len( accept_message ) - 1
+        limit = DatagramChannel.MAX_EVENT_BATCH_BYTES - len( prefix ) - 1
+        while True:
+            chunk_end = end
+            if end - start > limit:
+                chunk_end = accept_message.rfind( b":", start, start + limit )
+                if chunk_end < 0:
+                    # A single roster entry longer than the limit. Send it whole.
+                    chunk_end = accept_message.find( b":", start, end )
+                    if chunk_end < 0:
+                        chunk_end = end
+            self._transport.sendto( b"".join( (prefix, accept_message[start:chunk_end], b"\n") ), address )
+
+            if chunk_end >= end:
+                break
+            start = chunk_end + 1
+            prefix = b"ROST "
+
+    def send_binary_accept( self, accept_message, version_message, address, multicast_group=None ):
+        # The binary counterpart of send_accept. The roster's member entries are split across an ACPT
+        # frame and as many ROST frames as it takes, each in its own datagram.
+        if not self._transport:
+            return
+
+        if multicast_group:
+            self.send_multicast_group( multicast_group, address, binary_encoding=True )
+        self._transport.sendto( version_message, address )
+
+        message_type = binary.ACPT
+        start = binary.FRAME_HEADER.size
+        end = start
+        limit = DatagramChannel.MAX_EVENT_BATCH_BYTES - binary.FRAME_HEADER.size
+        while True:
+            # Each entry is a fixed size address followed by a length prefixed screen name.
+            while end < len( accept_message ):
+                entry_end = end + binary.MEMBER_ADDRESS.size + 1 + accept_message[end + binary.MEMBER_ADDRESS.size]
+                if entry_end - start > limit and end > start:
+                    break
+                end = entry_end
+            self._transport.sendto( binary.encode_frame( message_type, accept_message[start:end] ), address )
+
+            if end >= len( accept_message ):
+                break
+            start = end
+            message_type = binary.ROST
+
+    def datagram_received( self, data, addr ):
+        if not self._message_handler:
+            return
+
+        if binary.is_binary( data ):
+            try:
+                frames = list( binary.split_frames( data ) )
+            except ValueError:
+                return
+            for message_type, body in frames:
+                if message_type == binary.HELO and self._hello_filter and not self._hello_filter( addr, body, True ):
+                    continue
+                message = parse_binary_message( message_type, body )
+                if message:
+                    logging.info( f"Received binary {binary.MESSAGE_TYPES[message_type]} datagram message from {addr}." )
+                    self._message_handler( message, addr )
+            return
+
+        try:
+            messages = data.decode().split( "\n" )
+        except UnicodeDecodeError:
+            return
+
+        for message in messages:
+            if message:
+                logging.info( f"Received datagram message from {addr}: {message}" )
+                if message.startswith( "HELO " ) and self._hello_filter and not self._hello_filter( addr, message, False ):
+                    continue
+                message = parse_message( message )
+                if message:
+                    self._message_handler( message, addr )
+
+    def group_datagram_received( self, data, addr ):
+        # The group carries our own membership events too. Chat messages are only ever multicast as
+        # text, one per datagram.
+        if self._group_message_handler and data.startswith( b"MESG " ):
+            try:
+                message = parse_message( data.decode().rstrip( "\n" ) )
+            except UnicodeDecodeError:
+                return
+            if message:
+                self._group_message_handler( message, addr )
+
+    def datagrams_received( self, datagrams ):
+        # A datagram that can't be handled is dropped on its own, and the rest of the batch still goes
+        # through.
+        for data, addr in datagrams:
+            try:
+                self.datagram_received( data, addr )
+            except Exception:
+                logging.exception( f"Dropping datagram from {addr} that could not be handled." )
 
     def connection_lost( self, ex ):
         logging.info( "Datagram channel closed." )
+        self._batch_receiver.stop()
         self._transport_closed.set_result( None )
         self._transport = None
         self._transport_closed = None
 
-    def _send_datagram( self, data, member ):
-        if self._transport:
-            self._transport.sendto( data, (member.ip_address, member.port) )
+    def _send_datagrams( self, data, binary_data, room, excluded=None, sequenced=False ):
+        # Sequenced datagrams aren't sent to the members that didn't ask for them, which are sent
+        # their events separately.
+        if not self._transport:
+            return
+
+        members = room.connected_members
+        binary_members = room.binary_connected_members
+        unsequenced = sequenced and room.unsequenced_connected_members
+        if self.multicast_group_for( room ):
+            # Binary members understand text too, so one text datagram still reaches everybody in the
+            # group. That includes any excluded member, which has to ignore it on its own. Members
+            # that didn't ask for sequenced events are older clients that never join the group, so
+            # anything but sequenced events is sent to them individually.
+            self._transport.sendto( data, self._multicast_group )
+            if not sequenced:
+                self._send_unsequenced( data, room, excluded )
+        elif not binary_members and not unsequenced:
+            # Fan the datagram out to every member in as few system calls as the platform allows.
+            self._batch_sender.send_to_many( data,
+                [member.datagram_address for member in members if member is not excluded] )
+        else:
+            self._batch_sender.send_to_many( data,
+                [member.datagram_address for member in members
+                    if not member.binary and member is not excluded and (member.sequenced or not sequenced)] )
+            self._batch_sender.send_to_many( binary_data,
+                [member.datagram_address for member in binary_members if member is not excluded] )
+
+    def _send_unsequenced( self, data, room, excluded=None ):
+        addresses = room.unsequenced_addresses
+        if excluded and not excluded.sequenced:
+            addresses = [address for address in addresses if address != excluded.datagram_address]
+        if addresses:
+            self._batch_sender.send_to_many( data, addresses )
+
+    def _number_event( self, stream, data, binary_data ):
+        stream.sequence += 1
+        event = (stream.sequence, data, binary_data)
+        stream.history.append( event )
+        return event
+
+    def _send_events( self, room, events ):
+        room.events.sent_sequence = events[-1][0]
+        if not self._transport:
+            return
+
+        for data, binary_data in self._pack_events( events, self._event_batch_size ):
+            self._send_datagrams( data, binary_data, room, sequenced=True )
+
+        # Members that didn't ask for sequenced events get each one on its own, without a SEQN. They
+        # never join the multicast group either, so they're sent their events in multicast mode too.
+        addresses = room.unsequenced_addresses
+        if addresses:
+            for _, data, _ in events:
+                self._batch_sender.send_to_many( data, addresses )
+
+    def _pack_events( self, events, batch_size ):
+        # Packs a run of consecutively numbered events into as few datagrams as the batch size and
+        # datagram size limits allow, each starting with the sequence number of its first event.
+        # Binary events are never larger than their text counterparts, so the binary datagrams are
+        # packed with the same events as the text ones. The binary SEQN header can be larger than the
+        # text one though, so the larger of the two is counted against the size limit.
+        start = 0
+        while start < len( events ):
+            sequence = events[start][0]
+            header = f"SEQN {sequence}\n".encode()
+            batch_bytes = max( len( header ), DatagramChannel.BINARY_SEQUENCE_HEADER_SIZE ) + len( events[start][1] )
+            end = start + 1
+            while (end < len( events ) and end - start < batch_size and
+                batch_bytes + len( events[end][1] ) <= DatagramChannel.MAX_EVENT_BATCH_BYTES):
+                batch_bytes += len( events[end][1] )
+                end += 1
+
+            batch = events[start:end]
+            yield (b"".join( [header] + [data for _, data, _ in batch] ),
+                b"".join( [binary.encode_sequence( sequence )] + [binary_data for _, _, binary_data in batch] ))
+            start = end
+
+    def _queue_event( self, room, event ):
+        # The recipients are whoever the room's members are when the batch is flushed, not when the
+        # event was queued.
+        stream = room.events
+        stream.pending.append( event )
+        self._batching_rooms[room] = None
+
+        if len( stream.pending ) >= self._event_batch_size:
+            self._flush_events( room )
+        elif not stream.flush_handle:
+            stream.flush_handle = asyncio.get_event_loop().call_later( self._event_batch_window, self._flush_events, room )
+
+    def flush_events( self, room ):
+        self._flush_events( room )
+
+    def _flush_events( self, room ):
+        stream = room.events
+        self._batching_rooms.pop( room, None )
+        if stream.flush_handle:
+            stream.flush_handle.cancel()
+            stream.flush_handle = None
+
+        if not stream.pending:
+            return
+
+        events, stream.pending = stream.pending, []
+        logging.info( f"Sending batch of {len( events )} membership events to {len( room.connected_members )} peers "
+            f"in room {room.name}." )
+        self._send_events( room, events )
+
+class RosterHub:
+    # Runs in the parent process when the server is sharded across worker processes. Each worker
+    # connects to the hub over a Unix socket. The hub owns the authoritative global roster: workers
+    # must claim a screen name in a room from the hub before accepting a member, and the hub relays
+    # every membership change to the other workers so they can fan it out to the members they own.
+    #
+    # Messages between the hub and workers are newline delimited text:
+    #
+    #   Worker to hub: CLAIM <request id> <room> <screen name> <ip address> <port>
+    #                  EXIT <room> <screen name>
+    #                  PART <room> <screen name>
+    #                  MESG <room> <screen name> <chat message>
+    #
+    #   Hub to worker: GRANT <request id>
+    #                  DENY <request id>
+    #                  JOIN <room> <screen name> <ip address> <port>
+    #                  EXIT <room> <screen name>
+    #                  PART <room> <screen name>
+    #                  MESG <room> <screen name> <chat message>
+    #
+    # Chat messages only pass through the hub when the server relays chat, so that each worker can
+    # relay them to the members it owns.
+    def __init__( self, sock ):
+        self._sock = sock
+        self._server = None
+        self._workers = set()
+
+        # Roster entries and the worker that owns them, keyed by b"<room> <screen name>".
+        self._roster = {}
+
+    async def run( self ):
+        self._server = await asyncio.start_unix_server( self._handle_worker, sock=self._sock )
+        logging.info( "Roster hub started." )
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle_worker( self, reader, writer ):
+        logging.info( "Worker connected to roster hub." )
+
+        # Bring the new worker up to date on everybody who joined before it connected.
+        self._workers.add( writer )
+        for entry, _ in self._roster.values():
+            writer.write( b"JOIN " + entry + b"\n" )
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self._handle_request( line.rstrip( b"\n" ), writer )
+        except ConnectionError:
+            pass
+        finally:
+            logging.info( "Worker disconnected from roster hub." )
+            self._workers.discard( writer )
+            writer.close()
+
+            # Anybody owned by the departed worker is gone too.
+            for key in [key for (key, (_, owner)) in self._roster.items() if owner is writer]:
+                del self._roster[key]
+                self._broadcast( b"PART " + key + b"\n", writer )
+
+    def _handle_request( self, line, writer ):
+        request_type, _, request_data = line.partition( b" " )
+
+        if request_type == b"CLAIM":
+            request_id, _, entry = request_data.partition( b" " )
+            key = b" ".join( entry.split( b" ", 2 )[:2] )
+            if key in self._roster:
+                writer.write( b"DENY " + request_id + b"\n" )
+            else:
+                self._roster[key] = (entry, writer)
+                writer.write( b"GRANT " + request_id + b"\n" )
+                self._broadcast( b"JOIN " + entry + b"\n", writer )
+        elif request_type in (b"EXIT", b"PART"):
+            key = request_data
+            _, owner = self._roster.get( key, (None, None) )
+            if owner is not writer:
+                return
+            if request_type == b"PART":
+                del self._roster[key]
+            self._broadcast( line + b"\n", writer )
+        elif request_type == b"MESG":
+            key = b" ".join( request_data.split( b" ", 2 )[:2] )
+            _, owner = self._roster.get( key, (None, None) )
+            if owner is writer:
+                self._broadcast( line + b"\n", writer )
+
+    def _broadcast( self, data, origin ):
+        for worker in self._workers:
+            if worker is not origin:
+                worker.write( data )
+
+class RosterLink:
+    # A worker's connection to the roster hub. Claims are answered asynchronously by the hub, so each
+    # one is tracked by a request id until the hub grants or denies it.
+    def __init__( self, server ):
+        self._server = weakref.proxy( server )
+        self._reader = None
+        self._writer = None
+        self._request_ids = itertools.count()
+        self._pending_claims = {}
+        self._read_task = None
+
+    async def open( self, path ):
+        self._reader, self._writer = await asyncio.open_unix_connection( path )
+        self._read_task = asyncio.get_running_loop().create_task( self._read_hub_messages() )
+        logging.info( "Connected to roster hub." )
+
+    async def close( self ):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        if self._read_task:
+            await self._read_task
+            self._read_task = None
+
+    async def claim( self, room, member ):
+        if not self._writer:
+            return False
+        request_id = next( self._request_ids )
+        claimed = asyncio.get_running_loop().create_future()
+        self._pending_claims[request_id] = claimed
+        self._writer.write( f"CLAIM {request_id} {room} ".encode() + member.roster_entry + b"\n" )
+        return await claimed
+
+    def publish_exit( self, room, member ):
+        self._send( f"EXIT {room} {member.screen_name}\n" )
+
+    def publish_part( self, room, member ):
+        self._send( f"PART {room} {member.screen_name}\n" )
+
+    def publish_message( self, room, member, message ):
+        self._send( f"MESG {room} {member.screen_name} {message}\n" )
+
+    def _send( self, message ):
+        if self._writer:
+            self._writer.write( message.encode() )
+
+    async def _read_hub_messages( self ):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                self._handle_hub_message( line.decode().rstrip( "\n" ) )
+        except ConnectionError:
+            pass
+        finally:
+            logging.info( "Disconnected from roster hub." )
+            for claimed in self._pending_claims.values():
+                if not claimed.done():
+                    claimed.set_result( False )
+            self._pending_claims.clear()
+
+    def _handle_hub_message( self, message ):
+        message_type, _, message_data = message.partition( " " )
+
+        if message_type in ("GRANT", "DENY"):
+            claimed = self._pending_claims.pop( int( message_data ), None )
+            if claimed and not claimed.done():
+                claimed.set_result( message_type == "GRANT" )
+        elif message_type == "JOIN":
+            room, screen_name, ip_address, port = message_data.split( " " )
+            # The hub only relays text roster entries, so members on other workers are always listed
+            # as text members, and binary peers simply talk to them in text.
+            self._server.handle_remote_join( room, Member( screen_name, ip_address, int( port ) ) )
+        elif message_type == "EXIT":
+            self._server.handle_remote_exit( *message_data.split( " " ) )
+        elif message_type == "PART":
+            self._server.handle_remote_part( *message_data.split( " " ) )
+        elif message_type == "MESG":
+            self._server.handle_remote_message( *message_data.split( " ", 2 ) )
 
 class Server:
-    def __init__( self, port ):
+    def __init__( self, port, datagram_channel=None, hub_path=None, write_limits=None, idle_timeout=0.0,
+        udp_membership=False, roster_changelog_size=DEFAULT_ROSTER_CHANGELOG_SIZE, admission=None, relay_chat=False ):
         self._port = port
+        self._write_limits = write_limits or WriteLimits()
+
+        # Whether members may send their chat messages to the server once for it to fan out to the
+        # rest of their room, rather than sending them to every member themselves.
+        self._relay_chat = relay_chat
+
+        # Rate limits on HELOs, if any, applied before they are parsed.
+        self._admission = admission if admission and admission.enabled else None
+
+        # When members may also join over UDP, the datagram channel listens on the welcome port and
+        # each such member is tracked by the address it sends from.
+        self._udp_membership = udp_membership
+        self._datagram_members = {}
+
+        # Members that stay silent for longer than the idle timeout are presumed dead and evicted.
+        # A single timer wheel tracks every connection's timeout.
+        self._idle_wheel = None
+        self._idle_timeout_ticks = 0
+        if idle_timeout > 0:
+            self._idle_wheel = TimerWheel( self._idle_timer_expired )
+            self._idle_timeout_ticks = max( 1, math.ceil( idle_timeout / self._idle_wheel.tick ) )
+        self._hub_path = hub_path
+        self._roster_link = None
         self._server = None
         self._connections = {}
-        self._datagram_channel = None
-        self._members = []
+        self._datagram_channel = datagram_channel or DatagramChannel()
+        self._rooms = RoomDirectory( roster_changelog_size )
 
     async def run( self ):
         logging.info( "Initializing server." )
 
         # Setup the datagram channel for sending JOIN and EXIT messages to clients.
-        self._datagram_channel = DatagramChannel()
-        await self._datagram_channel.open()
+        # Members can always ask it to resend membership events they missed, and with UDP membership
+        # it also listens on the welcome port for members joining and leaving.
+        await self._datagram_channel.open( int( self._port ) if self._udp_membership else None,
+            self.handle_datagram_message, self._admit_datagram_hello if self._admission and self._udp_membership else None,
+            self.handle_group_message )
+
+        # When running as one of several workers, connect to the roster hub before accepting
+        # members so the global roster is known up front.
+        if self._hub_path:
+            self._roster_link = RosterLink( self )
+            await self._roster_link.open( self._hub_path )
 
-        # Setup the listening socket for new clients.
+        # Setup the listening socket for new clients. Workers share the welcome port with each other,
+        # and the kernel spreads incoming connections across them.
         loop = asyncio.get_running_loop()
-        self._server = await loop.create_server( lambda: MemberConnection( self ), port=self._port )
+        if self._idle_wheel:
+            self._idle_wheel.start( loop )
+        if self._admission:
+            self._admission.start( loop )
+        self._server = await loop.create_server( lambda: MemberConnection( self, self._write_limits ),
+            port=self._port,
+            backlog=socket.SOMAXCONN,
+            reuse_port=True if self._hub_path else None )
 
         # Windows requires a dirty hack to ensure the keyboard interrupt (Ctrl+C) results in the
         # event loop shutting down, even when it would normally be in an idle state (for instance,
@@ -214,11 +1678,20 @@ class Server:
 
     async def shutdown( self ):
         logging.info( "Stopping server." )
+        if self._idle_wheel:
+            self._idle_wheel.stop()
+        if self._admission:
+            self._admission.stop()
         if self._connections:
-            await asyncio.gather( *[conn.disconnect() for conn in self._connections] )
+            # Datagram members are forgotten on the spot, so only TCP connections have anything to
+            # wait on.
+            closing = [conn.disconnect() for conn in list( self._connections )]
+            await asyncio.gather( *[closed for closed in closing if closed] )
 
         self._server.close()
         await self._server.wait_closed()
+        if self._roster_link:
+            await self._roster_link.close()
         await self._datagram_channel.close()
         logging.info( "Server stopped.")
 
@@ -227,44 +1700,253 @@ class Server:
             warnings.warn( f"Connection already registered: {conn.address}" )
             return
         self._connections[conn] = None
+        if self._idle_wheel:
+            conn.last_active_tick = self._idle_wheel.current_tick
+            self._idle_wheel.schedule( conn, self._idle_timeout_ticks )
 
     def unregister_connection( self, conn ):
         if conn in self._connections:
-            member = self._connections[conn]
-            if member:
-                self._members.remove( member )
+            if self._idle_wheel:
+                self._idle_wheel.cancel( conn )
+            if self._admission:
+                self._admission.cancel( conn )
+            room, member = self._rooms.remove_by_connection( conn )
+            if member and self._roster_link:
+                self._roster_link.publish_part( room.name, member )
             del self._connections[conn]
 
+    def unregister_datagram_member( self, conn ):
+        self._datagram_members.pop( conn.peer, None )
+        self.unregister_connection( conn )
+
+    def admit_hello( self, conn, source_ip, message, binary_encoding=False ):
+        # Called with each HELO a member connection receives, before it is parsed. Returns whether the
+        # connection should go ahead and handle it. A deferred HELO is handled here later on instead,
+        # as long as the connection is still around by then.
+        if not self._admission:
+            return True
+
+        def handle():
+            if conn in self._connections:
+                parsed = parse_binary_message( binary.HELO, message ) if binary_encoding else parse_message( message )
+                if parsed:
+                    self.handle_message( parsed, conn )
+
+        return self._admission.admit( source_ip, conn, handle,
+            lambda reason: self._reject( peek_screen_name( message ), conn, reason ) )
+
+    def _admit_datagram_hello( self, addr, message, binary_encoding ):
+        # The datagram channel's counterpart of admit_hello for HELOs sent over UDP.
+        def handle():
+            parsed = parse_binary_message( binary.HELO, message ) if binary_encoding else parse_message( message )
+            if parsed:
+                self.handle_datagram_message( parsed, addr )
+
+        def reject( reason ):
+            DatagramMember( self, self._datagram_channel, addr, binary_encoding ).send_reject(
+                peek_screen_name( message ), reason )
+
+        return self._admission.admit( addr[0], addr, handle, reject )
+
+    def handle_datagram_message( self, message, addr ):
+        if isinstance( message, NACK ):
+            # Only members get events resent, so nobody else can use the channel to bounce datagrams
+            # at a third party.
+            room = self._rooms.get_by_datagram_address( addr )
+            if room:
+                self._datagram_channel.resend_events( room, message.first, message.last, addr, message.binary )
+            return
+        elif not self._udp_membership:
+            return
+
+        conn = self._datagram_members.get( addr )
+        if conn and isinstance( message, HELO ):
+            # Members keep resending HELO until they hear back, so a repeat from a member we've
+            # already accepted means our ACPT was lost along the way.
+            room = self._rooms.get_by_connection( conn )
+            member = room.get_by_connection( conn ) if room else None
+            if member and member.screen_name == message.screen_name and room.name == message.room:
+                if self._idle_wheel:
+                    conn.last_active_tick = self._idle_wheel.current_tick
+                self._send_accept( conn, room, message.roster_version )
+                return
+            elif member:
+                # A HELO under another name or for another room means the address has been taken over,
+                # most likely by a client restarted on the same port. The member it replaces won't be
+                # heard from again, so it leaves now instead of being kept alive by its successor's
+                # datagrams, and the HELO starts a membership of its own.
+                logging.info( f"Datagram member {member.screen_name} at {addr} replaced by {message.screen_name}." )
+                self._announce_exit( room, member )
+                conn.disconnect()
+                conn = None
+
+        if not conn:
+            # Only a HELO can start a membership. Anything else is from a member we've already
+            # forgotten (or never knew), so drop it.
+            if not isinstance( message, HELO ):
+                return
+            conn = DatagramMember( self, self._datagram_channel, addr, message.binary )
+            self._datagram_members[addr] = conn
+            self.register_connection( conn )
+
+        room = self._rooms.get_by_connection( conn )
+        self.handle_message( message, conn )
+
+        # There's no connection for a departing member to close, so forget it as soon as everybody
+        # has been told it left. That includes the member itself, so its EXIT can't be left waiting
+        # in a batch that won't be sent to it anymore.
+        if isinstance( message, EXIT ):
+            if room:
+                self._datagram_channel.flush_events( room )
+            conn.disconnect()
+
+    def handle_group_message( self, message, addr ):
+        # A chat message a member multicast to its room, which members that never joined the multicast
+        # group have to be sent on their own. Members may only speak for themselves.
+        room = self._rooms.get_by_datagram_address( addr )
+        sender = room.get_by_name( message.screen_name ) if room and isinstance( message, MESG ) else None
+        if (not sender or sender.datagram_address != addr or "\n" in message.message or
+            not self._datagram_channel.multicast_group_for( room )):
+            return
+
+        self._datagram_channel.send_group_message( room, sender,
+            self._encode_chat_message( sender.screen_name, message.message )[0] )
+
+    def handle_remote_join( self, room_name, member ):
+        room = self._rooms.get( room_name )
+        if room and member.screen_name in room:
+            warnings.warn( f"Member {member.screen_name} joined room {room_name} on another worker but is already registered." )
+            return
+        room = self._rooms.add( room_name, member )
+        self._datagram_channel.send_join( member, room )
+
+    def handle_remote_exit( self, room_name, screen_name ):
+        room = self._rooms.get( room_name )
+        departing_member = room.get_by_name( screen_name ) if room else None
+        if departing_member:
+            self._datagram_channel.send_exit( departing_member, room )
+
+    def handle_remote_part( self, room_name, screen_name ):
+        self._rooms.remove_by_name( room_name, screen_name )
+
+    def handle_remote_message( self, room_name, screen_name, message ):
+        # A chat message relayed by the worker its sender is connected to, which only reached the
+        # members on that worker.
+        room = self._rooms.get( room_name )
+        sender = room.get_by_name( screen_name ) if room else None
+        if sender:
+            self._datagram_channel.send_message( room, sender, *self._encode_chat_message( screen_name, message ) )
+
     def handle_message( self, message, conn ):
-        async def handle_message():
-            if isinstance( message, HELO ):
-                # Ignore this if this connection has already registered itself as a member.
-                if self._connections.get( conn, None ):
-                    warnings.warn( f"Connection {conn.address} already registered as member. Ignoring HELO." )
-                    return
+        # Messages are handled inline on the event loop. The only case that needs to wait on anything
+        # is a sharded HELO, which must hear back from the roster hub before the member is accepted,
+        # so that's the only case that gets a task of its own.
+        #
+        # Any message counts as a sign of life. Rather than rearming the connection's idle timer every
+        # time, just note when it was last heard from and check that once the timer goes off.
+        if self._idle_wheel:
+            conn.last_active_tick = self._idle_wheel.current_tick
 
-                for member in self._members:
-                    if member.screen_name == message.screen_name:
-                        conn.send_reject( message.screen_name )
-                        await conn.disconnect()
-                        break
-                else:
-                    member = Member( message.screen_name, message.ip_address, message.port )
-                    self._connections[conn] = member
-                    self._members.append( member )
-
-                    conn.send_accept( self._members )
-                    self._datagram_channel.send_join( member, self._members )
-            elif isinstance( message, EXIT ):
-                # Ignore this if this connection has never registered itself previously.
-                if not self._connections.get( conn, None ):
-                    warnings.warn( f"Connection {conn.address} never registered as member. Ignoring EXIT." )
-                    return
+        if isinstance( message, HELO ):
+            self._handle_hello( message, conn )
+        elif isinstance( message, EXIT ):
+            self._handle_exit( conn )
+        elif isinstance( message, PING ):
+            room = self._rooms.get_by_connection( conn )
+            if room:
+                conn.send_event_sequence( self._datagram_channel.event_sequence( room ) + 1 )
+        elif isinstance( message, MESG ) and self._relay_chat:
+            self._relay_message( message, conn )
+
+    def _handle_hello( self, message, conn ):
+        # Ignore this if this connection has already registered itself as a member.
+        if self._rooms.get_by_connection( conn ):
+            warnings.warn( f"Connection {conn.address} already registered as member. Ignoring HELO." )
+            return
+
+        if not message.valid_room:
+            self._reject( message.screen_name, conn, "ROOM" )
+            return
+
+        room = self._rooms.get( message.room )
+        if room and message.screen_name in room:
+            self._reject( message.screen_name, conn )
+            return
+
+        member = Member( message.screen_name, message.ip_address, message.port, message.binary, message.sequenced )
+        if self._roster_link:
+            # The local registry catches most duplicates, but the roster hub has the final say since
+            # another worker may be accepting the same screen name concurrently.
+            self._create_task( self._claim_and_accept( message.room, member, conn, message.roster_version ) )
+        else:
+            self._accept( message.room, member, conn, message.roster_version )
+
+    async def _claim_and_accept( self, room_name, member, conn, roster_version=None ):
+        if not await self._roster_link.claim( room_name, member ):
+            self._reject( member.screen_name, conn )
+        elif conn not in self._connections:
+            # The connection went away while the claim was in flight.
+            self._roster_link.publish_part( room_name, member )
+        else:
+            self._accept( room_name, member, conn, roster_version )
+
+    def _accept( self, room_name, member, conn, roster_version=None ):
+        room = self._rooms.add( room_name, member, conn )
+        self._send_accept( conn, room, roster_version )
+        self._datagram_channel.send_join( member, room )
+
+    def _send_accept( self, conn, room, roster_version=None ):
+        conn.send_accept( room, self._datagram_channel.multicast_group_for( room ), roster_version,
+            self._datagram_channel.event_sequence( room ), self._relay_chat )
+
+    def _reject( self, screen_name, conn, reason=None ):
+        conn.send_reject( screen_name, reason )
+        conn.disconnect()
+
+    def _handle_exit( self, conn ):
+        # Ignore this if this connection has never registered itself previously.
+        room = self._rooms.get_by_connection( conn )
+        if not room:
+            warnings.warn( f"Connection {conn.address} never registered as member. Ignoring EXIT." )
+            return
+
+        self._announce_exit( room, room.get_by_connection( conn ) )
 
-                departing_member = self._connections[conn]
-                self._datagram_channel.send_exit( departing_member, self._members )
+    def _announce_exit( self, room, departing_member ):
+        self._datagram_channel.send_exit( departing_member, room )
+        if self._roster_link:
+            self._roster_link.publish_exit( room.name, departing_member )
+
+    def _relay_message( self, message, conn ):
+        # Members may only speak for themselves, and only to their own room. Newlines would split the
+        # text encoding of the message (and the hub's line) into bogus extra messages.
+        room = self._rooms.get_by_connection( conn )
+        sender = room.get_by_connection( conn ) if room else None
+        if not sender or message.screen_name != sender.screen_name or "\n" in message.message:
+            return
+
+        self._datagram_channel.send_message( room, sender, *self._encode_chat_message( sender.screen_name, message.message ) )
+        if self._roster_link:
+            self._roster_link.publish_message( room.name, sender, message.message )
+
+    def _encode_chat_message( self, screen_name, message ):
+        return (f"MESG {screen_name}: {message}\n".encode(), binary.encode_message( screen_name, message ))
+
+    def _idle_timer_expired( self, conn ):
+        idle_ticks = self._idle_wheel.current_tick - conn.last_active_tick
+        if idle_ticks < self._idle_timeout_ticks:
+            self._idle_wheel.schedule( conn, self._idle_timeout_ticks - idle_ticks )
+            return
 
-        self._create_task( handle_message() )
+        # The peer has gone quiet for too long, most likely because it crashed and left a half-open
+        # connection behind. Let everybody know it's gone the same way as if it had said EXIT, and
+        # drop the connection without waiting on a peer that isn't reading anymore.
+        room = self._rooms.get_by_connection( conn )
+        idle_seconds = idle_ticks * self._idle_wheel.tick
+        logging.warning( f"Evicting peer {conn.peer} after {idle_seconds:.0f} seconds without a message." )
+        if room:
+            self._announce_exit( room, room.get_by_connection( conn ) )
+        conn.abort()
 
     def _create_task( self, coro ):
         self._server.get_loop().create_task( coro )
@@ -279,26 +1961,313 @@ def parse_command_line( argv ):
         metavar="<welcome port>",
         help="Port number clients will use when connecting to the membership server." )
 
-    return parser.parse_args( argv[1:] )
+    parser.add_argument( "--event-loop",
+        choices=EVENT_LOOP_BACKENDS,
+        default="auto",
+        help="Event loop backend to run the server on. The default picks uvloop if it is installed, "
+            "select on Windows, and the platform's most scalable selector (e.g., epoll) otherwise." )
 
-def main( argv ):
-    # Setup the module-wide logging.
-    logging.basicConfig( level=logging.INFO,
-        format="[%(asctime)s] [%(levelname)s] [%(funcName)s (%(filename)s)] - %(message)s" )
+    parser.add_argument( "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes to shard members across. Workers share the welcome port and "
+            "coordinate the global roster through a roster hub in the parent process." )
+
+    parser.add_argument( "--event-batch-window",
+        type=float,
+        default=0.0,
+        metavar="MILLISECONDS",
+        help="Hold JOIN and EXIT events for up to this many milliseconds and send each member the pending "
+            "events as one datagram. Disabled by default." )
+
+    parser.add_argument( "--event-batch-size",
+        type=int,
+        default=32,
+        help="Maximum number of membership events sent in one datagram when event batching is enabled." )
+
+    parser.add_argument( "--multicast",
+        type=parse_multicast_group,
+        metavar="GROUP:PORT",
+        help="Send JOIN and EXIT events once to this IPv4 multicast group instead of to every member. "
+            "Clients are told to join the group when they are accepted." )
+
+    parser.add_argument( "--multicast-interface",
+        metavar="ADDRESS",
+        help="Local IPv4 address of the interface to send multicast traffic on (e.g., 127.0.0.1 for "
+            "loopback testing)." )
+
+    parser.add_argument( "--multicast-ttl",
+        type=int,
+        default=1,
+        help="Time to live for multicast datagrams. The default keeps them on the local network." )
+
+    parser.add_argument( "--write-high-water",
+        type=int,
+        default=64,
+        metavar="KIB",
+        help="Kibibytes buffered for a member connection before it is considered slow and writes to it "
+            "are held back." )
+
+    parser.add_argument( "--write-low-water",
+        type=int,
+        default=16,
+        metavar="KIB",
+        help="Kibibytes a slow member connection has to drain down to before writes to it resume." )
+
+    parser.add_argument( "--slow-consumer-policy",
+        choices=SLOW_CONSUMER_POLICIES,
+        default="defer",
+        help="What to do with messages for a slow member: defer them until it catches up, drop them, or "
+            "disconnect the member." )
+
+    parser.add_argument( "--max-buffered",
+        type=int,
+        default=4096,
+        metavar="KIB",
+        help="Kibibytes that may pile up for a slow member under the defer policy before it is disconnected." )
+
+    parser.add_argument( "--stall-timeout",
+        type=float,
+        default=30.0,
+        metavar="SECONDS",
+        help="Disconnect members whose connection stays blocked for this long. Zero disables the timeout." )
 
-    # Make sure we pick the Select based event loop since that's the only one on Windows that
-    # support UDP transports.
-    selector = selectors.SelectSelector()
-    loop = asyncio.SelectorEventLoop( selector )
+    parser.add_argument( "--idle-timeout",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="Evict members that send nothing, not even a PING heartbeat, for this long. Disabled by default "
+            "unless UDP membership is enabled." )
+
+    parser.add_argument( "--udp-membership",
+        action="store_true",
+        help="Also let members join, refresh their membership, and leave with datagrams sent to the welcome "
+            "port, without holding a TCP connection open. Their membership expires after the idle timeout." )
+
+    parser.add_argument( "--helo-rate",
+        type=float,
+        default=0.0,
+        metavar="PER_SECOND",
+        help="Most HELOs per second accepted from any one source IP address, on average. HELOs beyond that "
+            "are rejected right away. Disabled by default." )
+
+    parser.add_argument( "--helo-burst",
+        type=int,
+        default=5,
+        help="Number of HELOs a source IP address may send back to back before --helo-rate applies." )
+
+    parser.add_argument( "--accept-rate",
+        type=float,
+        default=0.0,
+        metavar="PER_SECOND",
+        help="Most HELOs per second the server handles across all sources, on average. HELOs beyond that wait "
+            "in line to be handled. Disabled by default." )
+
+    parser.add_argument( "--accept-burst",
+        type=int,
+        default=100,
+        help="Number of HELOs the server handles back to back before --accept-rate applies." )
+
+    parser.add_argument( "--max-deferred-helos",
+        type=int,
+        default=1000,
+        help="Most HELOs waiting in line for --accept-rate. HELOs beyond that are rejected right away." )
+
+    parser.add_argument( "--relay-chat",
+        action="store_true",
+        help="Relay the chat messages of members that send them to the server once, fanning each one out to "
+            "the rest of the sender's room, instead of leaving members to send them to each other." )
+
+    parser.add_argument( "--roster-changelog-size",
+        type=int,
+        default=DEFAULT_ROSTER_CHANGELOG_SIZE,
+        metavar="CHANGES",
+        help="Number of recent joins and leaves remembered so rejoining members can be sent just the changes "
+            "since the roster version they last saw. Zero always sends the full roster." )
+
+    cli = parser.parse_args( argv[1:] )
+
+    if cli.event_batch_window < 0 or cli.event_batch_size < 1:
+        parser.error( "The event batch window must not be negative, and the event batch size must be at least one." )
+
+    if cli.workers < 1:
+        parser.error( "At least one worker is required." )
+
+    if cli.idle_timeout < 0:
+        parser.error( "The idle timeout must not be negative." )
+
+    if cli.helo_rate < 0 or cli.accept_rate < 0 or cli.helo_burst < 1 or cli.accept_burst < 1 or cli.max_deferred_helos < 0:
+        parser.error( "HELO and accept rates must not be negative, bursts must be at least one, and the deferred "
+            "HELO limit must not be negative." )
+
+    if cli.roster_changelog_size < 0:
+        parser.error( "The roster changelog size must not be negative." )
+
+    if cli.udp_membership:
+        if cli.workers > 1:
+            parser.error( "UDP membership cannot be combined with multiple workers." )
+        if not cli.idle_timeout:
+            cli.idle_timeout = DEFAULT_UDP_MEMBERSHIP_TIMEOUT
+
+    if not 0 <= cli.write_low_water <= cli.write_high_water or cli.max_buffered < 0 or cli.stall_timeout < 0:
+        parser.error( "The write low water mark must be between zero and the high water mark, and the "
+            "buffer limit and stall timeout must not be negative." )
+
+    if cli.multicast and cli.workers > 1:
+        # Each worker numbers the events it multicasts on its own, so members would be sent events
+        # from several unrelated sequences over the same group.
+        parser.error( "Multicast delivery cannot be combined with multiple workers." )
+
+    if cli.workers > 1 and not (hasattr( socket, "SO_REUSEPORT" ) and hasattr( socket, "AF_UNIX" )):
+        parser.error( "Multiple workers require SO_REUSEPORT and Unix sockets, which this platform lacks." )
+
+    if cli.event_loop == "uvloop" and not uvloop:
+        parser.error( "The uvloop event loop was requested, but uvloop is not installed." )
+
+    if cli.event_loop == "epoll" and not hasattr( selectors, "EpollSelector" ):
+        parser.error( "The epoll event loop was requested, but epoll is not available on this platform." )
+
+    return cli
+
+def parse_multicast_group( value ):
+    group, _, port = value.rpartition( ":" )
+    try:
+        if not ipaddress.IPv4Address( group ).is_multicast:
+            raise ValueError( f"{group} is not a multicast address" )
+        port = int( port )
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError( f"Invalid multicast group {value}: {ex}" )
+    return (group, port)
+
+def create_event_loop( backend ):
+    if backend == "auto":
+        if platform.system() == "Windows":
+            backend = "select"
+        elif uvloop:
+            backend = "uvloop"
+
+    if backend == "uvloop":
+        return uvloop.new_event_loop()
+    elif backend == "select":
+        # On Windows, the select based event loop is the only one that supports UDP transports. It is
+        # limited to FD_SETSIZE sockets though, so it is only the default where it is required.
+        return asyncio.SelectorEventLoop( selectors.SelectSelector() )
+    elif backend == "epoll":
+        return asyncio.SelectorEventLoop( selectors.EpollSelector() )
+    else:
+        return asyncio.SelectorEventLoop( selectors.DefaultSelector() )
+
+def raise_open_file_limit():
+    # Each member holds a TCP connection open for its entire session, so the number of members the
+    # server can track is capped by the number of file descriptors it may open. Raise the soft limit
+    # as far as the hard limit allows.
+    if not resource:
+        return
+
+    soft_limit, hard_limit = resource.getrlimit( resource.RLIMIT_NOFILE )
+    if hard_limit == resource.RLIM_INFINITY:
+        hard_limit = 1 << 20
+
+    if soft_limit != resource.RLIM_INFINITY and soft_limit < hard_limit:
+        try:
+            resource.setrlimit( resource.RLIMIT_NOFILE, (hard_limit, hard_limit) )
+            soft_limit = hard_limit
+        except (ValueError, OSError) as ex:
+            logging.warning( f"Unable to raise open file limit: {ex}" )
+
+    logging.info( f"Open file limit is {soft_limit}." )
+
+def raise_keyboard_interrupt( signum, frame ):
+    # When sharded, SIGTERM is treated the same as Ctrl+C so every process shuts down cleanly.
+    raise KeyboardInterrupt()
+
+def run_server( cli, hub_sock=None, hub_path=None ):
+    if hub_sock:
+        # Workers inherit the parent's listening hub socket when forked, but only the parent uses it.
+        hub_sock.close()
+        signal.signal( signal.SIGTERM, raise_keyboard_interrupt )
+
+    loop = create_event_loop( cli.event_loop )
     asyncio.set_event_loop( loop )
+    logging.info( f"Using {type( loop ).__name__} event loop backend ({cli.event_loop})." )
 
-    cli = parse_command_line( argv )
-    server = Server( cli.welcome_port )
+    datagram_channel = DatagramChannel( event_batch_window=cli.event_batch_window / 1000,
+        event_batch_size=cli.event_batch_size,
+        multicast_group=cli.multicast,
+        multicast_interface=cli.multicast_interface,
+        multicast_ttl=cli.multicast_ttl )
+    write_limits = WriteLimits( high_water=cli.write_high_water * 1024,
+        low_water=cli.write_low_water * 1024,
+        max_buffered=cli.max_buffered * 1024,
+        policy=cli.slow_consumer_policy,
+        stall_timeout=cli.stall_timeout )
+    admission = AdmissionControl( source_rate=cli.helo_rate,
+        source_burst=cli.helo_burst,
+        accept_rate=cli.accept_rate,
+        accept_burst=cli.accept_burst,
+        max_deferred=cli.max_deferred_helos )
+    server = Server( cli.welcome_port, datagram_channel, hub_path, write_limits, cli.idle_timeout, cli.udp_membership,
+        cli.roster_changelog_size, admission, cli.relay_chat )
 
     try:
         loop.run_until_complete( server.run() )
     except KeyboardInterrupt:
         loop.run_until_complete( server.shutdown() )
 
+def run_sharded_server( cli ):
+    # Bind the roster hub's socket before forking so that it is already accepting connections by the
+    # time the workers try to reach it.
+    hub_dir = tempfile.mkdtemp( prefix="chatter-" )
+    hub_path = os.path.join( hub_dir, "roster.sock" )
+    hub_sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    hub_sock.bind( hub_path )
+    hub_sock.listen( cli.workers )
+
+    context = multiprocessing.get_context( "fork" )
+    workers = [context.Process( target=run_server, args=(cli, hub_sock, hub_path), name=f"worker-{index}" )
+        for index in range( cli.workers )]
+
+    for worker in workers:
+        worker.start()
+    logging.info( f"Started {len( workers )} workers." )
+
+    signal.signal( signal.SIGTERM, raise_keyboard_interrupt )
+    loop = create_event_loop( cli.event_loop )
+    asyncio.set_event_loop( loop )
+    hub = RosterHub( hub_sock )
+
+    try:
+        loop.run_until_complete( hub.run() )
+    except KeyboardInterrupt:
+        # When Ctrl+C is pressed, the workers receive SIGINT right along with us. Give them a chance
+        # to stop on their own before asking them to.
+        deadline = time.monotonic() + WORKER_SHUTDOWN_GRACE_PERIOD
+        for worker in workers:
+            worker.join( max( 0, deadline - time.monotonic() ) )
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+    finally:
+        hub_sock.close()
+        os.unlink( hub_path )
+        os.rmdir( hub_dir )
+        logging.info( "All workers stopped." )
+
+def main( argv ):
+    cli = parse_command_line( argv )
+
+    # Setup the module-wide logging. Tag each line with the process it came from when sharded.
+    logging.basicConfig( level=logging.INFO,
+        format="[%(asctime)s] [%(levelname)s] "
+            f"{'[%(processName)s] ' if cli.workers > 1 else ''}"
+            "[%(funcName)s (%(filename)s)] - %(message)s" )
+
+    raise_open_file_limit()
+
+    if cli.workers > 1:
+        run_sharded_server( cli )
+    else:
+        run_server( cli )
+
 if __name__ == "__main__":
     main( sys.argv )
@@ -0,0 +1,479 @@
+import argparse
+import asyncio
+import itertools
+import random
+import sys
+import time
+import zlib
+
+from server import LineProtocol, raise_open_file_limit
+
+CHURN_PATTERNS = ["none", "steady", "burst", "flap"]
+
+class LatencyRecorder:
+    # Keeps a bounded, uniformly random sample of latencies so that memory stays flat no matter how
+    # many events a large swarm observes.
+    def __init__( self, max_samples=200000 ):
+        self._max_samples = max_samples
+        self._samples = []
+        self.count = 0
+
+    def record( self, seconds ):
+        self.count += 1
+        if len( self._samples ) < self._max_samples:
+            self._samples.append( seconds )
+        else:
+            index = random.randrange( self.count )
+            if index < self._max_samples:
+                self._samples[index] = seconds
+
+    def format( self ):
+        if not self._samples:
+            return "no samples"
+
+        samples = sorted( self._samples )
+        def percentile( fraction ):
+            return samples[min( len( samples ) - 1, int( fraction * len( samples ) ) )] * 1000
+
+        return (f"p50 {percentile( 0.5 ):8.2f} ms  p90 {percentile( 0.9 ):8.2f} ms  "
+            f"p99 {percentile( 0.99 ):8.2f} ms  max {samples[-1] * 1000:8.2f} ms  ({self.count} samples)")
+
+class MemberDatagramChannel( asyncio.DatagramProtocol ):
+    def __init__( self, member ):
+        self._member = member
+
+    def datagram_received( self, data, addr ):
+        self._member.datagram_received( data )
+
+class SwarmMember( LineProtocol ):
+    # A headless chat client. It says hello with a real UDP port, tracks how long the server takes to
+    # answer, and reports every membership event that reaches its datagram channel back to the swarm.
+    def __init__( self, swarm, screen_name ):
+        super().__init__()
+        self._swarm = swarm
+        self.screen_name = screen_name
+        self._transport = None
+        self._datagram_transport = None
+        self._hello_sent = None
+        self._answered = None
+        self._exit_acked = None
+        self._heartbeat = None
+
+    @property
+    def connected( self ):
+        if self._swarm.udp_membership:
+            return self._datagram_transport is not None and self._answered.done() and self._answered.result()
+        return self._transport is not None
+
+    async def join( self ):
+        # Returns True if the server accepted us and False if it rejected our screen name.
+        loop = asyncio.get_running_loop()
+        self._answered = loop.create_future()
+        self._datagram_transport, _ = await loop.create_datagram_endpoint( lambda: MemberDatagramChannel( self ),
+            local_addr=(self._swarm.udp_host, 0) )
+        _, udp_port = self._datagram_transport.get_extra_info( "sockname" )
+
+        if not self._swarm.udp_membership:
+            try:
+                await loop.create_connection( lambda: self, self._swarm.server_address, self._swarm.server_port )
+            except OSError:
+                self.close()
+                raise
+
+        self._hello_sent = time.perf_counter()
+        self._swarm.hello_sent( self )
+        room = self._swarm.room_for( self.screen_name )
+        if room:
+            self._send( f"HELO {self.screen_name} {self._swarm.udp_host} {udp_port} {room} SEQN\n".encode() )
+        else:
+            self._send( f"HELO {self.screen_name} {self._swarm.udp_host} {udp_port} SEQN\n".encode() )
+        if not self._swarm.udp_membership:
+            return await self._answered
+
+        # A lost HELO or ACPT datagram is counted as a failed join rather than retried, so that losses
+        # show up in the results.
+        try:
+            accepted = await asyncio.wait_for( self._answered, self._swarm.answer_timeout )
+        except asyncio.TimeoutError:
+            raise ConnectionError( "Server never answered HELO." )
+        if accepted and self._swarm.heartbeat_interval:
+            self._schedule_heartbeat()
+        return accepted
+
+    async def leave( self, timeout ):
+        # Leave the way the real client does: send EXIT, wait for our own EXIT to come back over UDP,
+        # and then disconnect.
+        if self.connected:
+            self._exit_acked = asyncio.get_running_loop().create_future()
+            self._swarm.exit_sent( self )
+            self._send( b"EXIT\n" )
+            try:
+                await asyncio.wait_for( self._exit_acked, timeout )
+            except asyncio.TimeoutError:
+                self._swarm.exit_timed_out()
+        self.close()
+
+    def close( self ):
+        if self._transport:
+            self._transport.close()
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        if self._datagram_transport:
+            self._datagram_transport.close()
+            self._datagram_transport = None
+
+    def connection_made( self, transport ):
+        self._transport = transport
+        if self._swarm.heartbeat_interval:
+            self._schedule_heartbeat()
+
+    def connection_lost( self, ex ):
+        self._transport = None
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        if self._answered and not self._answered.done():
+            self._answered.set_exception( ConnectionError( "Server closed the connection before answering HELO." ) )
+        else:
+            self._swarm.connection_lost( self )
+
+    def message_received( self, message ):
+        if not self._answered or self._answered.done():
+            return
+
+        message_type = message.partition( " " )[0]
+        if message_type == "ACPT":
+            self._swarm.accepted( time.perf_counter() - self._hello_sent )
+            self._answered.set_result( True )
+        elif message_type == "RJCT":
+            self._swarm.rejected( time.perf_counter() - self._hello_sent )
+            self._answered.set_result( False )
+
+    def datagram_received( self, data ):
+        now = time.perf_counter()
+        self._swarm.datagram_received()
+        for event in data.split( b"\n" ):
+            if not event:
+                continue
+            event_type, _, event_data = event.partition( b" " )
+            if event_type in (b"ACPT", b"RJCT"):
+                # Answers to a HELO sent over UDP.
+                self.message_received( event.decode() )
+                continue
+            elif event_type in (b"ROST", b"VERS", b"SEQN"):
+                continue
+            screen_name = event_data.partition( b" " )[0].decode()
+            self._swarm.event_received( event_type, screen_name, now )
+            if event_type == b"EXIT" and screen_name == self.screen_name and self._exit_acked and not self._exit_acked.done():
+                self._exit_acked.set_result( None )
+
+    def _schedule_heartbeat( self ):
+        self._heartbeat = asyncio.get_running_loop().call_later( self._swarm.heartbeat_interval, self._send_heartbeat )
+
+    def _send_heartbeat( self ):
+        if self.connected:
+            self._send( b"PING\n" )
+            self._schedule_heartbeat()
+
+    def _send( self, data ):
+        if self._swarm.udp_membership:
+            if self._datagram_transport:
+                self._datagram_transport.sendto( data, (self._swarm.server_address, self._swarm.server_port) )
+        elif self._transport:
+            self._transport.write( data )
+
+class Swarm:
+    def __init__( self, cli ):
+        self.server_address = cli.server_address
+        self.server_port = cli.server_port
+        self.udp_host = cli.udp_host
+        self.heartbeat_interval = cli.heartbeat_interval
+        self.udp_membership = cli.udp_membership
+        self.answer_timeout = cli.exit_timeout
+        self._cli = cli
+        self._names = (f"{cli.name_prefix}{index}" for index in itertools.count())
+        self._members = {}
+
+        # When each membership event was triggered, keyed by screen name, so receivers can work out
+        # how long the event took to reach them.
+        self._join_sent = {}
+        self._exit_sent = {}
+
+        self.acpt_latency = LatencyRecorder()
+        self.rjct_latency = LatencyRecorder()
+        self.join_latency = LatencyRecorder()
+        self.exit_latency = LatencyRecorder()
+        self.hellos = 0
+        self.accepts = 0
+        self.rejects = 0
+        self.failures = 0
+        self.exit_timeouts = 0
+        self.dropped = 0
+        self.datagrams = 0
+        self._start = None
+
+    def room_for( self, screen_name ):
+        # Members are spread across the rooms by screen name, so a member that reconnects (or a
+        # duplicate HELO) always lands in the same room as the original.
+        if self._cli.rooms > 1:
+            return f"room{zlib.crc32( screen_name.encode() ) % self._cli.rooms}"
+        return None
+
+    def hello_sent( self, member ):
+        self.hellos += 1
+        # A duplicate HELO for a name that's in use never produces a JOIN of its own.
+        if member.screen_name not in self._members:
+            self._join_sent[member.screen_name] = time.perf_counter()
+
+    def exit_sent( self, member ):
+        self._exit_sent[member.screen_name] = time.perf_counter()
+
+    def connection_lost( self, member ):
+        # Members we retire ourselves are forgotten before their connection closes, so anybody still
+        # on the books was dropped by the server (e.g., evicted for being idle).
+        if self._members.get( member.screen_name ) is member:
+            del self._members[member.screen_name]
+            self.dropped += 1
+            member.close()
+
+    def exit_timed_out( self ):
+        self.exit_timeouts += 1
+
+    def accepted( self, latency ):
+        self.accepts += 1
+        self.acpt_latency.record( latency )
+
+    def rejected( self, latency ):
+        self.rejects += 1
+        self.rjct_latency.record( latency )
+
+    def datagram_received( self ):
+        self.datagrams += 1
+
+    def event_received( self, event_type, screen_name, now ):
+        if event_type == b"JOIN":
+            sent = self._join_sent.get( screen_name )
+            if sent is not None:
+                self.join_latency.record( now - sent )
+        elif event_type == b"EXIT":
+            sent = self._exit_sent.get( screen_name )
+            if sent is not None:
+                self.exit_latency.record( now - sent )
+
+    async def run( self ):
+        self._start = time.perf_counter()
+        reporter = asyncio.get_running_loop().create_task( self._report_progress() )
+        try:
+            await self._ramp_up()
+            print( f"Ramp up complete: {len( self._members )} members in {time.perf_counter() - self._start:.2f} s." )
+
+            churn = getattr( self, f"_churn_{self._cli.churn}" )
+            try:
+                await asyncio.wait_for( churn(), self._cli.duration )
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            reporter.cancel()
+            elapsed = time.perf_counter() - self._start
+            await self._leave_all()
+            self._print_summary( elapsed )
+
+    async def _ramp_up( self ):
+        # Connect members at the requested rate, allowing many HELOs to be in flight at once.
+        interval = 1 / self._cli.ramp_rate if self._cli.ramp_rate > 0 else 0
+        pending = set()
+        for _ in range( self._cli.members ):
+            pending.add( asyncio.get_running_loop().create_task( self._join( next( self._names ) ) ) )
+            if interval:
+                await asyncio.sleep( interval )
+            if len( pending ) >= self._cli.concurrency:
+                _, pending = await asyncio.wait( pending, return_when=asyncio.FIRST_COMPLETED )
+        if pending:
+            await asyncio.wait( pending )
+
+    async def _join( self, screen_name ):
+        member = SwarmMember( self, screen_name )
+        try:
+            if await member.join():
+                self._members[screen_name] = member
+                return member
+            member.close()
+        except (OSError, ConnectionError):
+            self.failures += 1
+            member.close()
+
+    async def _leave( self, member ):
+        self._members.pop( member.screen_name, None )
+        await member.leave( self._cli.exit_timeout )
+
+    async def _leave_all( self ):
+        members = list( self._members.values() )
+        self._members.clear()
+        for member in members:
+            member.close()
+
+    async def _join_duplicate( self ):
+        # Deliberately reuse a screen name that's already in use to exercise the reject path.
+        if self._members and random.random() < self._cli.duplicate_ratio:
+            member = SwarmMember( self, random.choice( list( self._members ) ) )
+            try:
+                await member.join()
+            except (OSError, ConnectionError):
+                self.failures += 1
+            member.close()
+
+    async def _churn_none( self ):
+        while True:
+            await self._join_duplicate()
+            await asyncio.sleep( 1 )
+
+    async def _churn_steady( self ):
+        # One member leaves and a new one takes its place at a constant rate.
+        interval = 1 / self._cli.churn_rate
+        while True:
+            if self._members:
+                member = random.choice( list( self._members.values() ) )
+                asyncio.get_running_loop().create_task( self._leave( member ) )
+            asyncio.get_running_loop().create_task( self._join( next( self._names ) ) )
+            asyncio.get_running_loop().create_task( self._join_duplicate() )
+            await asyncio.sleep( interval )
+
+    async def _churn_burst( self ):
+        # Periodically a whole batch of members leaves and another batch joins all at once.
+        while True:
+            await asyncio.sleep( self._cli.burst_interval )
+            leaving = random.sample( list( self._members.values() ), min( self._cli.burst_size, len( self._members ) ) )
+            await asyncio.gather(
+                *[self._leave( member ) for member in leaving],
+                *[self._join( next( self._names ) ) for _ in range( self._cli.burst_size )],
+                self._join_duplicate() )
+
+    async def _churn_flap( self ):
+        # A handful of members disconnect without saying EXIT and immediately reconnect under the
+        # same screen name, like a client stuck in a reconnect loop.
+        flappers = list( self._members.values() )[:self._cli.burst_size]
+        while True:
+            for index, member in enumerate( flappers ):
+                self._members.pop( member.screen_name, None )
+                member.close()
+                flappers[index] = await self._join( member.screen_name ) or SwarmMember( self, member.screen_name )
+            await asyncio.sleep( 1 / self._cli.churn_rate )
+
+    async def _report_progress( self ):
+        while True:
+            await asyncio.sleep( self._cli.report_interval )
+            elapsed = time.perf_counter() - self._start
+            print( f"[{elapsed:8.1f} s] members {len( self._members ):>7}  HELOs {self.hellos:>8}  "
+                f"accepted {self.accepts:>8}  rejected {self.rejects:>6}  failed {self.failures:>6}  "
+                f"datagrams {self.datagrams:>10}" )
+
+    def _print_summary( self, elapsed ):
+        reject_rate = 100 * self.rejects / self.hellos if self.hellos else 0
+        print()
+        print( f"Ran for {elapsed:.2f} s with churn pattern '{self._cli.churn}' across {self._cli.rooms} room(s)." )
+        print( f"HELOs sent:        {self.hellos} ({self.hellos / elapsed:,.1f}/s)" )
+        print( f"Accepted:          {self.accepts} ({self.accepts / elapsed:,.1f}/s)" )
+        print( f"Rejected:          {self.rejects} ({reject_rate:.2f}% of HELOs)" )
+        print( f"Failed:            {self.failures}" )
+        print( f"EXIT timeouts:     {self.exit_timeouts}" )
+        print( f"Dropped by server: {self.dropped}" )
+        print( f"Datagrams:         {self.datagrams} ({self.datagrams / elapsed:,.1f}/s)" )
+        print( f"ACPT latency:      {self.acpt_latency.format()}" )
+        print( f"RJCT latency:      {self.rjct_latency.format()}" )
+        print( f"JOIN propagation:  {self.join_latency.format()}" )
+        print( f"EXIT propagation:  {self.exit_latency.format()}" )
+
+def parse_command_line( argv ):
+    parser = argparse.ArgumentParser( description="EE382V Project 2 Chatter Server Swarm Load Generator" )
+    parser.add_argument( "server_address",
+        metavar="<server address>",
+        help="IP address or hostname of the membership server." )
+    parser.add_argument( "server_port",
+        metavar="<server port>",
+        type=int,
+        help="Welcome port of the membership server." )
+    parser.add_argument( "--members",
+        type=int,
+        default=1000,
+        help="Number of members to ramp up to." )
+    parser.add_argument( "--ramp-rate",
+        type=float,
+        default=0,
+        help="Members to connect per second while ramping up. Zero connects as fast as possible." )
+    parser.add_argument( "--concurrency",
+        type=int,
+        default=256,
+        help="Maximum number of HELOs in flight while ramping up." )
+    parser.add_argument( "--churn",
+        choices=CHURN_PATTERNS,
+        default="none",
+        help="Churn pattern to run once ramped up: none holds the members idle, steady replaces members "
+            "at a constant rate, burst replaces batches of members periodically, and flap has a few "
+            "members reconnect under the same name in a tight loop." )
+    parser.add_argument( "--churn-rate",
+        type=float,
+        default=10,
+        help="Replacements per second for the steady pattern and reconnect rounds per second for flap." )
+    parser.add_argument( "--burst-size",
+        type=int,
+        default=100,
+        help="Members replaced per burst, or the number of flapping members." )
+    parser.add_argument( "--burst-interval",
+        type=float,
+        default=5,
+        help="Seconds between bursts." )
+    parser.add_argument( "--duplicate-ratio",
+        type=float,
+        default=0,
+        help="Probability of also sending a HELO with an in-use screen name each churn step." )
+    parser.add_argument( "--duration",
+        type=float,
+        default=30,
+        help="Seconds to run the churn pattern for after ramping up." )
+    parser.add_argument( "--exit-timeout",
+        type=float,
+        default=5,
+        help="Seconds a leaving member waits for its EXIT to be acknowledged, and with --udp-membership, "
+            "seconds a joining member waits for an answer to its HELO." )
+    parser.add_argument( "--heartbeat-interval",
+        type=float,
+        default=0,
+        help="Seconds between PING heartbeats sent by each member. Zero disables heartbeats, which lets a "
+            "server with an idle timeout evict the members." )
+    parser.add_argument( "--udp-membership",
+        action="store_true",
+        help="Join, refresh, and leave over UDP instead of holding a TCP connection open per member. The "
+            "server must be running with --udp-membership. Heartbeats default to every 10 seconds." )
+    parser.add_argument( "--udp-host",
+        default="127.0.0.1",
+        help="Local address the members' datagram channels bind to and announce in HELO." )
+    parser.add_argument( "--rooms",
+        type=int,
+        default=1,
+        help="Spread the members across this many rooms. Each member then only receives the membership "
+            "events of its own room, which shows up as fewer datagrams per member." )
+    parser.add_argument( "--name-prefix",
+        default="swarm",
+        help="Prefix for generated screen names." )
+    parser.add_argument( "--report-interval",
+        type=float,
+        default=5,
+        help="Seconds between progress reports." )
+
+    cli = parser.parse_args( argv[1:] )
+    if cli.churn_rate <= 0:
+        parser.error( "The churn rate must be positive." )
+    if cli.rooms < 1:
+        parser.error( "At least one room is required." )
+    if cli.udp_membership and not cli.heartbeat_interval:
+        cli.heartbeat_interval = 10
+    return cli
+
+def main( argv ):
+    cli = parse_command_line( argv )
+    raise_open_file_limit()
+    asyncio.run( Swarm( cli ).run() )
+
+if __name__ == "__main__":
+    main( sys.argv )
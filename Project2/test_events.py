@@ -0,0 +1,91 @@
+import collections
+import unittest
+
+from server import DatagramChannel, Member, MemberRegistry, binary
+
+class FakeTransport:
+    def __init__( self ):
+        self.sent = []
+
+    def sendto( self, data, address ):
+        self.sent.append( (data, address) )
+
+class EventRepairTest( unittest.TestCase ):
+    # Membership events are numbered as they're sent, and a member that notices a gap asks for just
+    # the missing ones again with a NACK, which the channel answers from the room's event history.
+    ADDRESS = ("10.0.0.9", 9000)
+
+    def setUp( self ):
+        self.channel = DatagramChannel()
+        self.room = MemberRegistry()
+
+    def send_events( self, count, name_length=8, exits_only=False ):
+        # The channel isn't open yet, so the events are numbered and recorded as sent without going
+        # anywhere, and then the transport is swapped in to catch the resends. Members alternately
+        # join and leave unless told otherwise.
+        for index in range( count ):
+            member = Member( f"{index:0{name_length}}", "10.0.0.1", 5000 + index )
+            if index % 2 or exits_only:
+                self.channel.send_exit( member, self.room )
+            else:
+                self.channel.send_join( member, self.room )
+        self.channel._transport = FakeTransport()
+
+    def resend( self, first, last, binary_encoding=False ):
+        self.channel.resend_events( self.room, first, last, EventRepairTest.ADDRESS, binary_encoding )
+        sent, self.channel._transport.sent = self.channel._transport.sent, []
+        return [data for data, address in sent if address == EventRepairTest.ADDRESS]
+
+    def test_missing_events_are_resent_in_one_datagram( self ):
+        self.send_events( 5 )
+        self.assertEqual( self.resend( 2, 3 ),
+            [b"SEQN 2\nEXIT 00000001\nJOIN 00000002 10.0.0.1 5002\n"] )
+
+    def test_binary_resend_starts_with_a_binary_seqn( self ):
+        self.send_events( 3 )
+        datagram, = self.resend( 2, 3, binary_encoding=True )
+        frames = list( binary.split_frames( datagram ) )
+        self.assertEqual( [message_type for message_type, _ in frames], [binary.SEQN, binary.EXIT, binary.JOIN] )
+        self.assertEqual( binary.SEQUENCE.unpack( frames[0][1] ), (2,) )
+
+    def test_resend_is_limited_to_sent_events_still_in_history( self ):
+        self.send_events( 6 )
+        self.room.events.history = collections.deque( list( self.room.events.history )[-4:], maxlen=5 )
+
+        # Events waiting to be batched haven't been sent, so they can't have been missed.
+        self.channel._number_event( self.room.events, b"JOIN late 10.0.0.1 6000\n", b"" )
+        datagram, = self.resend( 1, 100 )
+        self.assertTrue( datagram.startswith( b"SEQN 3\n" ) )
+        self.assertEqual( datagram.count( b"\n" ), 5 )
+
+        self.assertEqual( self.resend( 7, 7 ), [] )
+
+    def test_one_request_resends_at_most_max_repair_events( self ):
+        self.send_events( DatagramChannel.MAX_REPAIR_EVENTS + 10, name_length=1 )
+        resent = b"".join( self.resend( 1, DatagramChannel.MAX_REPAIR_EVENTS + 10 ) )
+        self.assertEqual( resent.count( b"EXIT " ) + resent.count( b"JOIN " ), DatagramChannel.MAX_REPAIR_EVENTS )
+
+    def test_large_resends_are_split_into_datagrams_that_fit( self ):
+        # EXIT events are the same size in both encodings. Six of these fill a text datagram to within
+        # a byte of the limit, which the larger binary SEQN header would push over if it weren't counted.
+        self.send_events( 40, name_length=226, exits_only=True )
+        for binary_encoding in (False, True):
+            datagrams = self.resend( 1, 40, binary_encoding )
+            self.assertGreater( len( datagrams ), 1 )
+            self.assertTrue( all( len( datagram ) <= DatagramChannel.MAX_EVENT_BATCH_BYTES for datagram in datagrams ) )
+
+            # Every event is resent exactly once, in order, with each datagram numbered after the last.
+            sequence = 1
+            for datagram in datagrams:
+                if binary_encoding:
+                    frames = list( binary.split_frames( datagram ) )
+                    self.assertEqual( binary.SEQUENCE.unpack( frames[0][1] ), (sequence,) )
+                    sequence += len( frames ) - 1
+                else:
+                    header, *events = datagram[:-1].split( b"\n" )
+                    self.assertEqual( header, f"SEQN {sequence}".encode() )
+                    sequence += len( events )
+            self.assertEqual( sequence, 41 )
+
+if __name__ == "__main__":
+    unittest.main()
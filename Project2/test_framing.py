@@ -0,0 +1,146 @@
+import asyncio
+import os
+import sys
+import threading
+import unittest
+
+# LineProtocol and LoopHandoff live in the chatter package the server shares with the client.
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), os.pardir, "Project1" ) )
+
+from chatter import binary
+from chatter.framing import LineProtocol, MIN_READ_SIZE
+from chatter.util import LoopHandoff
+
+class RecordingProtocol( LineProtocol ):
+    def __init__( self, **kwargs ):
+        super().__init__( **kwargs )
+        self.messages = []
+        self.too_large = 0
+
+    def message_received( self, message ):
+        self.messages.append( message )
+
+    def binary_frame_received( self, message_type, body ):
+        self.messages.append( (message_type, body) )
+
+    def frame_too_large( self ):
+        self.too_large += 1
+
+    def feed( self, data, read_size=None ):
+        # Hands the data over the way a transport would, in reads of at most read_size bytes. Like a
+        # transport, it lets go of each buffer before asking for the next, which may have to grow it.
+        while data:
+            buffer = self.get_buffer( -1 )
+            count = min( len( buffer ), len( data ), read_size or len( data ) )
+            buffer[:count] = data[:count]
+            buffer.release()
+            self.buffer_updated( count )
+            data = data[count:]
+
+class LineProtocolTest( unittest.TestCase ):
+    def test_messages_split_across_reads( self ):
+        protocol = RecordingProtocol()
+        protocol.feed( "HELO alice 10.0.0.1 5000\nMESG alice: héllo\nEXIT".encode(), read_size=3 )
+        self.assertEqual( protocol.messages, ["HELO alice 10.0.0.1 5000", "MESG alice: héllo"] )
+        protocol.feed( b"\n" )
+        self.assertEqual( protocol.messages[-1], "EXIT" )
+
+    def test_oversized_message_is_discarded( self ):
+        protocol = RecordingProtocol( max_frame_size=16 )
+        protocol.feed( b"short\n" + b"x" * 40, read_size=8 )
+        protocol.feed( b"x" * 40 + b"\nafter\n", read_size=8 )
+        self.assertEqual( protocol.messages, ["short", "after"] )
+        self.assertEqual( protocol.too_large, 1 )
+
+    def test_buffer_grows_for_large_messages( self ):
+        protocol = RecordingProtocol( max_frame_size=16 * MIN_READ_SIZE )
+        message = "ACPT " + "m" * (10 * MIN_READ_SIZE)
+        protocol.feed( (message + "\n").encode(), read_size=MIN_READ_SIZE )
+        self.assertEqual( protocol.messages, [message] )
+
+    def test_text_frames_are_not_binary( self ):
+        protocol = RecordingProtocol( allow_binary_frames=True )
+        protocol.feed( b"PING\n" )
+        self.assertFalse( protocol.binary_frames )
+        self.assertEqual( protocol.messages, ["PING"] )
+
+    def test_binary_frames_split_across_reads( self ):
+        protocol = RecordingProtocol( allow_binary_frames=True )
+        data = binary.encode_hello( "alice", "10.0.0.1", 5000 ) + binary.encode_frame( binary.PING ) + \
+            binary.encode_message( "alice", "hi" )
+        protocol.feed( data, read_size=3 )
+        self.assertTrue( protocol.binary_frames )
+        self.assertEqual( [message_type for message_type, _ in protocol.messages], [binary.HELO, binary.PING, binary.MESG] )
+        self.assertEqual( binary.decode_message( protocol.messages[2][1] ), ("alice", "hi") )
+
+    def test_binary_frame_with_a_bad_length_ends_the_stream( self ):
+        protocol = RecordingProtocol( max_frame_size=64, allow_binary_frames=True )
+        protocol.feed( binary.FRAME_HEADER.pack( 1000, binary.MESG ) + b"x" * 10 )
+        protocol.feed( binary.encode_frame( binary.PING ) )
+        self.assertEqual( protocol.messages, [] )
+        self.assertEqual( protocol.too_large, 1 )
+
+class LoopHandoffTest( unittest.TestCase ):
+    def setUp( self ):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup( self.loop.close )
+        self.calls = []
+
+    def run_loop_once( self ):
+        self.loop.run_until_complete( asyncio.sleep( 0 ) )
+
+    def test_calls_run_in_order_in_one_batch( self ):
+        handoff = LoopHandoff( self.loop, threadsafe=False )
+        for index in range( 3 ):
+            handoff.call_soon( self.calls.append, index )
+        self.assertEqual( self.calls, [] )
+        self.run_loop_once()
+        self.assertEqual( self.calls, [0, 1, 2] )
+
+    def test_call_queued_by_a_call_runs_on_the_next_pass( self ):
+        handoff = LoopHandoff( self.loop, threadsafe=False )
+        handoff.call_soon( lambda: (self.calls.append( "first" ), handoff.call_soon( self.calls.append, "second" )) )
+        self.loop.call_soon( self.loop.stop )
+        self.loop.run_forever()
+        self.assertEqual( self.calls, ["first"] )
+        self.run_loop_once()
+        self.assertEqual( self.calls, ["first", "second"] )
+
+    def test_failing_call_does_not_stop_the_rest( self ):
+        errors = []
+        self.loop.set_exception_handler( lambda loop, context: errors.append( context["exception"] ) )
+        handoff = LoopHandoff( self.loop, threadsafe=False )
+        handoff.call_soon( lambda: 1 / 0 )
+        handoff.call_soon( self.calls.append, "after" )
+        self.run_loop_once()
+        self.assertEqual( self.calls, ["after"] )
+        self.assertIsInstance( errors[0], ZeroDivisionError )
+
+    def test_calls_handed_over_from_another_thread( self ):
+        handoff = LoopHandoff( self.loop )
+        done = self.loop.create_future()
+
+        def hand_over():
+            for index in range( 100 ):
+                handoff.call_soon( self.calls.append, index )
+            handoff.call_soon( done.set_result, None )
+
+        thread = threading.Thread( target=hand_over )
+        thread.start()
+        self.loop.run_until_complete( asyncio.wait_for( done, 5 ) )
+        thread.join()
+        self.assertEqual( self.calls, list( range( 100 ) ) )
+
+    def test_create_task( self ):
+        handoff = LoopHandoff( self.loop, threadsafe=False )
+
+        async def record():
+            self.calls.append( "task" )
+
+        handoff.create_task( record() )
+        self.run_loop_once()
+        self.run_loop_once()
+        self.assertEqual( self.calls, ["task"] )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+from server import Member, MemberRegistry, binary
+
+def make_member( screen_name, index=0 ):
+    return Member( screen_name, "10.0.0.1", 5000 + index )
+
+def parse_resync( message ):
+    # Returns the screen names a text RSYN says joined and the ones it says left.
+    joined, departed = set(), set()
+    for change in message[len( b"RSYN " ):-1].decode().split( ":" ):
+        if change.startswith( "+" ):
+            joined.add( change[1:].split( " " )[0] )
+        else:
+            departed.add( change[1:] )
+    return joined, departed
+
+class RosterTest( unittest.TestCase ):
+    def setUp( self ):
+        self.room = MemberRegistry( changelog_size=8 )
+        self.connections = {}
+        self.joins = 0
+
+    def join( self, *screen_names ):
+        for screen_name in screen_names:
+            self.joins += 1
+            self.connections[screen_name] = object()
+            self.room.add( make_member( screen_name, self.joins ), self.connections[screen_name] )
+
+    def leave( self, *screen_names ):
+        for screen_name in screen_names:
+            self.room.remove_by_connection( self.connections.pop( screen_name ) )
+
+    def test_accept_message_follows_joins_and_leaves( self ):
+        self.join( "a", "b", "c" )
+        self.leave( "b" )
+        self.join( "d" )
+        self.assertEqual( self.room.accept_message, b"ACPT a 10.0.0.1 5001:c 10.0.0.1 5003:d 10.0.0.1 5004\n" )
+        members = binary.decode_members( next( binary.split_frames( self.room.binary_accept_message ) )[1] )
+        self.assertEqual( [member[0] for member in members], ["a", "c", "d"] )
+
+    def test_resync_sends_the_net_change_since_a_version( self ):
+        self.join( "a", "b", "c", "d", "e" )
+        version = self.room.roster_version
+        self.join( "f" )
+        self.leave( "a" )
+        self.join( "g" )
+        self.leave( "g" )
+        self.assertEqual( parse_resync( self.room.resync_message( version ) ), ({"f"}, {"a", "g"}) )
+
+    def test_binary_resync_carries_the_same_changes( self ):
+        self.join( "a", "b", "c", "d" )
+        version = self.room.roster_version
+        self.leave( "b" )
+        self.join( "e" )
+        message_type, body = next( binary.split_frames( self.room.binary_resync_message( version ) ) )
+        self.assertEqual( message_type, binary.RSYN )
+        joined, departed = binary.decode_roster_changes( body )
+        self.assertEqual( ([member[0] for member in joined], departed), (["e"], ["b"]) )
+
+    def test_cached_resync_is_brought_forward( self ):
+        self.join( "a", "b", "c", "d", "e" )
+        version = self.room.roster_version
+        self.leave( "a" )
+        self.assertEqual( parse_resync( self.room.resync_message( version ) ), (set(), {"a"}) )
+
+        # Somebody else rejoining with the same version is sent what changed since as well.
+        self.join( "a", "f" )
+        self.assertEqual( parse_resync( self.room.resync_message( version ) ), ({"a", "f"}, set()) )
+
+    def test_resync_is_refused_when_an_acpt_is_needed( self ):
+        self.join( "a", "b" )
+        roster_id, version = self.room.roster_version
+
+        # Up to date already, so there's nothing to send but an empty change list.
+        self.assertEqual( self.room.resync_message( (roster_id, version) ), b"RSYN \n" )
+
+        # A version from another server process, or one from the future.
+        self.assertIsNone( self.room.resync_message( (roster_id + 1, version) ) )
+        self.assertIsNone( self.room.resync_message( (roster_id, version + 1) ) )
+
+        # More changes than the roster has members.
+        self.leave( "a", "b" )
+        self.join( "c" )
+        self.assertIsNone( self.room.resync_message( (roster_id, version) ) )
+
+    def test_resync_is_refused_once_the_changelog_has_moved_past_the_version( self ):
+        self.join( *"abcdefgh" )
+        version = self.room.roster_version
+        self.join( *"ijklmnopq" )
+        self.assertIsNone( self.room.resync_message( version ) )
+
+if __name__ == "__main__":
+    unittest.main()
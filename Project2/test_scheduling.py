@@ -0,0 +1,175 @@
+import unittest
+
+from server import AdmissionControl, TimerWheel
+
+class FakeTimer:
+    def __init__( self, when, callback, args ):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel( self ):
+        self.cancelled = True
+
+class FakeLoop:
+    # Stands in for an event loop whose clock only moves when a test moves it, running any timers that
+    # come due along the way in deadline order.
+    def __init__( self ):
+        self.now = 0.0
+        self._timers = []
+
+    def time( self ):
+        return self.now
+
+    def call_at( self, when, callback, *args ):
+        timer = FakeTimer( when, callback, args )
+        self._timers.append( timer )
+        return timer
+
+    def call_later( self, delay, callback, *args ):
+        return self.call_at( self.now + delay, callback, *args )
+
+    def advance( self, seconds ):
+        deadline = self.now + seconds
+        while True:
+            due = [timer for timer in self._timers if not timer.cancelled and timer.when <= deadline]
+            if not due:
+                break
+            timer = min( due, key=lambda timer: timer.when )
+            self._timers.remove( timer )
+            self.now = max( self.now, timer.when )
+            timer.callback( *timer.args )
+        self.now = deadline
+
+    def stall( self, seconds ):
+        # Moves the clock without running anything, as when the loop is held up by a long callback.
+        self.now += seconds
+
+class TimerWheelTest( unittest.TestCase ):
+    def setUp( self ):
+        self.loop = FakeLoop()
+        self.expired = []
+        self.wheel = TimerWheel( self.expired.append, tick=1.0, slot_count=4 )
+        self.wheel.start( self.loop )
+
+    def test_timer_goes_off_after_its_ticks( self ):
+        self.wheel.schedule( "a", 2 )
+        self.loop.advance( 1.5 )
+        self.assertEqual( self.expired, [] )
+        self.loop.advance( 1.0 )
+        self.assertEqual( self.expired, ["a"] )
+
+    def test_cancelled_timer_never_goes_off( self ):
+        self.wheel.schedule( "a", 1 )
+        self.wheel.cancel( "a" )
+        self.wheel.cancel( "never scheduled" )
+        self.loop.advance( 5.0 )
+        self.assertEqual( self.expired, [] )
+
+    def test_rescheduling_replaces_the_deadline( self ):
+        self.wheel.schedule( "a", 1 )
+        self.wheel.schedule( "a", 3 )
+        self.loop.advance( 2.5 )
+        self.assertEqual( self.expired, [] )
+        self.loop.advance( 1.0 )
+        self.assertEqual( self.expired, ["a"] )
+
+    def test_deadline_past_one_revolution_waits_its_turn( self ):
+        # With 4 slots, a timer 6 ticks out shares a slot with tick 2, which has to skip it.
+        self.wheel.schedule( "far", 6 )
+        self.wheel.schedule( "near", 2 )
+        self.loop.advance( 2.5 )
+        self.assertEqual( self.expired, ["near"] )
+        self.loop.advance( 3.0 )
+        self.assertEqual( self.expired, ["near"] )
+        self.loop.advance( 1.0 )
+        self.assertEqual( self.expired, ["near", "far"] )
+
+    def test_catches_up_on_ticks_missed_while_the_loop_was_held_up( self ):
+        self.wheel.schedule( "a", 1 )
+        self.wheel.schedule( "b", 3 )
+        self.loop.stall( 3.5 )
+        self.loop.advance( 0.0 )
+        self.assertEqual( self.expired, ["a", "b"] )
+        self.assertEqual( self.wheel.current_tick, 3 )
+
+    def test_stop_cancels_the_wheels_own_timer( self ):
+        self.wheel.schedule( "a", 1 )
+        self.wheel.stop()
+        self.loop.advance( 5.0 )
+        self.assertEqual( self.expired, [] )
+
+class AdmissionControlTest( unittest.TestCase ):
+    def setUp( self ):
+        self.loop = FakeLoop()
+        self.handled = []
+        self.rejected = []
+
+    def start( self, **kwargs ):
+        admission = AdmissionControl( **kwargs )
+        admission.start( self.loop )
+        self.addCleanup( admission.stop )
+        return admission
+
+    def admit( self, admission, source_ip, key ):
+        return admission.admit( source_ip, key, lambda: self.handled.append( key ),
+            lambda reason: self.rejected.append( (key, reason) ) )
+
+    def test_source_over_its_rate_is_rejected( self ):
+        admission = self.start( source_rate=1.0, source_burst=2 )
+        self.assertTrue( self.admit( admission, "10.0.0.1", "a" ) )
+        self.assertTrue( self.admit( admission, "10.0.0.1", "b" ) )
+        self.assertFalse( self.admit( admission, "10.0.0.1", "c" ) )
+        self.assertEqual( self.rejected, [("c", "RATE")] )
+
+        # Other sources have buckets of their own, and the source's own bucket refills over time.
+        self.assertTrue( self.admit( admission, "10.0.0.2", "d" ) )
+        self.loop.advance( 1.0 )
+        self.assertTrue( self.admit( admission, "10.0.0.1", "e" ) )
+        self.assertEqual( admission.source_rejected, 1 )
+
+    def test_helos_over_the_budget_wait_for_it_to_refill( self ):
+        admission = self.start( accept_rate=2.0, accept_burst=1 )
+        self.assertTrue( self.admit( admission, "10.0.0.1", "a" ) )
+        self.assertFalse( self.admit( admission, "10.0.0.2", "b" ) )
+        self.assertFalse( self.admit( admission, "10.0.0.3", "c" ) )
+        self.assertEqual( self.handled, [] )
+
+        self.loop.advance( 0.5 )
+        self.assertEqual( self.handled, ["b"] )
+        self.loop.advance( 0.5 )
+        self.assertEqual( self.handled, ["b", "c"] )
+        self.assertEqual( (admission.admitted, admission.deferred), (3, 2) )
+
+    def test_helos_beyond_the_deferred_limit_are_rejected( self ):
+        admission = self.start( accept_rate=1.0, accept_burst=1, max_deferred=1 )
+        self.admit( admission, "10.0.0.1", "a" )
+        self.admit( admission, "10.0.0.2", "b" )
+        self.assertFalse( self.admit( admission, "10.0.0.3", "c" ) )
+        self.assertEqual( self.rejected, [("c", "BUSY")] )
+        self.assertEqual( admission.budget_rejected, 1 )
+
+    def test_repeated_helo_keeps_its_place_in_line( self ):
+        admission = self.start( accept_rate=1.0, accept_burst=1 )
+        self.admit( admission, "10.0.0.1", "a" )
+        self.admit( admission, "10.0.0.2", "b" )
+        self.admit( admission, "10.0.0.3", "c" )
+
+        # The repeat replaces what's handled once its turn comes, without taking another place.
+        admission.admit( "10.0.0.2", "b", lambda: self.handled.append( "b again" ), None )
+        self.assertEqual( admission.deferred, 2 )
+        self.loop.advance( 1.0 )
+        self.assertEqual( self.handled, ["b again"] )
+
+    def test_cancelled_helo_gives_up_its_place( self ):
+        admission = self.start( accept_rate=1.0, accept_burst=1 )
+        self.admit( admission, "10.0.0.1", "a" )
+        self.admit( admission, "10.0.0.2", "b" )
+        self.admit( admission, "10.0.0.3", "c" )
+        admission.cancel( "b" )
+        self.loop.advance( 1.0 )
+        self.assertEqual( self.handled, ["c"] )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+def find_free_port( kind=socket.SOCK_STREAM ):
+    with socket.socket( socket.AF_INET, kind ) as sock:
+        sock.bind( ("127.0.0.1", 0) )
+        return sock.getsockname()[1]
+
+def pick_multicast_group():
+    # A group and port of its own for each test, so that tests running side by side (or anything
+    # else on the machine using a fixed group) don't hear each other's traffic.
+    return (f"239.255.{random.randrange( 256 )}.{random.randrange( 1, 255 )}", find_free_port( socket.SOCK_DGRAM ))
+
+class MixedMulticastLobbyTest( unittest.TestCase ):
+    # A lobby in multicast mode with an older client that doesn't ask for sequenced events (and so
+    # never joins the multicast group) alongside one that does. Both have to hear every event and
+    # every chat message.
+    def setUp( self ):
+        self.port = find_free_port()
+        self.multicast_group = pick_multicast_group()
+        server_path = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "server.py" )
+        self.server = subprocess.Popen( [sys.executable, server_path, str( self.port ), "--relay-chat",
+                "--multicast", f"{self.multicast_group[0]}:{self.multicast_group[1]}", "--multicast-interface", "127.0.0.1"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True )
+        self.sockets = []
+
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection( ("127.0.0.1", self.port ) ).close()
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep( 0.1 )
+
+    def tearDown( self ):
+        for sock in self.sockets:
+            sock.close()
+        os.killpg( self.server.pid, signal.SIGTERM )
+        self.server.wait()
+
+    def open_datagram_socket( self, port=0 ):
+        sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        sock.settimeout( 2 )
+        self.sockets.append( sock )
+        if port:
+            sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+            if hasattr( socket, "SO_REUSEPORT" ):
+                sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEPORT, 1 )
+            sock.bind( ("", port) )
+        else:
+            sock.bind( ("127.0.0.1", 0) )
+            sock.setsockopt( socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton( "127.0.0.1" ) )
+        return sock
+
+    def join( self, screen_name, datagram_sock, sequenced ):
+        conn = socket.create_connection( ("127.0.0.1", self.port) )
+        conn.settimeout( 2 )
+        self.sockets.append( conn )
+        hello = f"HELO {screen_name} 127.0.0.1 {datagram_sock.getsockname()[1]}{' SEQN' if sequenced else ''}\n"
+        conn.sendall( hello.encode() )
+
+        received = b""
+        while b"ACPT " not in received:
+            received += conn.recv( 4096 )
+        return conn
+
+    def receive_until( self, sock, prefix ):
+        # Returns the first datagram that starts with the prefix, skipping anything else.
+        while True:
+            data, _ = sock.recvfrom( 65536 )
+            if data.startswith( prefix ):
+                return data
+
+    def test_legacy_member_hears_events_and_chat( self ):
+        legacy_sock = self.open_datagram_socket()
+        self.join( "legacy", legacy_sock, sequenced=False )
+
+        sequenced_sock = self.open_datagram_socket()
+        group_sock = self.open_datagram_socket( self.multicast_group[1] )
+        group_sock.setsockopt( socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+            socket.inet_aton( self.multicast_group[0] ) + socket.inet_aton( "127.0.0.1" ) )
+        sequenced_conn = self.join( "sequenced", sequenced_sock, sequenced=True )
+
+        # The legacy member gets each event on its own, without a SEQN, starting with its own JOIN.
+        self.assertEqual( legacy_sock.recvfrom( 65536 )[0],
+            f"JOIN legacy 127.0.0.1 {legacy_sock.getsockname()[1]}\n".encode() )
+        self.assertEqual( legacy_sock.recvfrom( 65536 )[0],
+            f"JOIN sequenced 127.0.0.1 {sequenced_sock.getsockname()[1]}\n".encode() )
+
+        # Chat the sequenced member multicasts to the room is passed on to the legacy member.
+        sequenced_sock.sendto( b"MESG sequenced: over the group\n", self.multicast_group )
+        self.assertEqual( self.receive_until( legacy_sock, b"MESG " ), b"MESG sequenced: over the group\n" )
+
+        # So is chat the server relays, which the sequenced member hears over the group.
+        sequenced_conn.sendall( b"MESG sequenced: through the server\n" )
+        self.assertEqual( self.receive_until( legacy_sock, b"MESG " ), b"MESG sequenced: through the server\n" )
+
+        # Chat from the legacy member reaches the group.
+        legacy_conn = self.join( "legacy2", self.open_datagram_socket(), sequenced=False )
+        legacy_conn.sendall( b"MESG legacy2: hello\n" )
+        self.assertEqual( self.receive_until( group_sock, b"MESG legacy2" ), b"MESG legacy2: hello\n" )
+        self.assertEqual( self.receive_until( legacy_sock, b"MESG " ), b"MESG legacy2: hello\n" )
+
+        # Nobody can speak for somebody else over the group.
+        legacy_sock.settimeout( 0.5 )
+        self.open_datagram_socket().sendto( b"MESG sequenced: forged\n", self.multicast_group )
+        with self.assertRaises( socket.timeout ):
+            self.receive_until( legacy_sock, b"MESG " )
+
+if __name__ == "__main__":
+    unittest.main()